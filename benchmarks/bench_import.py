@@ -0,0 +1,86 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Import time of the bv2mne modules, each one in a fresh interpreter
+#
+#   python benchmarks/bench_import.py --repeat 5 --output import.json
+#
+# Reports the best import time and the heavy dependencies loaded by each module. Entry points (command line,
+# pipeline workers) must not load any of them, the script exits with an error if they do or if they are slower
+# than --max-time
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import os.path as op
+import subprocess
+import sys
+
+# Modules loaded at the start of the command line and of each pipeline worker
+entry_points = ['bv2mne.main', 'bv2mne.pipeline']
+modules = entry_points + ['bv2mne.utils', 'bv2mne.bem', 'bv2mne.sensors', 'bv2mne.labels', 'bv2mne.surface',
+                          'bv2mne.volume', 'bv2mne.source', 'bv2mne.forward', 'bv2mne.planning',
+                          'bv2mne.vis']
+heavy = ['numpy', 'scipy', 'mne', 'nibabel', 'visbrain', 'vispy', 'matplotlib']
+
+_probe = '''
+import sys, time, json
+start = time.perf_counter()
+import {0}
+wall = time.perf_counter() - start
+print(json.dumps({{'wall': wall, 'loaded': sorted(set(m.split('.')[0] for m in sys.modules) & set({1!r}))}}))
+'''
+
+root = op.dirname(op.dirname(op.abspath(__file__)))
+
+
+def import_time(module, repeat=3):
+    """ Best import time of a module in fresh interpreters and the heavy dependencies it loads
+
+    Returns
+    -------
+    result : dict
+        module, wall (s, None if the import failed), loaded (list of heavy packages) and error
+    """
+    best, loaded, error = None, [], None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', _probe.format(module, heavy)], cwd=root,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'import failed'
+            break
+        res = json.loads(proc.stdout.strip().splitlines()[-1])
+        best = res['wall'] if best is None else min(best, res['wall'])
+        loaded = res['loaded']
+    return {'module': module, 'wall': best, 'loaded': loaded, 'error': error}
+
+
+def print_results(results):
+    print('\n{0:<18} {1:>10}  {2}'.format('module', 'wall (s)', 'heavy dependencies loaded'))
+    for r in results:
+        wall = '{0:>10.3f}'.format(r['wall']) if r['wall'] is not None else '{0:>10}'.format('-')
+        print('{0:<18} {1}  {2}'.format(r['module'], wall, r['error'] or ', '.join(r['loaded']) or '-'))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Import time of the bv2mne modules")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=3,
+                        help="Number of fresh interpreters per module, the best time is kept")
+    parser.add_argument("--max-time", dest="max_time", type=float, default=0.5,
+                        help="Maximum import time of the entry points, in s")
+    parser.add_argument("--output", dest="output", type=str, default=None,
+                        help="Save the results as json")
+    args = parser.parse_args()
+
+    results = [import_time(m, repeat=args.repeat) for m in modules]
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    failed = [r['module'] for r in results if r['module'] in entry_points and
+              (r['error'] or r['loaded'] or r['wall'] > args.max_time)]
+    if failed:
+        sys.exit('Import regression in {0}'.format(', '.join(failed)))
@@ -0,0 +1,144 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Benchmark of the source and forward pipeline on synthetic fixtures, at scalable sizes
+#
+#   python benchmarks/bench_pipeline.py --grades 3 4 5 --n-channels 102 --repeat 3 --output bench.json
+#
+# Reports wall time, throughput and peak (traced) memory of each stage
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from fixtures import make_project, make_meg_info
+
+
+def measure(func, *args, repeat=1, **kwargs):
+    """ Best wall time over repeat runs and peak memory allocated during one run
+
+    Returns
+    -------
+    result : object
+        Value returned by the last run
+    wall : float
+        Best wall time, in s
+    peak : float
+        Peak memory allocated by python and numpy during the call, in MB
+    """
+    wall = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        wall = min(wall, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1] / 2. ** 20
+    tracemalloc.stop()
+
+    return result, wall, peak
+
+
+def bench_grade(root, grade, n_channels=102, repeat=1, forward=True):
+    """ Benchmark all the stages on a synthetic project with meshes of a given grade """
+    from bv2mne.utils import create_trans
+    from bv2mne.surface import get_surface, get_surface_labels
+    from bv2mne.source import get_brain_surf_sources
+    from bv2mne.volume import get_volume
+    from bv2mne.bem import create_bem
+    from bv2mne.forward import forward_model
+
+    fx = make_project(root, grade=grade)
+    layout, subject = fx['layout'], fx['subject']
+    n_vertices = fx['n_vertices']
+
+    results = []
+
+    def record(stage, n_items, unit, wall, peak):
+        results.append({'grade': grade, 'n_vertices': n_vertices, 'stage': stage, 'wall': wall,
+                        'throughput': n_items / wall if wall > 0 else float('inf'), 'unit': unit, 'peak_mb': peak})
+
+    _, wall, peak = measure(create_trans, subject, layout.database, fx['fname_trans_ref'], fx['fname_trans_out'],
+                            repeat=repeat)
+    record('create_trans', 1, 'chain/s', wall, peak)
+
+    surface, wall, peak = measure(get_surface, fx['fname_surf'][0], subject, 'lh', trans=fx['fname_trans_out'],
+                                  repeat=repeat)
+    record('get_surface', n_vertices, 'vertices/s', wall, peak)
+
+    _, wall, peak = measure(get_surface, fx['fname_surf'][0], subject, 'lh', trans=fx['fname_trans_out'],
+                            compact=True, repeat=repeat)
+    record('get_surface (compact)', n_vertices, 'vertices/s', wall, peak)
+
+    _, wall, peak = measure(get_surface_labels, surface, fx['fname_tex'][0], subject=subject, hemi='lh',
+                            repeat=repeat)
+    record('get_surface_labels', n_vertices, 'vertices/s', wall, peak)
+
+    (surf_src, surf_labels), wall, peak = measure(get_brain_surf_sources, subject, fx['fname_surf'][0],
+                                                  fx['fname_surf'][1], fx['fname_tex'][0], fx['fname_tex'][1],
+                                                  trans=fx['fname_trans_out'], repeat=repeat)
+    record('get_brain_surf_sources', 2 * n_vertices, 'vertices/s', wall, peak)
+
+    _, wall, peak = measure(get_brain_surf_sources, subject, fx['fname_surf'][0], fx['fname_surf'][1],
+                            fx['fname_tex'][0], fx['fname_tex'][1], trans=fx['fname_trans_out'], n_jobs=2,
+                            repeat=repeat)
+    record('get_brain_surf_sources (2 threads)', 2 * n_vertices, 'vertices/s', wall, peak)
+
+    # Volume sources need the BEM model, not benchmarked (depends on anatomy only)
+    create_bem(layout, subject)
+    vol_src, wall, peak = measure(get_volume, subject, pos=5.0, json_fname=layout, repeat=repeat)
+    record('get_volume', sum(s['nuse'] for s in vol_src), 'sources/s', wall, peak)
+
+    if forward:
+        info = make_meg_info(n_channels)
+        _, wall, peak = measure(forward_model, subject, 'bench', info, fx['fname_trans'], surf_src,
+                                force_fixed=True, name='surf', json_fname=layout, use_cache=False, force=True,
+                                repeat=repeat)
+        n_sources = sum(s['nuse'] for s in surf_src)
+        record('forward_model', n_sources * n_channels, 'gains/s', wall, peak)
+
+    return results
+
+
+def print_results(results):
+    print('\n{0:>5} {1:>9} {2:<34} {3:>10} {4:>14} {5:<11} {6:>10}'.format(
+        'grade', 'vertices', 'stage', 'wall (s)', 'throughput', '', 'peak (MB)'))
+    for r in results:
+        print('{grade:>5} {n_vertices:>9} {stage:<34} {wall:>10.4f} {throughput:>14.1f} {unit:<11} '
+              '{peak_mb:>10.1f}'.format(**r))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark of the bv2mne pipeline on synthetic data")
+    parser.add_argument("--grades", dest="grades", type=int, nargs='+', default=[3, 4, 5],
+                        help="Subdivisions of the cortical meshes (10 * 4 ** grade + 2 vertices)")
+    parser.add_argument("--n-channels", dest="n_channels", type=int, default=102,
+                        help="Number of MEG channels")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1,
+                        help="Number of timed runs per stage, the best is kept")
+    parser.add_argument("--no-forward", dest="forward", action='store_false',
+                        help="Skip the forward model benchmark")
+    parser.add_argument("--output", dest="output", type=str, default=None,
+                        help="Save the results as json")
+    args = parser.parse_args()
+
+    results = []
+    for grade in args.grades:
+        root = tempfile.mkdtemp(prefix='bv2mne_bench_')
+        try:
+            results += bench_grade(root, grade, n_channels=args.n_channels, repeat=args.repeat,
+                                   forward=args.forward)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
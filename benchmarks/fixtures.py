@@ -0,0 +1,217 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Synthetic BrainVISA/FreeSurfer/MEG fixtures for the benchmarks, no subject data needed
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+import os
+import os.path as op
+from contextlib import nullcontext
+
+import numpy as np
+
+# FreeSurfer aseg values of the subcortical structures used by bv2mne.volume
+aseg_values = {'Left-Thalamus-Proper': 10, 'Left-Caudate': 11, 'Left-Putamen': 12, 'Left-Pallidum': 13,
+               'Left-Hippocampus': 17, 'Left-Amygdala': 18, 'Left-Accumbens-area': 26,
+               'Right-Thalamus-Proper': 49, 'Right-Caudate': 50, 'Right-Putamen': 51, 'Right-Pallidum': 52,
+               'Right-Hippocampus': 53, 'Right-Amygdala': 54, 'Right-Accumbens-area': 58}
+
+
+def icosphere(grade):
+    """ Unit sphere mesh from a subdivided icosahedron
+
+    Parameters
+    ----------
+    grade : int
+        Number of subdivisions, the mesh has 10 * 4 ** grade + 2 vertices
+
+    Returns
+    -------
+    rr : array, shape (n_vertices, 3)
+        Vertex positions
+    tris : array, shape (n_triangles, 3)
+        Triangles
+    """
+    t = (1. + np.sqrt(5.)) / 2.
+    rr = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                   [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                   [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], float)
+    tris = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                     [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                     [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                     [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+
+    for _ in range(grade):
+        # One new vertex in the middle of each edge
+        edges = np.sort(np.vstack([tris[:, [0, 1]], tris[:, [1, 2]], tris[:, [2, 0]]]), axis=1)
+        edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+        mid = len(rr) + inverse.reshape(3, -1)
+        rr = np.vstack([rr, (rr[edges[:, 0]] + rr[edges[:, 1]]) / 2.])
+        a, b, c = tris.T
+        ab, bc, ca = mid
+        tris = np.vstack([np.c_[a, ab, ca], np.c_[b, bc, ab], np.c_[c, ca, bc], np.c_[ab, bc, ca]])
+
+    rr /= np.linalg.norm(rr, axis=1, keepdims=True)
+    return rr, tris
+
+
+def parcels_texture(rr, n_parcels=48, offset=0):
+    """ Spatially coherent parcellation of a sphere mesh in longitude/latitude sectors """
+    n_lat = 4
+    n_lon = n_parcels // n_lat
+    lat = np.clip(((rr[:, 2] + 1.) / 2. * n_lat).astype(int), 0, n_lat - 1)
+    lon = np.clip(((np.arctan2(rr[:, 1], rr[:, 0]) + np.pi) / (2 * np.pi) * n_lon).astype(int), 0, n_lon - 1)
+    return (offset + lat * n_lon + lon).astype(np.float32)
+
+
+def _write_gifti(fname, arrays, intents):
+    import nibabel as nib
+    darrays = [nib.gifti.GiftiDataArray(a, intent=i) for a, i in zip(arrays, intents)]
+    nib.save(nib.gifti.GiftiImage(darrays=darrays), fname)
+
+
+def _write_trm(fname, rotation, translation):
+    """ BrainVISA .trm: translation on the first line, then the rotation """
+    with open(fname, 'w') as f:
+        f.write(' '.join(str(v) for v in translation) + '\n')
+        for row in np.asarray(rotation).T:
+            f.write(' '.join(str(v) for v in row) + '\n')
+
+
+def _write_aseg(fname, shape=(96, 96, 96), size=8):
+    """ aseg-like volume (1 mm voxels, LIA) with one cubic block per subcortical structure """
+    import nibabel as nib
+    data = np.zeros(shape, dtype=np.int32)
+    center = np.array(shape) // 2
+    for hemi, side in [('Left', -1), ('Right', 1)]:
+        names = sorted(n for n in aseg_values if n.startswith(hemi))
+        for k, name in enumerate(names):
+            dist = 4 + (size + 2) * (k % 2)
+            x = center[0] + dist if side > 0 else center[0] - dist - size
+            y = center[1] + (size + 2) * (k // 2) - 2 * size
+            z = center[2] - size // 2
+            data[x:x + size, y:y + size, z:z + size] = aseg_values[name]
+    affine = np.array([[-1., 0, 0, shape[0] / 2.], [0, 0, 1., -shape[2] / 2.],
+                       [0, -1., 0, shape[1] / 2.], [0, 0, 0, 1.]])
+    nib.save(nib.MGHImage(data, affine), fname)
+
+
+def make_meg_info(n_channels=102, radius=0.12):
+    """ Fake MEG measurement info with magnetometers on a helmet-like half sphere
+
+    Parameters
+    ----------
+    n_channels : int
+        Number of magnetometers
+    radius : float
+        Radius of the helmet, in m
+
+    Returns
+    -------
+    info : instance of mne.Info
+        Info with sensor locations, identity dev_head_t
+    """
+    import mne
+
+    # Golden spiral on the upper half sphere
+    k = np.arange(n_channels) + 0.5
+    z = 1. - k / n_channels * 0.9
+    theta = np.pi * (1. + np.sqrt(5.)) * k
+    pos = np.c_[np.sqrt(1. - z ** 2) * np.cos(theta), np.sqrt(1. - z ** 2) * np.sin(theta), z]
+
+    info = mne.create_info(['MEG{0:04d}'.format(i) for i in range(n_channels)], 1000., 'mag')
+    for ch, p in zip(info['chs'], pos):
+        ez = p
+        ex = np.cross([0., 0., 1.], ez)
+        ex = ex / np.linalg.norm(ex) if np.linalg.norm(ex) > 1e-6 else np.array([1., 0., 0.])
+        ey = np.cross(ez, ex)
+        ch['loc'][:12] = np.r_[p * radius, ex, ey, ez]
+        ch['coord_frame'] = mne.io.constants.FIFF.FIFFV_COORD_DEVICE
+    # Info keys are locked from MNE 1.0
+    with info._unlock() if hasattr(info, '_unlock') else nullcontext():
+        info['dev_head_t'] = mne.transforms.Transform('meg', 'head', np.eye(4))
+    return info
+
+
+def make_project(root, grade=4, subject='subject_bench', project='bench', n_parcels=48):
+    """ Create a synthetic project with BrainVISA, FreeSurfer and MNE databases
+
+    Parameters
+    ----------
+    root : str
+        Folder where the databases are created
+    grade : int
+        Subdivision of the cortical meshes (10 * 4 ** grade + 2 vertices per hemisphere)
+    subject : str
+        Name of the subject
+    project : str
+        Name of the project
+    n_parcels : int
+        Number of MarsAtlas-like parcels per hemisphere
+
+    Returns
+    -------
+    fixture : dict
+        Filenames and names of the project, with keys json_fname, subject,
+        fname_surf (lh, rh), fname_tex (lh, rh), fname_trans_ref, fname_trans_out,
+        fname_trans and n_vertices
+    """
+    import mne
+    from nibabel.freesurfer import write_geometry
+    from bv2mne.config.config import setup_db_info
+    from bv2mne.directories import get_layout
+
+    db_bv = op.join(root, 'db_brainvisa')
+    db_fs = op.join(root, 'db_freesurfer')
+    for d in [db_bv, db_fs, op.join(root, 'db_mne')]:
+        if not op.exists(op.join(d, project)):
+            os.makedirs(op.join(d, project))
+
+    json_fname = setup_db_info(root, project, json_path=op.join(root, 'db_mne', project), overwrite=True)
+    layout = get_layout(json_fname)
+    for folder in ['bem', 'fwd', 'mri', 'prep', 'ref', 'src', 'trans']:
+        if not op.exists(op.join(layout.subject_dir(subject), folder)):
+            os.makedirs(op.join(layout.subject_dir(subject), folder))
+
+    # BrainVISA white meshes (mm) and template MarsAtlas textures
+    mesh_dir = op.join(layout.bv_mesh_dir(subject), 'surface_analysis')
+    tex_dir = op.join(db_bv, 'hiphop138-multiscale', 'Decimated', '4K')
+    for d in [mesh_dir, tex_dir]:
+        if not op.exists(d):
+            os.makedirs(d)
+
+    rr, tris = icosphere(grade)
+    fname_surf, fname_tex = [], []
+    for h, side, offset in [('L', -1., 0), ('R', 1., 100)]:
+        coords = (rr * [30., 60., 45.] + [side * 35., -10., 15.]).astype(np.float32)
+        fname_surf.append(op.join(mesh_dir, '{0}_{1}white_remeshed_hiphop.gii'.format(subject, h)))
+        _write_gifti(fname_surf[-1], [coords, tris.astype(np.int32)], ['NIFTI_INTENT_POINTSET', 'NIFTI_INTENT_TRIANGLE'])
+        fname_tex.append(op.join(tex_dir, 'hiphop138_{0}white_dec_4K_parcels_marsAtlas.gii'.format(h)))
+        _write_gifti(fname_tex[-1], [parcels_texture(rr, n_parcels, offset)], ['NIFTI_INTENT_LABEL'])
+
+    # Referential: chain of three BrainVISA transformations
+    ref_dir = op.join(layout.db_mne, project, 'referential')
+    if not op.exists(ref_dir):
+        os.makedirs(ref_dir)
+    fname_trm = []
+    for n, translation in enumerate([[1., 2., 3.], [-1., 0.5, 0.], [0., -2.5, -3.]]):
+        fname_trm.append(op.join(ref_dir, '{0}-{1}.trm'.format('{0}', n)))
+        _write_trm(fname_trm[-1].format(subject), np.eye(3), translation)
+    fname_trans_ref = layout.referential()
+    with open(fname_trans_ref, 'w') as f:
+        f.write('\n'.join(fname_trm) + '\n')
+
+    # FreeSurfer single-shell BEM surface (inner skull sphere, mm)
+    fs_bem = op.join(layout.fs_subjects_dir(), subject, 'bem')
+    if not op.exists(fs_bem):
+        os.makedirs(fs_bem)
+    bem_rr, bem_tris = icosphere(4)
+    write_geometry(op.join(fs_bem, 'inner_skull.surf'), bem_rr * 85., bem_tris)
+
+    # Segmentation and head<->MRI transformation
+    _write_aseg(layout.aseg(subject))
+    mne.write_trans(layout.trans(subject), mne.transforms.Transform('head', 'mri', np.eye(4)))
+
+    return dict(json_fname=json_fname, layout=layout, subject=subject, fname_surf=fname_surf, fname_tex=fname_tex,
+                fname_trans_ref=fname_trans_ref, fname_trans_out=layout.trans_trm(subject),
+                fname_trans=layout.trans(subject), n_vertices=len(rr))
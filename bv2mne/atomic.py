@@ -0,0 +1,123 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+import json
+import shutil
+import uuid
+from contextlib import contextmanager
+
+# Prefix of the temporary files, hidden and never matched by the file name patterns of the stages
+tmp_prefix = '.tmp-'
+
+
+def marker_fname(fname):
+    """ Completion marker of a file """
+    return fname + '.ok'
+
+
+def _fsync_file(fname):
+    with open(fname, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(dirname):
+    """ Make a rename durable, not possible on Windows """
+    if os.name == 'nt':
+        return
+    fd = os.open(dirname or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_marker(fname):
+    """ Write the completion marker of a file, with its size and modification time
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the complete artifact
+    """
+    st = os.stat(fname)
+    fname_marker = marker_fname(fname)
+    fname_tmp = op.join(op.dirname(fname_marker), '{0}{1}-{2}'.format(tmp_prefix, uuid.uuid4().hex[:8],
+                                                                      op.basename(fname_marker)))
+    with open(fname_tmp, 'w') as f:
+        json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fname_tmp, fname_marker)
+
+
+def is_complete(fname):
+    """ Whether a file exists and was completely written
+
+    The file must have a completion marker matching its current size and
+    modification time, files written before markers existed are not complete.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the artifact
+
+    Returns
+    -------
+    True/False : bool
+    """
+    try:
+        st = os.stat(fname)
+        with open(marker_fname(fname), 'r') as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return marker.get('size') == st.st_size and marker.get('mtime_ns') == st.st_mtime_ns
+
+
+@contextmanager
+def atomic_write(fname, marker=True):
+    """ Write a file through a temporary file renamed into place once complete
+
+    The temporary file is in the same folder and ends with the name of the file,
+    so that writers checking file name endings (MNE) accept it. It is fsynced,
+    renamed over fname and the completion marker is written. If the writing
+    fails, the temporary file is removed and fname and its marker are left untouched.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the artifact
+    marker : bool
+        If True, write the completion marker of the file
+
+    Yields
+    ------
+    fname_tmp : str
+        The temporary filename to write to
+    """
+    dirname, basename = op.split(fname)
+    fname_tmp = op.join(dirname, '{0}{1}-{2}'.format(tmp_prefix, uuid.uuid4().hex[:8], basename))
+
+    try:
+        yield fname_tmp
+        _fsync_file(fname_tmp)
+        # Marker of the previous version, if any, is no longer valid
+        if op.lexists(marker_fname(fname)):
+            os.remove(marker_fname(fname))
+        os.replace(fname_tmp, fname)
+        _fsync_dir(dirname)
+    except BaseException:
+        if op.lexists(fname_tmp):
+            os.remove(fname_tmp)
+        raise
+
+    if marker:
+        write_marker(fname)
+
+
+def atomic_copy(src, dst, marker=True):
+    """ Copy a file with atomic_write, keeping its modification time """
+    with atomic_write(dst, marker=marker) as fname_tmp:
+        shutil.copy2(src, fname_tmp)
@@ -1,19 +1,39 @@
 # Authors: David Meunier <david.meunier@univ-amu.fr>
 #          Ruggero Basanisi <ruggero.basanisi@gmail.com>
 
-import mne
-
 import os.path as op
 
-from bv2mne.directories import read_directories, read_databases
+from bv2mne.directories import get_layout
+from bv2mne.manifest import manifest_fname, is_up_to_date, write_manifest
+from bv2mne.instrument import track_stage
+from bv2mne.atomic import atomic_write, is_complete
+
+# Conductivity of the single-shell BEM model
+conductivity = [0.3]
+
+def _bem_files(json_fname, subject):
+    """ Inputs, outputs and manifest of the BEM stage """
+    layout = get_layout(json_fname)
+
+    # Single-shell model: only the inner skull surface is used
+    inputs = [op.join(layout.fs_subjects_dir(), subject, 'bem', 'inner_skull.surf')]
+    outputs = [layout.bem_model(subject), layout.bem_sol(subject)]
+    fname_manifest = manifest_fname(layout.bem_dir.format(subject), 'bem')
+
+    return inputs, outputs, fname_manifest
 
-def create_bem(json_fname, subject):
+def create_bem(json_fname, subject, force=False):
     """ Create the BEM model from FreeSurfer files
 
     Parameters:
     ----------
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
     subject : str
         Name of the subject to calculate the BEM model
+    force : bool
+        If False, the BEM files are read instead of being computed again when
+        the FreeSurfer surfaces did not change since they were created
 
     Returns:
     -------
@@ -23,29 +43,39 @@ def create_bem(json_fname, subject):
         BEM model
     -------
     """
+    import mne
 
-    print('\n---------- Resolving BEM model and BEM soultion ----------\n')
-
+    layout = get_layout(json_fname)
 
-    database, project, db_mne, db_bv, db_fs = read_databases(json_fname)
+    inputs, outputs, fname_manifest = _bem_files(json_fname, subject)
+    fname_bem_model, fname_bem_sol = outputs
+    params = {'conductivity': conductivity}
 
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
+    if not force and is_up_to_date(fname_manifest, inputs, outputs, params=params, markers=True):
+        print('\n---------- BEM model and BEM solution up to date ----------\n')
+        return mne.read_bem_surfaces(fname_bem_model), mne.read_bem_solution(fname_bem_sol)
 
-    fname_bem_model = op.join(bem_dir.format(subject), '{0}-bem-model.fif'.format(subject))
-    fname_bem_sol = op.join(bem_dir.format(subject), '{0}-bem-sol.fif'.format(subject))
+    print('\n---------- Resolving BEM model and BEM soultion ----------\n')
 
     # Make bem model: single-shell model. Depends on anatomy only.
-    bem_model = mne.make_bem_model(subject, ico=None, conductivity=[0.3], subjects_dir=op.join(db_fs, project))
-    mne.write_bem_surfaces(fname_bem_model, bem_model)
+    with track_stage('bem_model', subject=subject, inputs=inputs, outputs=[fname_bem_model]):
+        bem_model = mne.make_bem_model(subject, ico=None, conductivity=params['conductivity'],
+                                       subjects_dir=layout.fs_subjects_dir())
+        with atomic_write(fname_bem_model) as fname_tmp:
+            mne.write_bem_surfaces(fname_tmp, bem_model)
 
     # Make bem solution. Depends on anatomy only.
-    bem_sol = mne.make_bem_solution(bem_model)
-    mne.write_bem_solution(fname_bem_sol, bem_sol)
+    with track_stage('bem_solution', subject=subject, inputs=[fname_bem_model], outputs=[fname_bem_sol]):
+        bem_sol = mne.make_bem_solution(bem_model)
+        with atomic_write(fname_bem_sol) as fname_tmp:
+            mne.write_bem_solution(fname_tmp, bem_sol)
+
+    write_manifest(fname_manifest, 'bem', inputs, outputs, params=params)
 
     return bem_model, bem_sol
 
 def check_bem(json_fname, subject):
-    """ Check if the BEM model exists
+    """ Check if the BEM model exists and is up to date
 
     Parameters
     ----------
@@ -55,19 +85,24 @@ def check_bem(json_fname, subject):
     Returns:
     -------
     True/False : bool
-        True if the BEM model exists for the subject, otherwise False
+        True if the BEM files of the subject were completely written and, when
+        their manifest exists, if the FreeSurfer surfaces did not change since,
+        otherwise False
     -------
     """
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
 
-    # Check if BEM files exists, return boolean value
+    # Check if BEM files exists and are complete, return boolean value
     print('\nChecking BEM files\n')
-    fname_bem_model = op.join(bem_dir.format(subject), '{0}-bem-model.fif'.format(subject))
-    fname_bem_sol = op.join(bem_dir.format(subject), '{0}-bem-sol.fif'.format(subject))
-
-    if op.isfile(fname_bem_model) and op.isfile(fname_bem_sol):
+    inputs, outputs, fname_manifest = _bem_files(json_fname, subject)
+    fname_bem_model, fname_bem_sol = outputs
+
+    # Truncated files of an interrupted job have no completion marker
+    if not (is_complete(fname_bem_model) and is_complete(fname_bem_sol)):
+        return False
+    # BEM created before manifests were recorded
+    if not op.isfile(fname_manifest):
         return True
-    else: return False
+    return is_up_to_date(fname_manifest, inputs, outputs, params={'conductivity': conductivity}, markers=True)
 
 if __name__ == '__main__':
     create_bem('subject_03')
@@ -0,0 +1,130 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+import hashlib
+
+import numpy as np
+
+from bv2mne.atomic import atomic_write
+
+# Parsed textures of this process, keyed by file
+_texture_cache = {}
+
+
+def hash_file(fname, algorithm='sha1', chunk_size=2 ** 20):
+    """ Compute the digest of the content of a file
+
+    Parameters
+    ----------
+    fname : str
+        The filename
+    algorithm : str
+        Name of the hashlib algorithm
+    chunk_size : int
+        Number of bytes read at once
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal digest of the file content
+    """
+    h = hashlib.new(algorithm)
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def update_hash(h, obj):
+    """ Update a hashlib object with a (nested) python or numpy object
+
+    Arrays are hashed with their dtype and shape, so that two arrays with
+    the same bytes but different layouts give different digests.
+    """
+    if obj is None:
+        h.update(b'None')
+    elif isinstance(obj, np.ndarray):
+        h.update('{0}{1}'.format(obj.dtype.str, obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update('{0}{1}'.format(type(obj).__name__, len(obj)).encode())
+        for o in obj:
+            update_hash(h, o)
+    elif isinstance(obj, dict):
+        h.update('dict{0}'.format(len(obj)).encode())
+        for key in sorted(obj):
+            update_hash(h, key)
+            update_hash(h, obj[key])
+    else:
+        h.update(repr(obj).encode())
+    return h
+
+
+def hash_object(obj, algorithm='sha1'):
+    """ Compute the digest of a (nested) python or numpy object """
+    return update_hash(hashlib.new(algorithm), obj).hexdigest()
+
+
+def file_stamp(fname):
+    """ Size and modification time of a file, used to invalidate caches """
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_texture(fname, cache_dir=None):
+    """ Read the values of a GIfTI texture, parsed once per process
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the texture (e.g. MarsAtlas parcels)
+    cache_dir : str | None
+        If not None, the values are also stored in this folder as a .npy
+        sidecar, which is memory-mapped by the next processes instead of
+        parsing the GIfTI file again
+
+    Returns
+    -------
+    values : array
+        Read-only values of the first data array of the texture
+    """
+    key = op.abspath(fname)
+    stamp = file_stamp(fname)
+
+    cached = _texture_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    values = None
+    if cache_dir is not None:
+        # The sidecar name changes with the texture file, so stale sidecars are never read
+        fname_npy = op.join(cache_dir, '{0}-{1}-{2}.npy'.format(op.basename(fname), *stamp))
+        if op.isfile(fname_npy):
+            values = np.load(fname_npy, mmap_mode='r')
+
+    if values is None:
+        import nibabel as nib
+        values = nib.load(fname).darrays[0].data
+        values.setflags(write=False)
+
+        if cache_dir is not None:
+            try:
+                if not op.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                with atomic_write(fname_npy, marker=False) as fname_tmp:
+                    np.save(fname_tmp, values)
+            except OSError:
+                print('Texture sidecar could not be written in {0}'.format(cache_dir))
+
+    _texture_cache[key] = (stamp, values)
+    return values
+
+
+def clear_texture_cache(fname=None):
+    """ Forget the parsed textures, all of them or only the one of fname """
+    if fname is None:
+        _texture_cache.clear()
+    else:
+        _texture_cache.pop(op.abspath(fname), None)
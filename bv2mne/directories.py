@@ -1,140 +1,350 @@
 import os
 import os.path as op
 import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from bv2mne.config.config import read_db_info
+from bv2mne.atomic import tmp_prefix
 
-# Defining database coordinates
-def read_databases(json_fname='default'):
+# Layouts already resolved in this process, keyed by json file
+_layouts = {}
+
+
+class ProjectLayout(object):
+    """ Immutable paths of the databases and artifacts of a project
+
+    Built once per json file by get_layout, and passed through the stages
+    in place of the json filename.
+
+    Parameters
+    ----------
+    json_fname : str
+        The path of the json file with the database coordinates
+    """
+
+    __slots__ = ('json_fname', 'database', 'project', 'db_mne', 'db_bv', 'db_fs', 'db_beh',
+                 'raw_dir', 'prep_dir', 'trans_dir', 'mri_dir', 'src_dir', 'bem_dir', 'fwd_dir',
+                 'hga_dir', 'fc_dir', 'gc_dir')
+
+    def __init__(self, json_fname):
+        database, project = read_db_info(json_fname)
+
+        # Information on databases
+        db_mne = op.join(database, 'db_mne')
+        paths = dict(json_fname=json_fname, database=database, project=project, db_mne=db_mne,
+                     db_bv=op.join(database, 'db_brainvisa'),
+                     db_fs=op.join(database, 'db_freesurfer'),
+                     db_beh=op.join(database, 'db_behaviour'))
+
+        # mne database subdirectories
+        paths.update(raw_dir=op.join(db_mne, project, '{0}', 'raw', '{1}'),
+                     prep_dir=op.join(db_mne, project, '{0}', 'prep', '{1}'),
+                     trans_dir=op.join(db_mne, project, '{0}', 'trans'),
+                     mri_dir=op.join(db_mne, project, '{0}', 'mri'),
+                     src_dir=op.join(db_mne, project, '{0}', 'src'),
+                     bem_dir=op.join(db_mne, project, '{0}', 'bem'),
+                     fwd_dir=op.join(db_mne, project, '{0}', 'fwd', '{1}'),
+                     hga_dir=op.join(db_mne, project, '{0}', 'hga', '{1}'),
+                     fc_dir=op.join(db_mne, project, '{0}', 'fc', '{1}'),
+                     gc_dir=op.join(db_mne, project, '{0}', 'gc', '{1}'))
+
+        for key, val in paths.items():
+            object.__setattr__(self, key, val)
+
+    def __setattr__(self, key, val):
+        raise AttributeError('ProjectLayout is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('ProjectLayout is immutable')
+
+    def __reduce__(self):
+        # Resolved again (once) in the process it is sent to
+        return get_layout, (self.json_fname,)
+
+    def __repr__(self):
+        return 'ProjectLayout({0}, project={1})'.format(self.database, self.project)
+
+    # Databases
+    def fs_subjects_dir(self):
+        """ FreeSurfer subjects directory of the project """
+        return op.join(self.db_fs, self.project)
+
+    def mne_subjects_dir(self):
+        """ MNE subjects directory of the project """
+        return op.join(self.db_mne, self.project)
+
+    def subject_dir(self, subject):
+        """ MNE directory of a subject """
+        return op.join(self.db_mne, self.project, subject)
+
+    def bv_mesh_dir(self, subject):
+        """ BrainVISA mesh directory of a subject """
+        return op.join(self.db_bv, self.project, subject, 't1mri', 'default_acquisition', 'default_analysis',
+                       'segmentation', 'mesh')
+
+    # Anatomy
+    def aseg(self, subject):
+        """ FreeSurfer segmentation in the MNE database """
+        return op.join(self.mri_dir.format(subject), 'aseg.mgz')
+
+    def atlas(self):
+        """ MarsAtlas labelling xls file """
+        return op.join(self.db_mne, self.project, 'marsatlas', 'MarsAtlas_BV_2015.xls')
+
+    def referential(self):
+        """ List of the transformation files from BrainVISA to FreeSurfer """
+        return op.join(self.db_mne, self.project, 'referential', 'referential.txt')
+
+    def trans_trm(self, subject):
+        """ Transformation from BrainVISA to FreeSurfer of a subject """
+        return op.join(self.db_mne, self.project, subject, 'ref', '{0}-trans.trm'.format(subject))
+
+    def trans(self, subject):
+        """ Transformation from head to MRI coordinates (meg2mri) """
+        return op.join(self.trans_dir.format(subject), '{0}-trans.fif'.format(subject))
+
+    # Artifacts
+    def bem_model(self, subject):
+        """ BEM surfaces of a subject """
+        return op.join(self.bem_dir.format(subject), '{0}-bem-model.fif'.format(subject))
+
+    def bem_sol(self, subject):
+        """ BEM solution of a subject """
+        return op.join(self.bem_dir.format(subject), '{0}-bem-sol.fif'.format(subject))
+
+    def src(self, subject, kind):
+        """ Source space of a subject, kind is 'surf' or 'vol' """
+        return op.join(self.src_dir.format(subject), '{0}_{1}-src.fif'.format(subject, kind))
+
+    def label(self, subject, kind, hemi):
+        """ Labels of the sources of a subject, kind is 'surf' or 'vol' """
+        return op.join(self.src_dir.format(subject), '{0}_{1}-lab-{2}.label'.format(subject, kind, hemi))
+
+    def parcels(self, subject, kind):
+        """ Parcel index of the sources of a subject (.npy, table in .json), kind is 'surf' or 'vol' """
+        return op.join(self.src_dir.format(subject), '{0}_{1}-parc.npy'.format(subject, kind))
+
+    def epochs(self, subject, session, event=''):
+        """ Epoched MEG data of a session """
+        fname = op.join(self.prep_dir.format(subject, session), '{0}_{1}-epo.fif'.format(subject, event))
+        return fname if event else fname.replace('_-', '-')
+
+    def sensor_info(self, subject, session, event=''):
+        """ Measurement info of the epoched MEG data of a session """
+        fname = op.join(self.fwd_dir.format(subject, session), '{0}_{1}-info.fif'.format(subject, event))
+        return fname if event else fname.replace('_-', '-')
+
+    def fwd(self, subject, session, name, compress=False):
+        """ Forward model of a session, name is 'surf' or 'vol', gzipped if compress """
+        ext = '.fif.gz' if compress else '.fif'
+        return op.join(self.fwd_dir.format(subject, session), '{0}-{1}-fwd{2}'.format(subject, name, ext))
+
+    def fwd_cache_dir(self, subject):
+        """ Forward models of a subject cached across sessions """
+        return op.join(self.db_mne, self.project, subject, 'fwd', 'cache')
+
+    def queue_dir(self):
+        """ Lock files and completion markers of the work queue of the project """
+        return op.join(self.db_mne, self.project, 'queue')
+
+
+def get_layout(json_fname='default'):
+    """ Get the layout of a project, resolved once per json file
+
+    Parameters
+    ----------
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates, or an
+        already resolved layout which is returned as is
+
+    Returns
+    -------
+    layout : ProjectLayout
+        The paths of the project
+    """
+    if isinstance(json_fname, ProjectLayout):
+        return json_fname
 
     if json_fname == 'default':
         read_dir = op.join(op.abspath(__package__), 'config')
         json_fname = op.join(read_dir, 'db_info.json')
 
-    database, project = read_db_info(json_fname)
+    # Resolved again only if the json file changed
+    key = op.abspath(json_fname)
+    stamp = os.stat(json_fname).st_mtime_ns if op.exists(json_fname) else None
+    cached = _layouts.get(key)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, ProjectLayout(json_fname))
+        _layouts[key] = cached
+
+    return cached[1]
+
 
-    # Information on databases
-    db_mne = op.join(database, 'db_mne')
-    db_bv = op.join(database, 'db_brainvisa')
-    db_fs = op.join(database, 'db_freesurfer')
-    db_beh = op.join(database, 'db_behaviour')
+# Defining database coordinates
+def read_databases(json_fname='default'):
 
-    return database, project, db_mne, db_bv, db_fs, db_beh
+    layout = get_layout(json_fname)
+
+    return layout.database, layout.project, layout.db_mne, layout.db_bv, layout.db_fs, layout.db_beh
 
 def read_directories(json_fname='default'):
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_info.json')
+    layout = get_layout(json_fname)
 
-    database, project, db_mne, db_bv, db_fs, db_beh = read_databases(json_fname)
+    return (layout.raw_dir, layout.prep_dir, layout.trans_dir, layout.mri_dir, layout.src_dir, layout.bem_dir,
+            layout.fwd_dir, layout.hga_dir, layout.fc_dir, layout.gc_dir)
 
-    # mne database subdirectories
-    raw_dir = op.join(db_mne, project, '{0}', 'raw', '{1}')
-    prep_dir = op.join(db_mne, project, '{0}', 'prep', '{1}')
-    trans_dir = op.join(db_mne, project, '{0}', 'trans')
-    mri_dir = op.join(db_mne, project, '{0}', 'mri')
-    src_dir = op.join(db_mne, project, '{0}', 'src')
-    bem_dir = op.join(db_mne, project, '{0}', 'bem')
-    fwd_dir = op.join(db_mne, project, '{0}', 'fwd', '{1}')
-    hga_dir = op.join(db_mne, project, '{0}', 'hga', '{1}')
-    fc_dir = op.join(db_mne, project, '{0}', 'fc', '{1}')
-    gc_dir = op.join(db_mne, project, '{0}', 'gc', '{1}')
+def create_sbj_db_mne(subject, json_fname='default', mode='copy', n_jobs=1):
+    """ Create the MNE database of a subject from FreeSurfer and BrainVISA databases
 
-    return raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir, fc_dir, gc_dir
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    mode : 'copy' | 'hardlink' | 'symlink' | 'reflink'
+        How anatomical files are added to the MNE database. Hardlinks and
+        reflinks (copy-on-write clones) fall back to a copy when the file
+        system does not support them. Files already present and unchanged
+        are skipped whatever the mode
+    n_jobs : int
+        Number of files ingested concurrently, as in MNE -1 uses all the CPUs
 
-def create_sbj_db_mne(subject, json_fname='default'):
+    Returns
+    -------
+    ingested : list of str
+        Files of the MNE database that were (re)created
+    """
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_info.json')
+    from bv2mne.pipeline import _check_n_jobs
+    n_jobs = _check_n_jobs(n_jobs)
+
+    layout = get_layout(json_fname)
+    db_mne, db_fs, project = layout.db_mne, layout.db_fs, layout.project
 
     print(subject)
-    database, project, db_mne, db_bv, db_fs = read_databases(json_fname)
 
-    # Create MNE database
-    if not op.exists(db_mne):
-        os.mkdir(db_mne)
+    # Create MNE database, project specific database in MNE, folders for labels and referentials
+    for folder in ['label', 'marsatlas', 'referential']:
+        if not op.exists(op.join(db_mne, project, folder)):
+            os.makedirs(op.join(db_mne, project, folder))
 
-    # Create project specific database in MNE
-    if not op.exists(op.join(db_mne, project)):
-        os.mkdir(op.join(db_mne, project))
+    # Create subject folder and sub-folders tree
+    for folder in ['bem', 'fwd', 'hga', 'mri', 'prep', 'raw', 'ref', 'src', 'surf', 'tex', 'trans', 'vol']:
+        if not op.exists(op.join(layout.subject_dir(subject), folder)):
+            os.makedirs(op.join(layout.subject_dir(subject), folder))
 
-    # Create folders for labels and referentials
-    if not op.exists(op.join(db_mne, project, 'label')):
-        os.mkdir(op.join(db_mne, project, 'label'))
-    if not op.exists(op.join(db_mne, project, 'marsatlas')):
-        os.mkdir(op.join(db_mne, project, 'marsatlas'))
-    if not op.exists(op.join(db_mne, project, 'referential')):
-        os.mkdir(op.join(db_mne, project, 'referential'))
+    bv_mesh = layout.bv_mesh_dir(subject)
+    sbj_mne = layout.subject_dir(subject)
 
-    # Create subject folder and sub-folders tree
-    if not op.exists(op.join(db_mne, project, subject)):
-        os.mkdir(op.join(db_mne, project, subject))
-
-    if not op.exists(op.join(db_mne, project, subject, 'bem')):
-        os.mkdir(op.join(db_mne, project, subject, 'bem'))
-    if not op.exists(op.join(db_mne, project, subject, 'fwd')):
-        os.mkdir(op.join(db_mne, project, subject, 'fwd'))
-    if not op.exists(op.join(db_mne, project, subject, 'hga')):
-        os.mkdir(op.join(db_mne, project, subject, 'hga'))
-    if not op.exists(op.join(db_mne, project, subject, 'mri')):
-        os.mkdir(op.join(db_mne, project, subject, 'mri'))
-    if not op.exists(op.join(db_mne, project, subject, 'prep')):
-        os.mkdir(op.join(db_mne, project, subject, 'prep'))
-    if not op.exists(op.join(db_mne, project, subject, 'raw')):
-        os.mkdir(op.join(db_mne, project, subject, 'raw'))
-    if not op.exists(op.join(db_mne, project, subject, 'ref')):
-        os.mkdir(op.join(db_mne, project, subject, 'ref'))
-    if not op.exists(op.join(db_mne, project, subject, 'src')):
-        os.mkdir(op.join(db_mne, project, subject, 'src'))
-    if not op.exists(op.join(db_mne, project, subject, 'surf')):
-        os.mkdir(op.join(db_mne, project, subject, 'surf'))
-    if not op.exists(op.join(db_mne, project, subject, 'tex')):
-        os.mkdir(op.join(db_mne, project, subject, 'tex'))
-    if not op.exists(op.join(db_mne, project, subject, 'trans')):
-        os.mkdir(op.join(db_mne, project, subject, 'trans'))
-    if not op.exists(op.join(db_mne, project, subject, 'vol')):
-        os.mkdir(op.join(db_mne, project, subject, 'vol'))
-
-    # Copy FreeSurfer MRI
-    shutil.copy2(op.join(db_fs, project, subject, 'mri', 'T1.mgz'),
-                 op.join(db_mne, project, subject, 'mri', 'T1.mgz'))
-    shutil.copy2(op.join(db_fs, project, subject, 'mri', 'aseg.mgz'),
-                 op.join(db_mne, project, subject, 'mri', 'aseg.mgz'))
-
-    # Copy FreeSurfer BEM
+    files = []
+
+    # FreeSurfer MRI
+    for f in ['T1.mgz', 'aseg.mgz']:
+        files.append((op.join(db_fs, project, subject, 'mri', f), op.join(sbj_mne, 'mri', f)))
+
+    # FreeSurfer BEM
     bem_files = os.listdir(op.join(db_fs, project, subject, 'bem'))
     for bf in bem_files:
-        shutil.copy2(op.join(db_fs, project, subject, 'bem', bf),
-                     op.join(db_mne, project, subject, 'bem'))
-
-    # Copy BrainVISA cortical meshes
-    shutil.copy2(op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                         'mesh', '{0}_Lwhite.gii'.format(subject)),
-                 op.join(db_mne, project, subject, 'surf'))
-    shutil.copy2(op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                         'mesh', '{0}_Rwhite.gii'.format(subject)),
-                 op.join(db_mne, project, subject, 'surf'))
-
-    # Copy FreeSurfer cortical meshes
-    shutil.copy2(op.join(db_fs, project, subject, 'surf', 'lh.white'),
-                 op.join(db_mne, project, subject, 'surf', 'lh.white'))
-    shutil.copy2(op.join(db_fs, project, subject, 'surf', 'rh.white'),
-                 op.join(db_mne, project, subject, 'surf', 'rh.white'))
-    shutil.copy2(op.join(db_fs, project, subject, 'surf', 'lh.white.gii'),
-                 op.join(db_mne, project, subject, 'surf', 'lh.white.gii'))
-    shutil.copy2(op.join(db_fs, project, subject, 'surf', 'rh.white.gii'),
-                 op.join(db_mne, project, subject, 'surf', 'rh.white.gii'))
-
-    # Copy BrainVISA textures
-    shutil.copy2(op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                         'mesh', 'surface_analysis', '{0}_Lwhite_parcels_marsAtlas.gii'.format(subject)),
-                 op.join(db_mne, project, subject, 'tex'))
-    shutil.copy2(op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                         'mesh', 'surface_analysis', '{0}_Rwhite_parcels_marsAtlas.gii'.format(subject)),
-                 op.join(db_mne, project, subject, 'tex'))
-
-    # Copy BrainVISA complete parcellation volume
-    shutil.copy2(op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                         'mesh', 'surface_analysis', '{0}_parcellation.nii.gz'.format(subject)),
-                 op.join(db_mne, project, subject, 'vol'))
+        files.append((op.join(db_fs, project, subject, 'bem', bf), op.join(sbj_mne, 'bem', bf)))
+
+    # BrainVISA cortical meshes
+    for f in ['{0}_Lwhite.gii', '{0}_Rwhite.gii']:
+        files.append((op.join(bv_mesh, f.format(subject)), op.join(sbj_mne, 'surf', f.format(subject))))
+
+    # FreeSurfer cortical meshes
+    for f in ['lh.white', 'rh.white', 'lh.white.gii', 'rh.white.gii']:
+        files.append((op.join(db_fs, project, subject, 'surf', f), op.join(sbj_mne, 'surf', f)))
+
+    # BrainVISA textures
+    for f in ['{0}_Lwhite_parcels_marsAtlas.gii', '{0}_Rwhite_parcels_marsAtlas.gii']:
+        files.append((op.join(bv_mesh, 'surface_analysis', f.format(subject)), op.join(sbj_mne, 'tex', f.format(subject))))
+
+    # BrainVISA complete parcellation volume
+    f = '{0}_parcellation.nii.gz'.format(subject)
+    files.append((op.join(bv_mesh, 'surface_analysis', f), op.join(sbj_mne, 'vol', f)))
+
+    if n_jobs == 1:
+        done = [ingest_file(src, dst, mode=mode) for src, dst in files]
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            done = list(executor.map(lambda sd: ingest_file(sd[0], sd[1], mode=mode), files))
+
+    ingested = [dst for (src, dst), d in zip(files, done) if d]
+    print('{0} files added, {1} already up to date'.format(len(ingested), len(files) - len(ingested)))
+
+    return ingested
+
+
+def _is_same_file(src, dst):
+    """ Check if dst is a link to src or an unchanged copy of it """
+    if not op.exists(dst):
+        return False
+    if op.samefile(src, dst):
+        return True
+    # Copies keep size and modification time of the original (copy2)
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return src_stat.st_size == dst_stat.st_size and abs(src_stat.st_mtime - dst_stat.st_mtime) < 1.
+
+
+def _reflink(src, dst):
+    """ Copy-on-write clone of a file (Linux, on btrfs, xfs, ...) """
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def ingest_file(src, dst, mode='copy'):
+    """ Add a file to the MNE database
+
+    Parameters
+    ----------
+    src : str
+        The original file
+    dst : str
+        The file in the MNE database
+    mode : 'copy' | 'hardlink' | 'symlink' | 'reflink'
+        How the file is added, hardlinks and reflinks fall back to a copy
+        if the file system does not support them
+
+    Returns
+    -------
+    True/False : bool
+        False if dst was already present and unchanged, otherwise True
+    """
+
+    if mode not in ['copy', 'hardlink', 'symlink', 'reflink']:
+        raise ValueError('mode should be \'copy\', \'hardlink\', \'symlink\' or \'reflink\'')
+
+    if _is_same_file(src, dst):
+        return False
+
+    # Added next to dst and renamed over it, dst is never missing nor partial
+    fname_tmp = op.join(op.dirname(dst), '{0}{1}-{2}'.format(tmp_prefix, uuid.uuid4().hex[:8], op.basename(dst)))
+    try:
+        if mode == 'hardlink':
+            try:
+                os.link(src, fname_tmp)
+            except OSError:
+                shutil.copy2(src, fname_tmp)
+        elif mode == 'symlink':
+            os.symlink(op.abspath(src), fname_tmp)
+        elif mode == 'reflink':
+            try:
+                _reflink(src, fname_tmp)
+            except (OSError, ImportError):
+                if op.exists(fname_tmp):
+                    os.remove(fname_tmp)
+                shutil.copy2(src, fname_tmp)
+        else:
+            shutil.copy2(src, fname_tmp)
+        os.replace(fname_tmp, dst)
+    except BaseException:
+        if op.lexists(fname_tmp):
+            os.remove(fname_tmp)
+        raise
+
+    return True
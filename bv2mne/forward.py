@@ -1,13 +1,24 @@
 # Authors: David Meunier <david.meunier@univ-amu.fr>
 #          Ruggero Basanisi <ruggero.basanisi@gmail.com>
 
-import mne
 import os
 import os.path as op
-from bv2mne.directories import read_directories
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from bv2mne.directories import get_layout, ingest_file
 from bv2mne.bem import check_bem, create_bem
+from bv2mne.cache import hash_file, hash_object, file_stamp
+from bv2mne.sensors import get_sensor_info
+from bv2mne.manifest import manifest_fname, is_up_to_date, write_manifest
+from bv2mne.instrument import track_stage
+from bv2mne.atomic import atomic_write, write_marker, is_complete, tmp_prefix
 
-def create_forward_models(subject, session=1, event='', src=None, json_fname='default'):
+# Minimum distance (mm) of the sources from the inner skull surface
+fwd_mindist = 0.0
+
+def create_forward_models(subject, session=1, event='', src=None, json_fname='default', force=False,
+                          mem_budget=None, compress=False):
     """ Create the forward model
 
     Parameters:
@@ -20,6 +31,16 @@ def create_forward_models(subject, session=1, event='', src=None, json_fname='de
         Name of the event MEG file
     src : str | None, default None
         Path of the sources file, if None the 'src.fif' file is automatically searched
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    force : bool
+        If True, forward models are computed again even if their inputs did not change
+    mem_budget : float | None
+        Approximate memory (MB) for the gain matrices computed at once, if None each
+        forward model is computed in one call. It bounds the computation only, not the
+        writing of the forward models (see forward_model)
+    compress : bool
+        If True, forward models are stored gzipped (see forward_model)
 
     Returns:
     -------
@@ -27,66 +48,173 @@ def create_forward_models(subject, session=1, event='', src=None, json_fname='de
             List of forward models
     -------
     """
+    import mne
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_info.json')
-
-    # database, project, db_mne, db_bv, db_fs = read_databases(json_fname)
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
-
-    # File to align coordinate frames meg2mri computed using mne.analyze
-    # (computed with interactive gui)
-    fname_trans = op.join(trans_dir.format(subject), '{0}-trans.fif'.format(subject))
+    layout = get_layout(json_fname)
 
-    # MEG Epoched data to recover position of channels
-    fname_event = op.join(prep_dir.format(subject, session), '{0}_{1}-epo.fif'.format(subject, event))
-    if event == '' or event == None:
-        fname_event.replace('_-', '-')
+    # BEM solution, source spaces and trans of the subject, loaded once per process
+    engine = get_forward_engine(subject, json_fname=layout)
 
-    # Take info from epochs, and then free some space
-    epochs_event = mne.read_epochs(fname_event)
-    info = epochs_event.info
-    del epochs_event
+    # Sensors positions, read from the header of the MEG epoched data only
+    info = get_sensor_info(subject, session, event, json_fname=layout)
 
     # Find and read source space files
     if src is None:
-        src = [n for n in os.listdir(src_dir.format(subject)) if n.endswith('src.fif')]
-        src = [mne.read_source_spaces(op.join(src_dir.format(subject), n)) for n in src]
-    elif src is str:
-        if op.isfile(src): src = [mne.read_source_spaces(src)]
-    elif src is list:
-        if src[0] == str:
-            src = [mne.read_source_spaces(n) for n in src]
-        if src[0] == mne.source_space.SourceSpaces:
-            pass
-    elif src is mne.source_space.SourceSpaces: src = [src]
+        src = engine.sources()
+    elif isinstance(src, str):
+        src = [mne.read_source_spaces(src)]
+    elif isinstance(src, mne.SourceSpaces):
+        src = [src]
+    elif isinstance(src, list):
+        src = [mne.read_source_spaces(n) if isinstance(n, str) else n for n in src]
     else: raise Exception('\nSource space dtype not recognized, use str, list of str, list of SourceSpaces, '
                           'or None to automatic research\n')
 
     # Calculate forward model for each source space
-    fwds = []
-    for sp in src:
-
-        if sp[0]['type'] == 'surf':
-            print('\n---------- Forward Model for cortical sources ----------\n')
-            f_fixed = True
-            name = 'surf'
-        elif sp[0]['type'] == 'vol':
-            print('\n---------- Forward Model for subcortical sources ----------\n')
-            f_fixed = False
-            name = 'vol'
-        else: raise ValueError('Unknown Source Space type, it should be \'surf\' or \'vol\'')
-
-        fwd = forward_model(subject, session, info, fname_trans, sp, force_fixed=f_fixed, name=name, json_fname=json_fname)
-        fwds.append(fwd)
+    fwds = engine.forward_models(session, info, src=src, force=force, mem_budget=mem_budget, compress=compress)
 
     print('\n---------- Forward Models Completed ----------\n')
 
     return fwds
 
 
-def forward_model(subject, session, info, fname_trans, src, force_fixed=False, name='model', json_fname='default'):
+# Forward engines of this process, per project and subject, the least recently used
+# are released beyond max_engines (BEM and source spaces of a subject are large)
+_engines = OrderedDict()
+max_engines = 1
+
+
+def get_forward_engine(subject, json_fname='default'):
+    """ Forward engine of a subject, created once per process and again only when the
+    BEM solution, the trans or the source space files change. Only the engines of the
+    last max_engines subjects are kept
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+
+    Returns
+    -------
+    engine : instance of ForwardEngine
+        The forward engine of the subject
+    """
+    layout = get_layout(json_fname)
+    key = (layout.json_fname, subject)
+
+    engine = _engines.get(key)
+    if engine is not None and engine.stamps == engine.current_stamps():
+        _engines.move_to_end(key)
+        return engine
+
+    # Released before loading the new one
+    _engines.pop(key, None)
+    while len(_engines) >= max(max_engines, 1):
+        _engines.popitem(last=False)
+
+    engine = ForwardEngine(subject, json_fname=layout)
+    _engines[key] = engine
+    return engine
+
+
+class ForwardEngine(object):
+    """ BEM solution, source spaces and trans of a subject, loaded once to compute the
+    forward models of any number of sessions and events
+
+    Only the files are shared: the preparation of the sensors and BEM geometry is
+    done again by mne.make_forward_solution for each forward model.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    """
+
+    def __init__(self, subject, json_fname='default'):
+        import mne
+        self.subject = subject
+        self.layout = get_layout(json_fname)
+
+        # Making BEM model and BEM solution if it was not done before
+        if not check_bem(self.layout, subject):
+            create_bem(self.layout, subject)
+
+        self.fname_bem_sol = self.layout.bem_sol(subject)
+        self.fname_trans = self.layout.trans(subject)
+        self.fname_src = self._src_files()
+        self.fname_src_ignored = sorted(set(self._src_files(complete=False)) - set(self.fname_src))
+        if self.fname_src_ignored:
+            print('Warning: source spaces without valid completion marker are ignored, run create_source_models '
+                  'again: {0}'.format(self.fname_src_ignored))
+
+        print('\nLoading BEM solution, trans and source spaces of {0}\n'.format(subject))
+        self.stamps = self.current_stamps()
+        self.bem = mne.read_bem_solution(self.fname_bem_sol)
+        self.trans = mne.read_trans(self.fname_trans)
+        self.src = [mne.read_source_spaces(f) for f in self.fname_src]
+
+    def __repr__(self):
+        return '<ForwardEngine | {0}, {1} source spaces>'.format(self.subject, len(self.src))
+
+    def _src_files(self, complete=True):
+        """ Source space files of the subject, only those completely written if complete is True """
+        src_dir = self.layout.src_dir.format(self.subject)
+        if not op.isdir(src_dir):
+            return []
+        # Source spaces being written or left truncated by a killed job are not listed
+        return [op.join(src_dir, n) for n in sorted(os.listdir(src_dir))
+                if n.endswith('src.fif') and not n.startswith(tmp_prefix) and
+                (not complete or is_complete(op.join(src_dir, n)))]
+
+    def sources(self):
+        """ Source spaces of the subject, an error is raised if there is no completely written one """
+        if not self.src:
+            if self.fname_src_ignored:
+                raise ValueError('Source spaces of {0} have no valid completion marker, they were written by an '
+                                 'interrupted job or before markers existed, run create_source_models again: '
+                                 '{1}'.format(self.subject, self.fname_src_ignored))
+            raise ValueError('No source space of {0} in {1}, run create_source_models first'.format(
+                self.subject, self.layout.src_dir.format(self.subject)))
+        return self.src
+
+    def current_stamps(self):
+        """ Stamps of the files the engine is loaded from """
+        files = [self.fname_bem_sol, self.fname_trans] + self._src_files()
+        return [(f, file_stamp(f)) if op.isfile(f) else (f, None) for f in files]
+
+    def forward(self, session, info, src, force_fixed=False, name='model', **kwargs):
+        """ Forward model of a session for one source space, see forward_model for the options """
+        return forward_model(self.subject, session, info, self.trans, src, force_fixed=force_fixed, name=name,
+                             json_fname=self.layout, bem=self.bem, **kwargs)
+
+    def forward_models(self, session, info, src=None, **kwargs):
+        """ Forward models of a session for the source spaces of the subject (or src): cortical sources
+        with fixed orientation ('surf') and subcortical sources with free orientation ('vol') """
+        fwds = []
+        for sp in self.sources() if src is None else src:
+
+            if sp[0]['type'] == 'surf':
+                print('\n---------- Forward Model for cortical sources ----------\n')
+                f_fixed = True
+                name = 'surf'
+            elif sp[0]['type'] == 'vol':
+                print('\n---------- Forward Model for subcortical sources ----------\n')
+                f_fixed = False
+                name = 'vol'
+            else: raise ValueError('Unknown Source Space type, it should be \'surf\' or \'vol\'')
+
+            fwds.append(self.forward(session, info, sp, force_fixed=f_fixed, name=name, **kwargs))
+
+        return fwds
+
+
+def forward_model(subject, session, info, fname_trans, src, force_fixed=False, name='model', json_fname='default',
+                  use_cache=True, force=False, mem_budget=None, compress=False, report=False,
+                  bem=None):
     """  Compute forward model
 
     Parameters
@@ -97,8 +225,8 @@ def forward_model(subject, session, info, fname_trans, src, force_fixed=False, n
         Name of the session of MEG file
     info : info from raw MEG file
         sensor position and data
-    fname_trans : str
-        The filename of transformation matrix
+    fname_trans : str | instance of Transform
+        The transformation matrix or its filename
     src : instance of SourceSpaces | list
         Sources of each interest hemisphere
     subjects_dir : str
@@ -107,6 +235,30 @@ def forward_model(subject, session, info, fname_trans, src, force_fixed=False, n
         Force fixed source orientation mode
     name : str
         Use to save output
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    use_cache : bool
+        If True, look for a forward model computed with the same sensors, trans, sources and BEM
+        in the cache of the subject before computing it, and store the new ones in the cache.
+        Cache entries are hardlinks of the session files (a copy if the file system does not
+        support them), see prune_forward_cache to remove the unused ones
+    force : bool
+        If True, the forward model is computed even if it is up to date or in the cache
+    mem_budget : float | None
+        If not None, the gain matrix is computed by blocks of sources of each source space,
+        sized to use about mem_budget MB at once. Each block is oriented and stored in a
+        disk-backed array, the result is the same as the one-shot computation. The budget
+        bounds the computation only: mne.write_forward_solution loads the whole gain matrix
+        to write the file, so the peak memory still grows with the size of the forward model
+    compress : bool
+        If True, the forward model is stored gzipped ('-fwd.fif.gz'), lossless. Gains are
+        stored in float32 in both cases
+    report : bool
+        If True, print the accuracy of the stored forward model against the float64 one
+        computed (see forward_accuracy)
+    bem : instance of ConductorModel | None
+        The BEM solution of the subject already loaded (see ForwardEngine), if None it is
+        read from its file (and created if needed)
 
     Returns
     -------
@@ -114,40 +266,407 @@ def forward_model(subject, session, info, fname_trans, src, force_fixed=False, n
         Forward model
     -------
     """
+    import mne
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_coords.json')
-
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
+    layout = get_layout(json_fname)
 
     # Files to save
-    fname_bem_sol = op.join(bem_dir.format(subject), '{0}-bem-sol.fif'.format(subject))
-    fname_fwd = op.join(fwd_dir.format(subject, session), '{0}-{1}-fwd.fif'.format(subject, name))
+    fname_bem_sol = layout.bem_sol(subject)
+    fname_fwd = layout.fwd(subject, session, name, compress=compress)
 
     # Create fwd subdirectoties if not existing
-    if not op.exists(fwd_dir.format(subject, session)):
-        os.makedirs(fwd_dir.format(subject, session))
+    if not op.exists(op.dirname(fname_fwd)):
+        os.makedirs(op.dirname(fname_fwd))
 
     # Making BEM model and BEM solution if it was not done before
-    if not check_bem(json_fname, subject):
-        create_bem(json_fname, subject)
+    if bem is None:
+        if not check_bem(layout, subject):
+            create_bem(layout, subject)
+        bem = fname_bem_sol
+
+    # Inputs of the forward model: sensors, trans, sources, BEM and orientation
+    mindist = fwd_mindist
+    digest = forward_digest(info, fname_trans, src, fname_bem_sol, force_fixed=force_fixed, mindist=mindist)
+    fwd_inputs = [fname_bem_sol] + ([fname_trans] if isinstance(fname_trans, str) else [])
+    fwd_manifest = forward_manifest(fname_fwd, subject, name)
+
+    if not force and is_up_to_date(fwd_manifest, fwd_inputs, [fname_fwd], params={'digest': digest},
+                                   markers=True):
+        print('\nForward model up to date, {0}\n'.format(fname_fwd))
+        return read_forward_model(fname_fwd, force_fixed)
+
+    # Forward models of the subject are cached across sessions, keyed by the digest of their inputs
+    if use_cache:
+        cache_dir = layout.fwd_cache_dir(subject)
+        if not op.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fname_cache = op.join(cache_dir, '{0}-fwd{1}'.format(digest, '.fif.gz' if compress else '.fif'))
+
+        if not force and is_complete(fname_cache):
+            print('\nForward model found in cache, {0}\n'.format(fname_cache))
+            fwd = read_forward_model(fname_cache, force_fixed)
+            ingest_file(fname_cache, fname_fwd, mode='hardlink')
+            write_marker(fname_fwd)
+            write_manifest(fwd_manifest, 'fwd', fwd_inputs, [fname_fwd], params={'digest': digest})
+            return fwd
 
     # Compute forward, commonly referred to as the gain or leadfield matrix.
-    fwd = mne.make_forward_solution(info=info, trans=fname_trans, src=src, bem=fname_bem_sol, mindist=0.0)
+    with track_stage('forward_compute', subject=subject, session=session, inputs=fwd_inputs):
+        if mem_budget is None:
+            fwd = mne.make_forward_solution(info=info, trans=fname_trans, src=src, bem=bem, mindist=mindist)
+
+            # Set orientation of cortical sources to surface normals or 3D for volume
+            fwd = _set_orientation(fwd, force_fixed)
+        else:
+            fwd = chunked_forward_solution(info, fname_trans, src, bem, mem_budget, force_fixed=force_fixed,
+                                           mindist=mindist, tmp_dir=op.dirname(fname_fwd))
+
+    # Save fwd model
+    with track_stage('forward_write', subject=subject, session=session, outputs=[fname_fwd]):
+        with atomic_write(fname_fwd) as fname_tmp:
+            mne.write_forward_solution(fname_tmp, fwd)
+        if use_cache:
+            ingest_file(fname_fwd, fname_cache, mode='hardlink')
+            write_marker(fname_cache)
+    write_manifest(fwd_manifest, 'fwd', fwd_inputs, [fname_fwd], params={'digest': digest})
+
+    if report:
+        acc = forward_accuracy(fwd, fname_fwd, force_fixed=force_fixed)
+        print('\nStored forward model: {size_mb:.1f} MB ({ratio:.2f} of float64), max relative error '
+              '{max_rel_error:.2e}, relative norm error {rel_norm_error:.2e}, min correlation '
+              '{min_corr:.8f}\n'.format(**acc))
+
+    return fwd
+
+
+def prune_forward_cache(subject, json_fname='default', unused_only=True):
+    """ Remove forward models from the cache of a subject
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    unused_only : bool
+        If True, only the cache entries no longer linked to the forward model of a session
+        are removed (the session was computed again or deleted), otherwise the whole cache.
+        Entries copied on file systems without hardlinks are never linked, they are removed
+
+    Returns
+    -------
+    removed : list of str
+        The removed cache entries
+    """
+    cache_dir = get_layout(json_fname).fwd_cache_dir(subject)
+    if not op.isdir(cache_dir):
+        return []
+
+    removed = []
+    for n in sorted(os.listdir(cache_dir)):
+        fname = op.join(cache_dir, n)
+        # Files being written by another process are kept
+        if n.endswith('.ok') or n.startswith(tmp_prefix) or not op.isfile(fname):
+            continue
+        if unused_only and os.stat(fname).st_nlink > 1:
+            continue
+        os.remove(fname)
+        if op.lexists(fname + '.ok'):
+            os.remove(fname + '.ok')
+        removed.append(fname)
+
+    print('{0} forward model(s) removed from the cache of {1}'.format(len(removed), subject))
+    return removed
+
+
+def forward_manifest(fname_fwd, subject, name):
+    """ Manifest of a forward model file """
+    return manifest_fname(op.dirname(fname_fwd), '{0}-{1}-fwd'.format(subject, name))
+
+
+def read_forward_model(fname, force_fixed=False):
+    """ Read a forward model stored by forward_model, gzipped or not
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the forward model ('-fwd.fif' or '-fwd.fif.gz')
+    force_fixed : bool
+        Orientation mode, see _set_orientation
+
+    Returns
+    -------
+    fwd : instance of mne.Forward
+        Forward model
+    """
+    import mne
+    return _set_orientation(mne.read_forward_solution(fname), force_fixed)
+
+
+def forward_accuracy(fwd, fname, force_fixed=False):
+    """ Accuracy of a stored forward model against the float64 one it was written from
+
+    Parameters
+    ----------
+    fwd : instance of mne.Forward
+        The forward model in memory (float64)
+    fname : str
+        The filename of the stored forward model
+    force_fixed : bool
+        Orientation mode, see _set_orientation
+
+    Returns
+    -------
+    accuracy : dict
+        size_mb (file size), ratio (file size over the size of the float64 gains),
+        max_abs_error, max_rel_error (relative to the largest gain), rel_norm_error
+        (relative Frobenius norm of the error) and min_corr (lowest correlation
+        between stored and float64 gains of a source)
+    """
+    ref = np.asarray(fwd['sol']['data'], dtype=np.float64)
+    stored = read_forward_model(fname, force_fixed)['sol']['data']
+
+    err = np.abs(stored - ref)
+    scale = np.abs(ref).max()
+    norm = np.linalg.norm(ref)
+
+    # Correlations per column, constant columns are ignored
+    ref_c = ref - ref.mean(axis=0)
+    stored_c = stored - stored.mean(axis=0)
+    denom = np.linalg.norm(ref_c, axis=0) * np.linalg.norm(stored_c, axis=0)
+    valid = denom > 0
+    corr = (ref_c * stored_c).sum(axis=0)[valid] / denom[valid]
+
+    size = op.getsize(fname)
+    return {'size_mb': size / 2. ** 20,
+            'ratio': size / float(max(ref.size * 8, 1)),
+            'max_abs_error': float(err.max()) if err.size else 0.,
+            'max_rel_error': float(err.max() / scale) if err.size and scale > 0 else 0.,
+            'rel_norm_error': float(np.linalg.norm(err) / norm) if norm > 0 else 0.,
+            'min_corr': float(corr.min()) if corr.size else 1.}
+
 
-    # Set orientation of cortical sources to surface normals or 3D for volume
+def _source_blocks(src, n_block):
+    """ Split the used sources of each source space in blocks of at most n_block sources
+
+    Yields (index of the source space, start, stop), positions in its vertno
+    """
+    for i, s in enumerate(src):
+        for start in range(0, s['nuse'], n_block):
+            yield i, start, min(start + n_block, s['nuse'])
+
+
+def _sub_source_space(s, start, stop):
+    """ Shallow copy of a source space using only vertno[start:stop] """
+    s = dict(s)
+    vertno = s['vertno'][start:stop].copy()
+    inuse = np.zeros(s['np'], dtype=s['inuse'].dtype)
+    inuse[vertno] = 1
+    s.update(inuse=inuse, vertno=vertno, nuse=len(vertno))
+    if s['type'] == 'surf':
+        s.update(use_tris=None, nuse_tris=0)
+    if s.get('patch_inds') is not None:
+        s['patch_inds'] = s['patch_inds'][start:stop]
+    return s
+
+
+def _block_size(info, bem, mem_budget):
+    """ Number of sources per block of chunked_forward_solution under a memory budget (MB)
+
+    Each block pays the preparation of MNE (field of the coils on the BEM vertices,
+    computed again for every block) besides the gains and BEM potentials of its sources.
+    """
+    n_chan = len(info['ch_names'])
+    n_bem = 0 if bem.get('is_sphere') else sum(s['np'] for s in bem['surfs'])
+
+    # Coils x BEM vertices matrix, up to 8 integration points per coil
+    prep = 8 * n_chan * n_bem * 8
+    # Free orientation gain, oriented copy, original gain and working arrays of MNE, potentials
+    # of the BEM vertices, float64
+    per_source = 3 * 8 * (4 * n_chan + n_bem)
+
+    budget = mem_budget * 2 ** 20 - prep
+    if budget < per_source:
+        print('Memory budget of {0} MB below the preparation of the forward model ({1:.1f} MB), '
+              'one source per block'.format(mem_budget, prep / 2. ** 20))
+        return 1
+    return int(budget // per_source)
+
+
+def chunked_forward_solution(info, trans, src, bem, mem_budget, force_fixed=False, mindist=0.0, tmp_dir=None):
+    """ Compute and orient a forward model by blocks of sources under a memory budget
+
+    Blocks never span two source spaces. The gain of each block is oriented and copied
+    in disk-backed arrays (temporary files, removed when the forward model is released),
+    so that only one block of gains is held in memory at once during the computation.
+    Writing the result with mne.write_forward_solution still loads the whole gain matrix.
+
+    Parameters
+    ----------
+    info : instance of mne.Info
+        Measurement info
+    trans : str | instance of Transform
+        The head<->MRI transformation or its filename
+    src : instance of SourceSpaces
+        The source spaces
+    bem : str | instance of ConductorModel
+        The BEM solution or its filename, read once for all the blocks
+    mem_budget : float
+        Approximate memory (MB) used to compute one block, including the preparation
+        of the sensors and BEM geometry. The returned gains are disk-backed, writing them
+        loads them in memory at once
+    force_fixed : bool
+        Orientation mode, see _set_orientation
+    mindist : float
+        Minimum distance of sources from inner skull surface
+    tmp_dir : str | None
+        Folder of the temporary files, default is the system one
+
+    Returns
+    -------
+    fwd : instance of mne.Forward
+        Forward model, same as the one-shot computation
+    """
+    import mne
+
+    # Files are read once, not by every block
+    if isinstance(bem, str):
+        bem = mne.read_bem_solution(bem)
+    if isinstance(trans, str):
+        trans = mne.read_trans(trans)
+
+    n_block = _block_size(info, bem, mem_budget)
+
+    def _disk_array(shape):
+        return np.memmap(tempfile.TemporaryFile(dir=tmp_dir), dtype=np.float64, mode='w+', shape=shape)
+
+    n_sources = sum(s['nuse'] for s in src)
+    fwd, sol, orig_sol = None, None, None
+    col, orig_col = 0, 0
+    vertno = [[] for _ in src]
+    patch_inds = [[] for _ in src]
+    spaces = [None] * len(src)
+    source_rr, source_nn = [], []
+
+    for i, start, stop in _source_blocks(src, n_block):
+        print('Forward model of sources {0}-{1} of source space {2}'.format(start, stop, i))
+        block_src = mne.SourceSpaces([_sub_source_space(src[i], start, stop)], info=src.info)
+        block = mne.make_forward_solution(info=info, trans=trans, src=block_src, bem=bem, mindist=mindist)
+        block = _set_orientation(block, force_fixed)
+
+        if fwd is None:
+            # First block is the template of the assembled forward model
+            fwd = block
+            n_ori = block['sol']['ncol'] // max(block['nsource'], 1)
+            sol = _disk_array((block['sol']['nrow'], n_ori * n_sources))
+            if block.get('_orig_sol') is not None:
+                orig_sol = _disk_array((block['sol']['nrow'], 3 * n_sources))
+
+        # Sources can be excluded (outside the inner skull, mindist)
+        ncol = block['sol']['ncol']
+        sol[:, col:col + ncol] = block['sol']['data']
+        col += ncol
+        if orig_sol is not None:
+            orig_ncol = block['_orig_sol'].shape[1]
+            orig_sol[:, orig_col:orig_col + orig_ncol] = block['_orig_sol']
+            orig_col += orig_ncol
+
+        block_space = block['src'][0]
+        if spaces[i] is None:
+            spaces[i] = block_space
+        vertno[i].append(block_space['vertno'])
+        if block_space.get('patch_inds') is not None:
+            patch_inds[i].append(block_space['patch_inds'])
+        source_rr.append(block['source_rr'])
+        source_nn.append(block['source_nn'])
+
+    if fwd is None:
+        raise ValueError('No source to compute the forward model')
+
+    # Source spaces (head coordinates) with the sources kept in every block
+    for i, space in enumerate(spaces):
+        space = dict(space)
+        space['vertno'] = np.concatenate(vertno[i]).astype(space['vertno'].dtype)
+        space['inuse'] = np.zeros(space['np'], dtype=space['inuse'].dtype)
+        space['inuse'][space['vertno']] = 1
+        space['nuse'] = len(space['vertno'])
+        if patch_inds[i]:
+            space['patch_inds'] = np.concatenate(patch_inds[i])
+        spaces[i] = space
+
+    fwd['src'] = mne.SourceSpaces(spaces, info=fwd['src'].info)
+    fwd['nsource'] = sum(s['nuse'] for s in spaces)
+    fwd['source_rr'] = np.concatenate(source_rr)
+    fwd['source_nn'] = np.concatenate(source_nn)
+    fwd['sol'] = dict(fwd['sol'], data=sol[:, :col], ncol=col)
+    if orig_sol is not None:
+        fwd['_orig_sol'] = orig_sol[:, :orig_col]
+
+    return fwd
+
+
+def _set_orientation(fwd, force_fixed):
+    """ Set the orientation of the sources of a forward model """
+    import mne
     if force_fixed:
         # Surface normal
         fwd = mne.forward.convert_forward_solution(fwd, surf_ori=True)
     else:
         # Cartesian 3D
         fwd = mne.forward.convert_forward_solution(fwd)
+    return fwd
 
-    # Save fwd model
-    mne.write_forward_solution(fname_fwd, fwd, overwrite=True)
 
-    return fwd
+# Digests of the BEM solutions, per file and stamp
+_file_digests = {}
+
+
+def _file_digest(fname):
+    """ Digest of a file content, computed again only when the file changes """
+    key = (op.abspath(fname), file_stamp(fname))
+    if key not in _file_digests:
+        _file_digests[key] = hash_file(fname)
+    return _file_digests[key]
+
+
+def forward_digest(info, trans, src, fname_bem, force_fixed=False, mindist=0.0):
+    """ Compute the digest of the inputs of a forward model
+
+    Parameters
+    ----------
+    info : instance of mne.Info
+        Measurement info, only the sensors geometry and dev_head_t are used
+    trans : str | instance of Transform
+        The head<->MRI transformation or its filename
+    src : instance of SourceSpaces
+        The source spaces, only the used vertices are taken into account
+    fname_bem : str
+        The filename of the BEM solution
+    force_fixed : bool
+        Orientation mode of the forward model
+    mindist : float
+        Minimum distance of sources from inner skull surface
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal digest identifying the forward model
+    """
+    import mne
+
+    chs = [(ch['ch_name'], ch['kind'], ch['coil_type'], ch['coord_frame'], np.asarray(ch['loc']))
+           for ch in info['chs']]
+    dev_head_t = info['dev_head_t']['trans'] if info['dev_head_t'] is not None else None
+
+    if isinstance(trans, str):
+        trans = mne.read_trans(trans)
+    trans = trans['trans']
+
+    sources = [(s['type'], s['id'], s['coord_frame'], s['vertno'], s['rr'][s['vertno']], s['nn'][s['vertno']])
+               for s in src]
+
+    return hash_object(['forward-v1', chs, dev_head_t, trans, sources, _file_digest(fname_bem),
+                        bool(force_fixed), float(mindist)])
 
 
 if __name__ == '__main__':
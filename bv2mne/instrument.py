@@ -0,0 +1,222 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+import sys
+import json
+import time
+import threading
+import warnings
+import multiprocessing
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Callbacks receiving the events of the stages
+_hooks = []
+
+# Whether this process is a worker of run_graph, running one stage at once
+_worker = False
+
+
+def register_hook(hook):
+    """ Register a callback called with the event (dict) of each stage
+
+    Events have the keys: stage, subject, session, status ('ok' or 'error'),
+    time (end, epoch seconds), wall and cpu (s, CPU time of the process for the
+    stages run by the main thread of the worker processes of run_graph, of the
+    thread running the stage otherwise, so that stages run by concurrent threads
+    are not charged each other's CPU time, see cpu_clock: 'process' or 'thread'),
+    max_rss_mb (high-water mark
+    of the process at the end of the stage, since the process started) and
+    max_rss_delta_mb (how much the stage raised it, 0 if an earlier stage of the
+    process used more memory), both None if unavailable, inputs and outputs
+    (filenames) with input_bytes and output_bytes (total size of those that
+    exist, None if no file)
+
+    Stages run by the worker processes of run_graph send their events to the
+    callbacks of the main process (see worker_events), the callbacks do not
+    need to be picklable. Errors of the callbacks are reported as warnings,
+    they never fail the stage.
+
+    Parameters
+    ----------
+    hook : callable
+        Function taking the event as only argument
+
+    Returns
+    -------
+    hook : callable
+        The registered callback
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def unregister_hook(hook):
+    """ Remove a callback registered with register_hook """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def get_hooks():
+    """ List of the registered callbacks """
+    return list(_hooks)
+
+
+class _QueueHook(object):
+    """ Callback of a worker process sending the events to the main process """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, event):
+        self.queue.put(dict(event, pid=os.getpid()))
+
+
+def set_event_queue(queue):
+    """ Send the events of this (worker) process to a queue, initializer of the worker processes """
+    global _worker
+    _worker = True
+    _hooks[:] = [_QueueHook(queue)] if queue is not None else []
+
+
+def _call_hooks(event):
+    """ Call the registered callbacks with an event, their errors are reported as warnings """
+    for hook in list(_hooks):
+        try:
+            hook(event)
+        except Exception as e:
+            warnings.warn('Stage event callback {0!r} failed on {1}: {2!r}'.format(hook, event.get('stage'), e),
+                          RuntimeWarning)
+
+
+def _dispatch_events(queue):
+    """ Call the callbacks of this process with the events of the workers, until None is received """
+    while True:
+        event = queue.get()
+        if event is None:
+            break
+        _call_hooks(event)
+
+
+@contextmanager
+def worker_events():
+    """ Queue through which worker processes send their events to the callbacks of this process
+
+    Pass it to set_event_queue in each worker, the events are dispatched by a
+    thread of this process until the context exits. Nothing is created if no
+    callback is registered.
+
+    Yields
+    ------
+    queue : instance of multiprocessing.Queue | None
+        The queue, None if no callback is registered
+    """
+    if not _hooks:
+        yield None
+        return
+
+    queue = multiprocessing.Queue()
+    thread = threading.Thread(target=_dispatch_events, args=(queue,), daemon=True)
+    thread.start()
+    try:
+        yield queue
+    finally:
+        # Workers have exited and flushed their events
+        queue.put(None)
+        thread.join()
+
+
+def _max_rss():
+    """ High-water mark of the resident memory of the process, in MB """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / 2. ** 20 if sys.platform == 'darwin' else rss / 2. ** 10
+
+
+def _files_size(fnames):
+    """ Total size of the existing files, None if there is no file """
+    fnames = [f for f in fnames if isinstance(f, str) and op.isfile(f)]
+    if not fnames:
+        return None
+    return sum(op.getsize(f) for f in fnames)
+
+
+@contextmanager
+def track_stage(stage, subject=None, session=None, inputs=None, outputs=None):
+    """ Time a stage and send its event to the registered callbacks
+
+    Inputs and outputs known only inside the stage can be added to the
+    yielded event ('inputs' and 'outputs' lists). Nothing is measured if no
+    callback is registered.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, e.g. 'surface_read', 'labeling', 'bem_model',
+        'bem_solution', 'volume_setup', 'forward_compute', 'forward_write'
+    subject : str | None
+        Name of the subject
+    session : str | None
+        Name of the session
+    inputs : list of str | None
+        Input files of the stage
+    outputs : list of str | None
+        Output files of the stage
+    """
+    event = {'stage': stage, 'subject': subject, 'session': session,
+             'inputs': list(inputs or []), 'outputs': list(outputs or [])}
+
+    if not _hooks:
+        yield event
+        return
+
+    # Only a worker process runs a single stage at once, other threads may run stages at the same time
+    per_process = _worker and threading.current_thread() is threading.main_thread()
+    cpu_clock = time.process_time if per_process else time.thread_time
+
+    wall, cpu, rss = time.perf_counter(), cpu_clock(), _max_rss()
+    event['status'] = 'error'
+    try:
+        yield event
+        event['status'] = 'ok'
+    finally:
+        max_rss = _max_rss()
+        event.update(time=time.time(),
+                     wall=time.perf_counter() - wall,
+                     cpu=cpu_clock() - cpu,
+                     cpu_clock='process' if per_process else 'thread',
+                     max_rss_mb=max_rss,
+                     max_rss_delta_mb=max_rss - rss if max_rss is not None else None,
+                     input_bytes=_files_size(event['inputs']),
+                     output_bytes=_files_size(event['outputs']))
+        _call_hooks(event)
+
+
+class JsonLinesHook(object):
+    """ Callback appending each event as a json line to a file
+
+    Events of several processes can be written to the same file.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the log
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __call__(self, event):
+        # Events of the workers already have their pid
+        line = json.dumps(dict({'pid': os.getpid()}, **event), default=str) + '\n'
+        with open(self.fname, 'a') as f:
+            f.write(line)
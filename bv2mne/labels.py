@@ -0,0 +1,106 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import colorsys
+from functools import reduce
+
+import numpy as np
+
+
+def _blend_colors(color_1, color_2):
+    """ Blend two RGBA colors in HSV space, as the addition of mne.Label does """
+    if color_1 is None:
+        return color_2
+    if color_2 is None:
+        return color_1
+
+    r_1, g_1, b_1, a_1 = color_1
+    r_2, g_2, b_2, a_2 = color_2
+    h_1, s_1, v_1 = colorsys.rgb_to_hsv(r_1, g_1, b_1)
+    h_2, s_2, v_2 = colorsys.rgb_to_hsv(r_2, g_2, b_2)
+
+    # Mean hue on the color circle
+    hue_diff = abs(h_1 - h_2)
+    if hue_diff < 0.5:
+        h = min(h_1, h_2) + hue_diff / 2.
+    else:
+        h = (max(h_1, h_2) + (1. - hue_diff) / 2.) % 1.
+
+    r, g, b = colorsys.hsv_to_rgb(h, (s_1 + s_2) / 2., (v_1 + v_2) / 2.)
+    return r, g, b, (a_1 + a_2) / 2.
+
+
+def _add_labels(labels):
+    """ Sum of labels with repeated Label addition """
+    labels_sum = labels[0]
+    for l in labels[1:]:
+        labels_sum = labels_sum + l
+    return labels_sum
+
+
+def sum_labels(labels):
+    """ Combine the labels of one hemisphere into a single label
+
+    Same result as adding the labels one by one (names and comments joined
+    with ' + ', blended colors, sorted vertices), but vertices, positions and
+    values are concatenated and sorted once instead of at each addition.
+
+    Parameters
+    ----------
+    labels : list of instance of mne.Label
+        Labels of the same hemisphere and subject
+
+    Returns
+    -------
+    label : instance of mne.Label | list
+        The combined label, the label itself if there is only one, an empty
+        list if there is no label
+    """
+    from mne import Label
+    if len(labels) == 0:
+        return []
+    if len(labels) == 1:
+        return labels[0]
+
+    vertices = np.concatenate([l.vertices for l in labels])
+
+    # Labels of both hemispheres or overlapping labels: addition checks them
+    if len(set(l.hemi for l in labels)) > 1 or len(set(l.subject for l in labels)) > 1 or \
+            len(np.unique(vertices)) < len(vertices):
+        return _add_labels(labels)
+
+    order = np.argsort(vertices)
+    pos = np.concatenate([l.pos for l in labels])[order]
+    values = np.concatenate([l.values for l in labels])[order]
+
+    name = ' + '.join(l.name if l.name else 'unnamed' for l in labels)
+    comment = ' + '.join('%s' % l.comment for l in labels)
+    color = reduce(_blend_colors, [l.color for l in labels])
+    verbose = reduce(lambda a, b: a or b, [l.verbose for l in labels])
+
+    return Label(vertices[order], pos=pos, values=values, hemi=labels[0].hemi, comment=comment, name=name,
+                 filename=None, subject=labels[0].subject, color=color, verbose=verbose)
+
+
+def sum_hemi_labels(labels):
+    """ Combine labels of both hemispheres into one label per hemisphere
+
+    Same result as the lh and rh labels of the BiHemiLabel obtained by adding
+    the labels one by one.
+
+    Parameters
+    ----------
+    labels : list of instance of mne.Label
+        Labels of both hemispheres
+
+    Returns
+    -------
+    labels : list
+        Combined label of the left and of the right hemisphere, None for a
+        hemisphere without label
+    """
+    hemi_labels = []
+    for hemi in ['lh', 'rh']:
+        labels_hemi = [l for l in labels if l.hemi == hemi]
+        hemi_labels.append(sum_labels(labels_hemi) if labels_hemi else None)
+    return hemi_labels
@@ -1,28 +1,37 @@
 import os.path as op
 import argparse
-from bv2mne.config.config import setup_db_coords
-from bv2mne.directories import create_sbj_db_mne
+from bv2mne.config.config import setup_db_info
+from bv2mne.pipeline import run_pipeline
+from bv2mne.instrument import register_hook, unregister_hook, JsonLinesHook
 
-def create_main(database, project, subjects, ses, event, json):
+def create_main(database, project, subjects, sessions, event, json=None, n_jobs=1, force=None, events=None,
+                group_fwd=False, tol_trans=1e-3, tol_rot=1e-3, worker=False):
 
     if not json:
-        json = setup_db_coords(database, project, overwrite=True)
-
-    from bv2mne.source import create_source_models
-    from bv2mne.forward import create_forward_models
-
-    for sbj in subjects:
-
-        create_sbj_db_mne(json, sbj)
-        # Pipeline for the estimation of surfaces/volumes sources and labels
-        # ------------------------------------------------------------------------------------------------------------------
-        surf_src, surf_labels, vol_src, vol_labels = create_source_models(sbj, save=True)
-        # ------------------------------------------------------------------------------------------------------------------
-
-        # Pipeline to estimate surfaces/volumes forward models
-        # ------------------------------------------------------------------------------------------------------------------
-        fwds = create_forward_models(sbj, ses, event, json)
-        # ------------------------------------------------------------------------------------------------------------------
+        # Workers would all rewrite the shared coordinates file
+        if worker:
+            raise ValueError('Workers need the coordinates file of the project (-json)')
+        json = setup_db_info(database, project, overwrite=True)
+
+    # Timing and memory of each stage as json lines
+    hook = register_hook(JsonLinesHook(events)) if events else None
+
+    # Pipeline for the MNE database, the BEM, the estimation of surfaces/volumes sources and labels
+    # and the surfaces/volumes forward models. Independent stages run on n_jobs processes
+    # ------------------------------------------------------------------------------------------------------------------
+    try:
+        if worker:
+            # Tasks claimed with lock files on the project directory, any number of workers can run
+            from bv2mne.workqueue import run_worker
+            run_worker(subjects, sessions, event, json_fname=json, force_stages=force, group_fwd=group_fwd,
+                       tol_trans=tol_trans, tol_rot=tol_rot)
+        else:
+            run_pipeline(subjects, sessions, event, json_fname=json, n_jobs=n_jobs, force_stages=force,
+                         group_fwd=group_fwd, tol_trans=tol_trans, tol_rot=tol_rot)
+    finally:
+        if hook is not None:
+            unregister_hook(hook)
+    # ------------------------------------------------------------------------------------------------------------------
 
 if __name__ == '__main__':
 
@@ -43,21 +52,52 @@ if __name__ == '__main__':
     parser.add_argument("-event", dest="event", type=str,
                         help="Event Name", required=True)
 
-    parser.add_argument("-ses", dest="ses", type=str,
-                        help="ses number", required=True)
+    parser.add_argument("-ses", dest="ses", type=str, nargs='+',
+                        help="ses number(s)", required=True)
 
     parser.add_argument("-json", dest="json", type=str,
                         help="If a json is alreasdy defined", required=False)
 
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="Number of processes running independent stages", required=False)
+
+    parser.add_argument("--force", dest="force", type=str, nargs='+', choices=['bem', 'src', 'fwd'],
+                        help="Stages rebuilt even if up to date", required=False)
+
+    parser.add_argument("--events", dest="events", type=str,
+                        help="File where the timing and memory of each stage are appended as json lines",
+                        required=False)
+
+    parser.add_argument("--group-fwd", dest="group_fwd", action='store_true',
+                        help="Compute one forward model per group of sessions with the same head position",
+                        required=False)
+
+    parser.add_argument("--tol-trans", dest="tol_trans", type=float, default=1.,
+                        help="With --group-fwd, maximum head displacement (mm) within a group", required=False)
+
+    parser.add_argument("--tol-rot", dest="tol_rot", type=float, default=1.,
+                        help="With --group-fwd, maximum head rotation (mrad) within a group", required=False)
+
+    parser.add_argument("--worker", dest="worker", action='store_true',
+                        help="Run as a worker of the work queue shared by all the workers of the project",
+                        required=False)
+
     args = parser.parse_args()
 
     # main_workflow
     print("Initialising the pipeline...")
     wf = create_main(
-        data=args.data,
+        database=args.data,
         project=args.project,
         subjects=args.subjects,
-        ses=args.ses,
+        sessions=args.ses,
         event=args.event,
-        json=args.json
+        json=args.json,
+        n_jobs=args.jobs,
+        force=args.force,
+        events=args.events,
+        group_fwd=args.group_fwd,
+        tol_trans=args.tol_trans * 1e-3,
+        tol_rot=args.tol_rot * 1e-3,
+        worker=args.worker
     )
@@ -0,0 +1,142 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+import json
+
+from bv2mne.cache import hash_file
+from bv2mne.atomic import atomic_write, is_complete
+
+
+def fingerprint(fname, method='stat'):
+    """ Fingerprint of a file
+
+    Parameters
+    ----------
+    fname : str
+        The filename
+    method : 'stat' | 'hash'
+        If 'stat' the fingerprint is the size and modification time of the
+        file, if 'hash' it is the digest of its content
+
+    Returns
+    -------
+    fp : dict | None
+        The fingerprint, None if the file does not exist
+    """
+    if not op.isfile(fname):
+        return None
+    if method == 'stat':
+        stat = os.stat(fname)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+    elif method == 'hash':
+        return {'sha1': hash_file(fname)}
+    else:
+        raise ValueError('method should be \'stat\' or \'hash\'')
+
+
+def manifest_fname(out_dir, stage):
+    """ Filename of the manifest of a stage whose outputs are in out_dir """
+    return op.join(out_dir, '{0}.manifest.json'.format(stage))
+
+
+def read_manifest(fname):
+    """ Read a stage manifest, None if it does not exist or is unreadable """
+    if not op.isfile(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_manifest(fname, stage, inputs, outputs, params=None, method='stat'):
+    """ Record the inputs consumed and the outputs produced by a stage
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the manifest
+    stage : str
+        Name of the stage
+    inputs : list of str
+        Input files of the stage
+    outputs : list of str
+        Output files of the stage
+    params : dict | None
+        Parameters of the stage (must be json serializable), a change of
+        these parameters triggers the stage as a change of its inputs
+    method : 'stat' | 'hash'
+        How files are fingerprinted, see fingerprint
+
+    Returns
+    -------
+    manifest : dict
+        The recorded manifest
+    """
+    manifest = {'stage': stage,
+                'method': method,
+                'params': params,
+                'inputs': {f: fingerprint(f, method) for f in inputs},
+                'outputs': {f: fingerprint(f, 'stat') for f in outputs}}
+
+    with atomic_write(fname, marker=False) as fname_tmp:
+        with open(fname_tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    return manifest
+
+
+def is_up_to_date(fname, inputs, outputs, params=None, method='stat', markers=False):
+    """ Check if a stage has to be run again
+
+    A stage is up to date if its manifest exists, if its parameters and the
+    fingerprints of its inputs did not change since the manifest was
+    written, and if its outputs exist and were not modified since.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the manifest
+    inputs : list of str
+        Input files of the stage
+    outputs : list of str
+        Output files of the stage
+    params : dict | None
+        Parameters of the stage
+    method : 'stat' | 'hash'
+        How input files are fingerprinted
+    markers : bool
+        If True, outputs must also have a valid completion marker (see bv2mne.atomic),
+        outputs written before markers existed are not up to date
+
+    Returns
+    -------
+    True/False : bool
+        True if the stage does not need to be run
+    """
+    manifest = read_manifest(fname)
+    if manifest is None or manifest.get('method') != method:
+        return False
+
+    # json has no tuples, compare parameters as they would be stored
+    if manifest.get('params') != json.loads(json.dumps(params)):
+        return False
+
+    if sorted(manifest['inputs']) != sorted(inputs) or sorted(manifest['outputs']) != sorted(outputs):
+        return False
+
+    for f in inputs:
+        if fingerprint(f, method) != manifest['inputs'][f]:
+            return False
+
+    for f in outputs:
+        fp = fingerprint(f, 'stat')
+        if fp is None or fp != manifest['outputs'][f]:
+            return False
+        if markers and not is_complete(f):
+            return False
+
+    return True
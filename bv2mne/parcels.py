@@ -0,0 +1,185 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import json
+
+import numpy as np
+
+from bv2mne.atomic import atomic_write
+
+# Sources without parcel
+no_parcel = -1
+
+
+def _space_hemi(s):
+    """ Hemisphere of a source space, from its id (surface) or its segmentation name (volume) """
+    if s['type'] == 'surf':
+        return {101: 'lh', 102: 'rh'}.get(int(s['id']))
+    seg_name = s.get('seg_name') or ''
+    if seg_name.endswith('lh'):
+        return 'lh'
+    if seg_name.endswith('rh'):
+        return 'rh'
+    return None
+
+
+def build_parcel_index(src, labels):
+    """ Parcel id of each source, in the order of the sources of the forward model
+
+    Parameters
+    ----------
+    src : instance of SourceSpaces
+        The source spaces
+    labels : list of instance of mne.Label
+        Hemisphere labels (lh, rh) whose values are the parcel ids
+
+    Returns
+    -------
+    ids : array of int16, shape (n_sources,)
+        Parcel id of each used vertex of each source space, -1 if the vertex is in no parcel
+    spaces : list of dict
+        For each source space, its type, hemisphere, number of sources and offset in ids
+    """
+    hemi_labels = dict((l.hemi, l) for l in labels if l is not None and not isinstance(l, list))
+
+    ids = np.full(sum(s['nuse'] for s in src), no_parcel, dtype=np.int16)
+    spaces = []
+    offset = 0
+    for s in src:
+        hemi = _space_hemi(s)
+        vertno = np.asarray(s['vertno'])
+        label = hemi_labels.get(hemi)
+
+        if label is not None and len(label.vertices):
+            # Label vertices are sorted, look up each source in one pass
+            pos = np.clip(np.searchsorted(label.vertices, vertno), 0, len(label.vertices) - 1)
+            found = label.vertices[pos] == vertno
+            ids[offset:offset + len(vertno)][found] = np.asarray(label.values)[pos[found]]
+
+        spaces.append({'type': s['type'], 'hemi': hemi, 'nuse': len(vertno), 'offset': offset})
+        offset += len(vertno)
+
+    return ids, spaces
+
+
+def write_parcel_index(fname, src, labels, names):
+    """ Write the parcel index of source spaces: ids as .npy and table as .json
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the index ('.npy'), the table is written next to it ('.json')
+    src : instance of SourceSpaces
+        The source spaces
+    labels : list of instance of mne.Label
+        Hemisphere labels (lh, rh) whose values are the parcel ids
+    names : dict
+        For each hemisphere ('lh', 'rh'), dict of parcel id -> name
+
+    Returns
+    -------
+    index : instance of ParcelIndex
+        The parcel index
+    """
+    ids, spaces = build_parcel_index(src, labels)
+    table = {'spaces': spaces,
+             'names': {hemi: {str(key): val for key, val in names.get(hemi, {}).items()} for hemi in ['lh', 'rh']}}
+
+    # Written atomically, the index may be memory-mapped by other processes. The table
+    # comes first, the completion marker of the ids then stands for both files
+    with atomic_write(fname[:-len('.npy')] + '.json', marker=False) as fname_tmp:
+        with open(fname_tmp, 'w') as f:
+            json.dump(table, f)
+    with atomic_write(fname) as fname_tmp:
+        np.save(fname_tmp, ids)
+
+    return ParcelIndex(ids, table['spaces'], table['names'])
+
+
+def read_parcel_index(fname):
+    """ Read a parcel index written by write_parcel_index, the ids are memory-mapped
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the index ('.npy')
+
+    Returns
+    -------
+    index : instance of ParcelIndex
+        The parcel index
+    """
+    ids = np.load(fname, mmap_mode='r')
+    with open(fname[:-len('.npy')] + '.json', 'r') as f:
+        table = json.load(f)
+    return ParcelIndex(ids, table['spaces'], table['names'])
+
+
+class ParcelIndex(object):
+    """ Parcel of each source of source spaces
+
+    Parameters
+    ----------
+    ids : array, shape (n_sources,)
+        Parcel id of each source (-1 if none), sources of all the source spaces in order
+    spaces : list of dict
+        For each source space, its type, hemisphere, number of sources and offset
+    names : dict
+        For each hemisphere, dict of parcel id (str) -> name
+    """
+
+    def __init__(self, ids, spaces, names):
+        self.ids = ids
+        self.spaces = spaces
+        self.names = names
+
+        # Hemisphere of each source, 0 lh and 1 rh
+        self._hemi = np.full(len(ids), -1, dtype=np.int8)
+        for sp in spaces:
+            if sp['hemi'] in ['lh', 'rh']:
+                self._hemi[sp['offset']:sp['offset'] + sp['nuse']] = ['lh', 'rh'].index(sp['hemi'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return '<ParcelIndex | {0} sources, {1} source spaces>'.format(len(self), len(self.spaces))
+
+    def space(self, i):
+        """ Parcel ids of the sources of the i-th source space """
+        sp = self.spaces[i]
+        return self.ids[sp['offset']:sp['offset'] + sp['nuse']]
+
+    def _hemi_mask(self, hemi):
+        if hemi is None:
+            return np.ones(len(self.ids), dtype=bool)
+        return self._hemi == ['lh', 'rh'].index(hemi)
+
+    def parcel_id(self, name, hemi):
+        """ Id of a parcel from its name, None if unknown """
+        for key, val in self.names.get(hemi, {}).items():
+            if val == name:
+                return int(key)
+        return None
+
+    def name(self, parcel, hemi):
+        """ Name of a parcel from its id, None if unknown """
+        return self.names.get(hemi, {}).get(str(int(parcel)))
+
+    def mask(self, parcel, hemi=None):
+        """ Boolean mask of the sources of a parcel (id or name, then hemi is required) """
+        if isinstance(parcel, str):
+            parcel = self.parcel_id(parcel, hemi)
+            if parcel is None:
+                return np.zeros(len(self.ids), dtype=bool)
+        return (np.asarray(self.ids) == parcel) & self._hemi_mask(hemi)
+
+    def sources(self, parcel, hemi=None):
+        """ Indices of the sources of a parcel (id or name) """
+        return np.flatnonzero(self.mask(parcel, hemi))
+
+    def counts(self, hemi=None):
+        """ Number of sources of each parcel, dict of parcel id -> count """
+        ids = np.asarray(self.ids)[self._hemi_mask(hemi)]
+        parcels, counts = np.unique(ids[ids != no_parcel], return_counts=True)
+        return dict(zip(parcels.tolist(), counts.tolist()))
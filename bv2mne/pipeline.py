@@ -0,0 +1,241 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from bv2mne.directories import create_sbj_db_mne, get_layout
+from bv2mne.instrument import worker_events, set_event_queue
+
+# Stages of the pipeline, in the order of their dependencies
+stages = ['db', 'bem', 'src', 'fwd']
+
+
+def setup_db_stage(subject, json_fname='default'):
+    """ Create the MNE database of the subject """
+    create_sbj_db_mne(subject, json_fname=json_fname)
+
+
+def bem_stage(subject, json_fname='default', force=False):
+    """ Create the BEM model and solution if they do not exist or are out of date """
+    from bv2mne.bem import check_bem, create_bem
+    if force or not check_bem(json_fname, subject):
+        create_bem(json_fname, subject, force=force)
+
+
+def source_stage(subject, json_fname='default', force=False):
+    """ Create and save the surface and volume source models """
+    from bv2mne.source import create_source_models
+    # Results are saved on disk, nothing is sent back to the main process
+    create_source_models(subject, save=True, json_fname=json_fname, force=force)
+
+
+def forward_stage(subject, session, event, json_fname='default', force=False):
+    """ Create and save the forward models of one session """
+    from bv2mne.forward import create_forward_models
+    create_forward_models(subject, session, event, json_fname=json_fname, force=force)
+
+
+def grouped_forward_stage(subject, sessions, event, json_fname='default', force=False, tol_trans=1e-3,
+                          tol_rot=1e-3):
+    """ Create and save the forward models of all the sessions, one per head position """
+    from bv2mne.planning import create_grouped_forward_models
+    return create_grouped_forward_models(subject, sessions, [event], json_fname=json_fname, tol_trans=tol_trans,
+                                         tol_rot=tol_rot, force=force)
+
+
+def build_pipeline_graph(subjects, sessions, event, json_fname='default', run_stages=None, force_stages=None,
+                         group_fwd=False, tol_trans=1e-3, tol_rot=1e-3):
+    """ Build the dependency graph of the pipeline stages
+
+    db setup -> BEM -> surface/volume sources -> per-session forwards
+
+    Parameters
+    ----------
+    subjects : list of str
+        Names of the subjects
+    sessions : list of str | list of int
+        Sessions for which forward models are computed
+    event : str
+        Name of the event MEG file
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    run_stages : list of str | None
+        Stages to include in the graph among 'db', 'bem', 'src' and 'fwd',
+        if None all the stages are included. Dependencies on stages that
+        are not included are considered already satisfied
+    force_stages : list of str | None
+        Stages rebuilt even if their outputs are up to date
+    group_fwd : bool
+        If True, one forward node per subject computes one forward model per group of
+        sessions with the same head position (see bv2mne.planning), instead of one node
+        per session
+    tol_trans : float
+        With group_fwd, maximum distance between the head positions of a group, in m
+    tol_rot : float
+        With group_fwd, maximum rotation between the head positions of a group, in rad
+
+    Returns
+    -------
+    graph : dict
+        For each node (stage, subject[, session]) a tuple (func, args, deps)
+    """
+
+    if run_stages is None:
+        run_stages = stages
+    if force_stages is None:
+        force_stages = []
+    for st in list(run_stages) + list(force_stages):
+        if st not in stages:
+            raise ValueError('Unknown stage {0}, it should be one of {1}'.format(st, stages))
+
+    graph = {}
+    for sbj in subjects:
+        nodes = {'db': ('db', sbj), 'bem': ('bem', sbj), 'src': ('src', sbj)}
+
+        graph[nodes['db']] = (setup_db_stage, (sbj, json_fname), [])
+        graph[nodes['bem']] = (bem_stage, (sbj, json_fname, 'bem' in force_stages), [nodes['db']])
+        graph[nodes['src']] = (source_stage, (sbj, json_fname, 'src' in force_stages), [nodes['bem']])
+        if group_fwd:
+            graph[('fwd', sbj)] = (grouped_forward_stage, (sbj, list(sessions), event, json_fname,
+                                                           'fwd' in force_stages, tol_trans, tol_rot),
+                                   [nodes['src']])
+            continue
+        for ses in sessions:
+            graph[('fwd', sbj, ses)] = (forward_stage, (sbj, ses, event, json_fname, 'fwd' in force_stages),
+                                        [nodes['src']])
+
+    # Keep only the requested stages
+    graph = {node: (func, args, [d for d in deps if d[0] in run_stages])
+             for node, (func, args, deps) in graph.items() if node[0] in run_stages}
+
+    return graph
+
+
+def _topological_order(graph):
+    """ Order the nodes so that each node comes after its dependencies """
+    order = []
+    visited = set()
+
+    def visit(node, path):
+        if node in visited:
+            return
+        if node in path:
+            raise ValueError('Cycle in the pipeline graph at node {0}'.format(node))
+        for dep in graph[node][2]:
+            visit(dep, path | {node})
+        visited.add(node)
+        order.append(node)
+
+    for node in graph:
+        visit(node, set())
+
+    return order
+
+
+def _check_n_jobs(n_jobs):
+    """ Number of processes, negative values count from the number of CPUs """
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    if n_jobs == 0:
+        raise ValueError('n_jobs must be a non-zero integer (-1 for all the CPUs), got 0')
+    return n_jobs
+
+
+def run_graph(graph, n_jobs=1):
+    """ Run the nodes of a dependency graph
+
+    Parameters
+    ----------
+    graph : dict
+        For each node a tuple (func, args, deps), see build_pipeline_graph
+    n_jobs : int
+        Number of processes. If 1 the nodes are run serially in the current
+        process, otherwise independent nodes are run on a process pool. As in
+        MNE, -1 uses all the CPUs, -2 all but one, ...
+
+    Returns
+    -------
+    results : dict
+        The value returned by each node
+    """
+
+    n_jobs = _check_n_jobs(n_jobs)
+    order = _topological_order(graph)
+    results = {}
+
+    if n_jobs == 1:
+        for node in order:
+            func, args, deps = graph[node]
+            results[node] = func(*args)
+        return results
+
+    pending = list(order)
+    running = {}
+    # Stage events of the workers are sent to the callbacks registered in this process
+    with worker_events() as queue, \
+            ProcessPoolExecutor(max_workers=n_jobs, initializer=set_event_queue, initargs=(queue,)) as executor:
+        while pending or running:
+            # Submit every node whose dependencies are completed
+            for node in list(pending):
+                func, args, deps = graph[node]
+                if all(d in results for d in deps):
+                    running[executor.submit(func, *args)] = node
+                    pending.remove(node)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    results[node] = future.result()
+                except Exception:
+                    for f in running:
+                        f.cancel()
+                    print('\nPipeline failed at stage {0}\n'.format(node))
+                    raise
+
+    return results
+
+
+def run_pipeline(subjects, sessions, event, json_fname='default', n_jobs=1, run_stages=None, force_stages=None,
+                 group_fwd=False, tol_trans=1e-3, tol_rot=1e-3):
+    """ Run the whole pipeline for several subjects and sessions
+
+    Parameters
+    ----------
+    subjects : list of str
+        Names of the subjects
+    sessions : list of str | list of int
+        Sessions for which forward models are computed
+    event : str
+        Name of the event MEG file
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    n_jobs : int
+        Number of processes used to run independent stages, -1 for all the CPUs
+    run_stages : list of str | None
+        Stages to run among 'db', 'bem', 'src' and 'fwd', if None all
+    force_stages : list of str | None
+        Stages rebuilt even if their outputs are up to date, by default only
+        the stages whose inputs changed are run again
+    group_fwd : bool
+        If True, sessions recorded with the same head position share one forward model
+    tol_trans, tol_rot : float
+        Tolerances (m, rad) on the head positions of the sessions sharing a forward model
+
+    Returns
+    -------
+    results : dict
+        The value returned by each stage
+    """
+
+    # Project paths resolved once and passed through the stages
+    layout = get_layout(json_fname)
+    n_jobs = _check_n_jobs(n_jobs)
+    graph = build_pipeline_graph(subjects, sessions, event, json_fname=layout, run_stages=run_stages,
+                                 force_stages=force_stages, group_fwd=group_fwd, tol_trans=tol_trans,
+                                 tol_rot=tol_rot)
+    print('\n---------- Running {0} pipeline stages on {1} process(es) ----------\n'.format(len(graph), n_jobs))
+
+    return run_graph(graph, n_jobs=n_jobs)
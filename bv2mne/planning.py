@@ -0,0 +1,210 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+
+import numpy as np
+
+from bv2mne.directories import get_layout, ingest_file
+from bv2mne.cache import hash_object
+from bv2mne.sensors import get_sensor_info
+from bv2mne.manifest import write_manifest
+from bv2mne.atomic import write_marker
+from bv2mne.forward import get_forward_engine, forward_digest, forward_manifest, fwd_mindist
+
+
+def sensor_key(info):
+    """ Digest of the sensors of a measurement info (names, types, coils and positions in device coordinates) """
+    return hash_object([(ch['ch_name'], ch['kind'], ch['coil_type'], ch['coord_frame'], np.asarray(ch['loc']))
+                        for ch in info['chs']])
+
+
+def same_head_position(trans1, trans2, tol_trans=1e-3, tol_rot=1e-3):
+    """ Whether two device to head transformations are equal within tolerances
+
+    Parameters
+    ----------
+    trans1, trans2 : array, shape (4, 4) | None
+        The transformations
+    tol_trans : float
+        Maximum distance between the translations, in m
+    tol_rot : float
+        Maximum angle of the rotation between them, in rad
+
+    Returns
+    -------
+    True/False : bool
+    """
+    if trans1 is None or trans2 is None:
+        return trans1 is None and trans2 is None
+
+    trans1, trans2 = np.asarray(trans1), np.asarray(trans2)
+    if np.linalg.norm(trans1[:3, 3] - trans2[:3, 3]) > tol_trans:
+        return False
+
+    # Angle of R1^T R2
+    cos = (np.trace(np.dot(trans1[:3, :3].T, trans2[:3, :3])) - 1.) / 2.
+    return np.arccos(np.clip(cos, -1., 1.)) <= tol_rot
+
+
+def plan_forwards(subject, sessions, events, json_fname='default', tol_trans=1e-3, tol_rot=1e-3):
+    """ Group the sessions of a subject sharing the same sensors and head position
+
+    One forward model per group is enough: the forward model depends only on the
+    sensors geometry and on the device to head transformation. The forward model
+    file is per session, so the events of a session are always in the group of the
+    session, which is placed from the info of its first event (as forward_model run
+    for the session does).
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    sessions : list of str | list of int
+        The sessions
+    events : list of str
+        Names of the event MEG files
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    tol_trans : float
+        Maximum distance between the head positions of a group, in m
+    tol_rot : float
+        Maximum rotation between the head positions of a group, in rad
+
+    Returns
+    -------
+    groups : list of dict
+        For each group, 'members' the list of (session, event), the first one is the
+        representative whose forward model is computed, and 'info' its measurement info
+    """
+    layout = get_layout(json_fname)
+
+    groups = []
+    for ses in sessions:
+        infos = [get_sensor_info(subject, ses, ev, json_fname=layout) for ev in events]
+        key = sensor_key(infos[0])
+        dev_head_t = _dev_head_t(infos[0])
+
+        for ev, info in zip(events[1:], infos[1:]):
+            if sensor_key(info) != key or not same_head_position(dev_head_t, _dev_head_t(info), tol_trans, tol_rot):
+                print('Warning: sensors or head position of event {0} differ from those of event {1} in session '
+                      '{2}, the forward model of the session is computed for event {1}'.format(ev, events[0], ses))
+
+        for group in groups:
+            if group['key'] == key and same_head_position(group['dev_head_t'], dev_head_t, tol_trans, tol_rot):
+                break
+        else:
+            group = {'key': key, 'dev_head_t': dev_head_t, 'members': [], 'info': infos[0], 'infos': []}
+            groups.append(group)
+        group['members'].extend((ses, ev) for ev in events)
+        group['infos'].extend(infos)
+
+    return groups
+
+
+def _dev_head_t(info):
+    """ Device to head transformation of a measurement info, None if unknown """
+    return info['dev_head_t']['trans'] if info['dev_head_t'] is not None else None
+
+
+def run_forward_plan(subject, groups, json_fname='default', mode='hardlink', force=False, compress=False,
+                     **kwargs):
+    """ Compute one forward model per group and link it for the other sessions of the group
+
+    The forward models of the other sessions are added with ingest_file. Their manifest
+    records the digest of the representative and the session it is shared from, so
+    forward_model run for one of these sessions alone computes its own forward model.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    groups : list of dict
+        Groups returned by plan_forwards, a session can be in one group only
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    mode : 'copy' | 'hardlink' | 'symlink' | 'reflink'
+        How the forward model of the representative is added to the other sessions
+    force : bool
+        If True, the forward models of the representatives are computed even if up to date
+    compress : bool
+        If True, forward models are stored gzipped
+    **kwargs
+        Other options of forward_model (mem_budget, use_cache, report)
+
+    Returns
+    -------
+    report : dict
+        n_members (sessions x events), n_groups, n_forwards (forward models of the
+        representatives, computed or reused when up to date or cached) and n_shared
+        (forward models of the other sessions, linked to those of their representative)
+    """
+    # One forward model file per session, it cannot be shared from two representatives
+    seen, shared = set(), set()
+    for group in groups:
+        sessions = set(ses for ses, ev in group['members'])
+        shared |= seen & sessions
+        seen |= sessions
+    if shared:
+        raise ValueError('Sessions {0} are in several groups, the events of a session must be in the group of '
+                         'the session (see plan_forwards)'.format(sorted(shared, key=str)))
+
+    layout = get_layout(json_fname)
+    engine = get_forward_engine(subject, json_fname=layout)
+    names = [(sp[0]['type'], sp) for sp in engine.sources()]
+
+    n_forwards, n_shared = 0, 0
+    for group in groups:
+        rep_ses, rep_ev = group['members'][0]
+        print('\n---------- Forward models of session {0} ({1}) for {2} member(s) ----------\n'.format(
+            rep_ses, rep_ev, len(group['members'])))
+        engine.forward_models(rep_ses, group['info'], force=force, compress=compress, **kwargs)
+        n_forwards += len(names)
+
+        rep_digests = dict((name, forward_digest(group['info'], engine.trans, sp, engine.fname_bem_sol,
+                                                 force_fixed=(name == 'surf'), mindist=fwd_mindist))
+                           for name, sp in names)
+
+        # Events of the same session share the forward model file
+        done = set([rep_ses])
+        for ses, ev in group['members'][1:]:
+            if ses in done:
+                continue
+            done.add(ses)
+
+            for name, sp in names:
+                fname_rep = layout.fwd(subject, rep_ses, name, compress=compress)
+                fname_fwd = layout.fwd(subject, ses, name, compress=compress)
+                if not op.exists(op.dirname(fname_fwd)):
+                    os.makedirs(op.dirname(fname_fwd))
+                ingest_file(fname_rep, fname_fwd, mode=mode)
+                write_marker(fname_fwd)
+
+                # Computed at the head position of the representative, not exactly at this one
+                write_manifest(forward_manifest(fname_fwd, subject, name), 'fwd', [engine.fname_bem_sol],
+                               [fname_fwd], params={'digest': rep_digests[name], 'shared_from': str(rep_ses)})
+                n_shared += 1
+
+    n_members = sum(len(g['members']) for g in groups)
+    report = {'n_members': n_members, 'n_groups': len(groups), 'n_forwards': n_forwards, 'n_shared': n_shared}
+    print('\n{n_groups} head position group(s) for {n_members} session(s)/event(s): {n_forwards} forward '
+          'model(s) of the representatives, {n_shared} shared\n'.format(**report))
+
+    return report
+
+
+def create_grouped_forward_models(subject, sessions, events, json_fname='default', tol_trans=1e-3, tol_rot=1e-3,
+                                  mode='hardlink', force=False, **kwargs):
+    """ Plan and compute the forward models of the sessions and events of a subject, one per head position
+
+    See plan_forwards and run_forward_plan for the parameters.
+
+    Returns
+    -------
+    report : dict
+        Number of members, groups, forward models of the representatives and shared ones
+    """
+    layout = get_layout(json_fname)
+    groups = plan_forwards(subject, sessions, events, json_fname=layout, tol_trans=tol_trans, tol_rot=tol_rot)
+    return run_forward_plan(subject, groups, json_fname=layout, mode=mode, force=force, **kwargs)
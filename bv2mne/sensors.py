@@ -0,0 +1,88 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+
+from bv2mne.directories import get_layout
+from bv2mne.cache import file_stamp
+from bv2mne.atomic import atomic_write, is_complete
+
+# Measurement info already read in this process, keyed by file
+_info_cache = {}
+
+
+def read_sensor_info(fname):
+    """ Read only the measurement info of a MEG file
+
+    The data (epochs, raw, ...) are never loaded. Infos are kept in memory
+    and read again only if the file changed.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of a FIF file (raw, epochs, evoked or info)
+
+    Returns
+    -------
+    info : instance of mne.Info
+        Measurement info, with sensors positions
+    """
+    import mne
+    key = op.abspath(fname)
+    stamp = file_stamp(fname)
+
+    cached = _info_cache.get(key)
+    if cached is None or cached[0] != stamp:
+        info = mne.io.read_info(fname)
+        _info_cache[key] = (stamp, info)
+    else:
+        info = cached[1]
+
+    return info.copy()
+
+
+def get_sensor_info(subject, session=1, event='', json_fname='default'):
+    """ Get the measurement info of an epoched MEG file of a session
+
+    The info is stored once per subject, session and event in the forward
+    model directory of the session ('{subject}_{event}-info.fif'), so that
+    the other stages can reuse it without opening the epochs file.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    session : int | str
+        Number of the session
+    event : str
+        Name of the event MEG file
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+
+    Returns
+    -------
+    info : instance of mne.Info
+        Measurement info, with sensors positions
+    """
+    import mne
+
+    layout = get_layout(json_fname)
+
+    # MEG Epoched data to recover position of channels
+    fname_event = layout.epochs(subject, session, event)
+    fname_info = layout.sensor_info(subject, session, event)
+
+    # Stored info is used as long as it was completely written after the epochs file
+    if is_complete(fname_info) and (not op.isfile(fname_event) or
+                                    op.getmtime(fname_info) >= op.getmtime(fname_event)):
+        return read_sensor_info(fname_info)
+
+    info = read_sensor_info(fname_event)
+
+    if not op.exists(op.dirname(fname_info)):
+        os.makedirs(op.dirname(fname_info))
+    with atomic_write(fname_info) as fname_tmp:
+        mne.io.write_info(fname_tmp, info)
+
+    return info
@@ -3,15 +3,19 @@
 
 import os.path as op
 import numpy as np
-import mne
-from mne import SourceSpaces
-from bv2mne.directories import read_databases, read_directories
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bv2mne.directories import get_layout
 from bv2mne.surface import get_surface, get_surface_labels
 from bv2mne.volume import get_volume, get_volume_labels
-from bv2mne.utils import create_trans
+from bv2mne.labels import sum_labels, sum_hemi_labels
+from bv2mne.parcels import write_parcel_index
+from bv2mne.utils import create_trans, read_referential, read_texture_info
 from bv2mne.bem import check_bem, create_bem
+from bv2mne.manifest import manifest_fname, is_up_to_date, write_manifest
+from bv2mne.instrument import track_stage
+from bv2mne.atomic import atomic_write
 
-def create_source_models(subject, save=False, json_fname='default'):
+def create_source_models(subject, save=False, json_fname='default', force=False, n_jobs=1):
     """ Create cortical and subcortical source models
 
     Pipeline for:
@@ -29,6 +33,14 @@ def create_source_models(subject, save=False, json_fname='default'):
         To delete, database reference for trans file, useless from next version
     save : bool | True
         Allows to save source spaces and respective labels in the default directory
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    force : bool | list of str
+        If False, saved surface and volume sources whose inputs did not change since they
+        were created are read instead of being computed again. If True both are computed,
+        a list of 'surf' and/or 'vol' forces only those
+    n_jobs : int
+        Number of cortical hemispheres processed concurrently (threads)
 
     Returns
     -------
@@ -41,13 +53,10 @@ def create_source_models(subject, save=False, json_fname='default'):
     vol_labels : instance of Labels
         Subcortical volumes Labels
     """
+    import mne
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_info.son')
-
-    database, project, db_mne, db_bv, db_fs = read_databases(json_fname)
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
+    layout = get_layout(json_fname)
+    database, project, db_mne, db_bv = layout.database, layout.project, layout.db_mne, layout.db_bv
 
     ###########################################################################
     # -------------------------------------------------------------------------
@@ -55,11 +64,11 @@ def create_source_models(subject, save=False, json_fname='default'):
     # -------------------------------------------------------------------------
 
     # BV decimated white meshes (cortical sources)
-    fname_surf_L = op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                           'mesh', 'surface_analysis', '{0}_Lwhite_remeshed_hiphop.gii'.format(subject))
+    fname_surf_L = op.join(layout.bv_mesh_dir(subject), 'surface_analysis',
+                           '{0}_Lwhite_remeshed_hiphop.gii'.format(subject))
 
-    fname_surf_R = op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                           'mesh', 'surface_analysis', '{0}_Rwhite_remeshed_hiphop.gii'.format(subject))
+    fname_surf_R = op.join(layout.bv_mesh_dir(subject), 'surface_analysis',
+                           '{0}_Rwhite_remeshed_hiphop.gii'.format(subject))
 
     # BV texture (MarsAtlas labels) for decimated white meshes
     # (cortical sources)
@@ -70,62 +79,122 @@ def create_source_models(subject, save=False, json_fname='default'):
                           'hiphop138_Rwhite_dec_4K_parcels_marsAtlas.gii')
 
     # Labelling xls file
-    fname_atlas = op.join(db_mne, project, 'marsatlas', 'MarsAtlas_BV_2015.xls')
+    fname_atlas = layout.atlas()
+
+    # Parsed template textures, shared by all the subjects of the project
+    tex_cache_dir = op.join(db_mne, project, 'marsatlas', 'cache')
 
     # Color palette (still used???)
     fname_color = op.join(db_mne, project, 'marsatlas', 'MarsAtlas.ima')
 
     # MarsAtlas volume parcellation
-    fname_vol = op.join(db_bv, project, subject, 't1mri', 'default_acquisition', 'default_analysis', 'segmentation',
-                        'mesh', 'surface_analysis', '{0}_parcellation.nii.gz'.format(subject))
+    fname_vol = op.join(layout.bv_mesh_dir(subject), 'surface_analysis', '{0}_parcellation.nii.gz'.format(subject))
 
     # -------------------------------------------------------------------------
     # Transformation files BV to FS
     # -------------------------------------------------------------------------
     # Referential file list
     # (3 transformation files to transform BV meshes to FS space)
-    fname_trans_ref = op.join(db_mne, project, 'referential', 'referential.txt')
+    fname_trans_ref = layout.referential()
 
     # This file contains the transformations for subject_01
-    fname_trans_out = op.join(db_mne, project, subject, 'ref', '{0}-trans.trm'.format(subject))
+    fname_trans_out = layout.trans_trm(subject)
 
     name_lobe_vol = ['Subcortical']
 
+    # Saved sources and labels
+    src_dir = layout.src_dir.format(subject)
+    fname_surf_src = layout.src(subject, 'surf')
+    fname_vol_src = layout.src(subject, 'vol')
+    fname_surf_lab = [layout.label(subject, 'surf', h) for h in ['lh', 'rh']]
+    fname_vol_lab = [layout.label(subject, 'vol', h) for h in ['lh', 'rh']]
+    fname_surf_parc = layout.parcels(subject, 'surf')
+    fname_vol_parc = layout.parcels(subject, 'vol')
+
+    if force is True:
+        force = ['surf', 'vol']
+    elif force is False:
+        force = []
+
     # ---------------------------------------------------------------------
     # Setting up the source space from BrainVISA results
     # ---------------------------------------------------------------------
-    # http://martinos.org/mne/stable/manual/cookbook.html#source-localization
-    # Create .trm file transformation from BrainVisa to FreeSurfer needed
-    # for brain.py function for surface only
-    create_trans(subject, database, fname_trans_ref, fname_trans_out)
-
-    # Calculate cortical sources and MarsAtlas labels
-    print('\n---------- Cortical sources ----------\n')
-    surf_src, surf_labels = get_brain_surf_sources(subject, fname_surf_L, fname_surf_R, fname_tex_L, fname_tex_R,
-                                                   fname_trans_out, fname_atlas, fname_color)
-
-    if save == True:
-        print('\nSaving surface source space and labels.....')
-        mne.write_source_spaces(op.join(src_dir.format(subject), '{0}_surf-src.fif'.format(subject)), surf_src, overwrite=True)
-        for sl in surf_labels:
-            mne.write_label(op.join(src_dir.format(subject), '{0}_surf-lab'.format(subject)), sl)
-        print('[done]')
+    surf_inputs = [fname_surf_L, fname_surf_R, fname_tex_L, fname_tex_R, fname_atlas, fname_trans_ref]
+    surf_inputs += [f for f, inv_bool in read_referential(subject, database, fname_trans_ref)]
+    surf_outputs = [fname_surf_src] + fname_surf_lab + [fname_surf_parc]
+    surf_manifest = manifest_fname(src_dir, 'surf-src')
+
+    if save and 'surf' not in force and is_up_to_date(surf_manifest, surf_inputs, surf_outputs, markers=True):
+        print('\n---------- Cortical sources up to date ----------\n')
+        surf_src = mne.read_source_spaces(fname_surf_src)
+        surf_labels = [mne.read_label(f) for f in fname_surf_lab]
+
+    else:
+        # http://martinos.org/mne/stable/manual/cookbook.html#source-localization
+        # Create .trm file transformation from BrainVisa to FreeSurfer needed
+        # for brain.py function for surface only. The composed matrix is
+        # applied directly, the file is kept for the other tools
+        trans = create_trans(subject, database, fname_trans_ref, fname_trans_out)
+
+        # Calculate cortical sources and MarsAtlas labels
+        print('\n---------- Cortical sources ----------\n')
+        surf_src, surf_labels = get_brain_surf_sources(subject, fname_surf_L, fname_surf_R, fname_tex_L, fname_tex_R,
+                                                       trans, fname_atlas, fname_color,
+                                                       tex_cache_dir=tex_cache_dir, n_jobs=n_jobs)
+
+        if save == True:
+            print('\nSaving surface source space and labels.....')
+            with track_stage('surf_source_write', subject=subject, outputs=surf_outputs):
+                # Written next to their final paths and renamed into place once complete
+                with atomic_write(fname_surf_src) as fname_tmp:
+                    mne.write_source_spaces(fname_tmp, surf_src)
+                for sl in surf_labels:
+                    with atomic_write(layout.label(subject, 'surf', sl.hemi)) as fname_tmp:
+                        mne.write_label(fname_tmp, sl)
+                # Source -> MarsAtlas parcel id, texture values are the ids
+                names = dict((h, dict((key, val[0]) for key, val in read_texture_info(fname_atlas, h).items()))
+                             for h in ['lh', 'rh'])
+                write_parcel_index(fname_surf_parc, surf_src, surf_labels, names)
+            write_manifest(surf_manifest, 'surf-src', surf_inputs, surf_outputs)
+            print('[done]')
 
     # Create BEM model if needed
     print('\nBEM model is needed for volume source space\n')
-    if not check_bem(json_fname, subject):
-        create_bem(json_fname, subject)
-
-    print('\n---------- Subcortical sources ----------\n')
-
-    vol_src, vol_labels = get_brain_vol_sources(subject, fname_vol, json_fname, name_lobe_vol, fname_trans_out, fname_atlas, space=5.)
-
-    if save == True:
-        print('Saving volume source space and labels.....')
-        mne.write_source_spaces(op.join(src_dir.format(subject), '{0}_vol-src.fif'.format(subject)), vol_src, overwrite=True)
-        for vl in vol_labels:
-            mne.write_label(op.join(src_dir.format(subject), '{0}_vol-lab'.format(subject)), vl)
-        print('[done]')
+    if not check_bem(layout, subject):
+        create_bem(layout, subject)
+
+    vol_params = {'pos': 5.}
+    vol_inputs = [layout.aseg(subject), layout.bem_model(subject)]
+    vol_outputs = [fname_vol_src] + fname_vol_lab + [fname_vol_parc]
+    vol_manifest = manifest_fname(src_dir, 'vol-src')
+
+    if save and 'vol' not in force and is_up_to_date(vol_manifest, vol_inputs, vol_outputs, params=vol_params,
+                                                     markers=True):
+        print('\n---------- Subcortical sources up to date ----------\n')
+        vol_src = mne.read_source_spaces(fname_vol_src)
+        vol_labels = [mne.read_label(f) for f in fname_vol_lab]
+
+    else:
+        print('\n---------- Subcortical sources ----------\n')
+
+        vol_src, vol_labels = get_brain_vol_sources(subject, fname_vol, layout, name_lobe_vol, fname_trans_out,
+                                                    fname_atlas, space=vol_params['pos'])
+
+        if save == True:
+            print('Saving volume source space and labels.....')
+            with track_stage('vol_source_write', subject=subject, outputs=vol_outputs):
+                with atomic_write(fname_vol_src) as fname_tmp:
+                    mne.write_source_spaces(fname_tmp, vol_src)
+                for vl in vol_labels:
+                    with atomic_write(layout.label(subject, 'vol', vl.hemi)) as fname_tmp:
+                        mne.write_label(fname_tmp, vl)
+                # Source -> structure id, label values are 200 + the index of the structure
+                names = {'lh': {}, 'rh': {}}
+                for k, vs in enumerate(vol_src):
+                    names[vs['seg_name'][-2:]][200 + k] = vs['seg_name']
+                write_parcel_index(fname_vol_parc, vol_src, vol_labels, names)
+            write_manifest(vol_manifest, 'vol-src', vol_inputs, vol_outputs, params=vol_params)
+            print('[done]')
     #
     print('\n---------- Sources Completed ----------\n')
 
@@ -134,7 +203,8 @@ def create_source_models(subject, save=False, json_fname='default'):
 
 def get_brain_surf_sources(subject, fname_surf_L=None, fname_surf_R=None,
                            fname_tex_L=None, fname_tex_R=None,
-                           trans=False, fname_atlas=None, fname_color=None):
+                           trans=False, fname_atlas=None, fname_color=None, tex_cache_dir=None,
+                           compact=False, n_jobs=1, backend='thread'):
     """compute surface sources
     Parameters
     ----------
@@ -149,12 +219,20 @@ def get_brain_surf_sources(subject, fname_surf_L=None, fname_surf_R=None,
         The texture is used to select areas in the surface
     fname_tex_R : None | str
         The filename of the texture surface of the left hemisphere
-    trans : str | None
-        The filename that contains transformation matrix for surface
+    trans : str | array | None
+        The transformation matrix for surface or the filename that contains it
     fname_atlas : str | None
         The filename of the area atlas
     fname_color : Brain surfer instance
         The filename of color atlas
+    tex_cache_dir : str | None
+        Folder where parsed textures are stored as memory-mapped .npy files
+    compact : bool
+        If True, float32 positions transformed in place (see get_surface)
+    n_jobs : int
+        Number of hemispheres processed concurrently
+    backend : 'thread' | 'process'
+        Run the hemispheres in threads or in processes (n_jobs > 1)
     Returns
     -------
     surf_src : instance of mne.SourceSpace
@@ -163,6 +241,7 @@ def get_brain_surf_sources(subject, fname_surf_L=None, fname_surf_R=None,
         Surface MarsAtlas labels
     -------
     """
+    from mne import SourceSpaces
 
     list_hemi = ['lh', 'rh']
 
@@ -171,41 +250,55 @@ def get_brain_surf_sources(subject, fname_surf_L=None, fname_surf_R=None,
 
     print('\nBuilding surface areas.....')
 
-    # Get surfaces
-    surfaces = []
-    surf_labels = []
-    for hemi_surf, hemi_tex, hemi in zip(fname_surf, fname_tex, list_hemi):
+    hemis = [(hemi_surf, hemi_tex, hemi) for hemi_surf, hemi_tex, hemi in zip(fname_surf, fname_tex, list_hemi)
+             if hemi_surf is not None and hemi_tex is not None]
+    args = [(subject, hemi_surf, hemi_tex, hemi, trans, fname_atlas, fname_color, tex_cache_dir, compact)
+            for hemi_surf, hemi_tex, hemi in hemis]
+
+    # Hemispheres are independent, results are kept in lh, rh order
+    if n_jobs == 1 or len(args) < 2:
+        results = [_get_hemi_sources(*a) for a in args]
+    else:
+        if backend == 'thread':
+            pool = ThreadPoolExecutor
+        elif backend == 'process':
+            pool = ProcessPoolExecutor
+        else:
+            raise ValueError("backend must be 'thread' or 'process'")
+        with pool(max_workers=min(n_jobs, len(args))) as executor:
+            results = list(executor.map(_get_hemi_sources, *zip(*args)))
+
+    surfaces = [surface for surface, labels_sum in results]
+    surf_labels = [labels_sum for surface, labels_sum in results]
+
+    print('\nSet sources on MarsAtlas cortical areas')
+    surf_src = SourceSpaces(surfaces)
 
-        if hemi_surf is not None and hemi_tex is not None:
+    print('[done]')
+    return surf_src, surf_labels
 
-            # Create surface areas
-            surface = get_surface(hemi_surf, subject=subject, hemi=hemi, trans=trans)
-            labels_hemi = get_surface_labels(surface, texture=hemi_tex, hemi=hemi, subject=subject,
-                                             fname_atlas=fname_atlas, fname_color=fname_color)
 
-            # Delete WM (values of texture 0 and 42)
-            bad_areas = [0, 42]
-            if bad_areas is not None:
-                # bad =
-                labels_hemi = list(np.delete(labels_hemi, bad_areas, axis=0))
+def _get_hemi_sources(subject, hemi_surf, hemi_tex, hemi, trans, fname_atlas, fname_color, tex_cache_dir,
+                      compact=False):
+    """ Surface source space and MarsAtlas labels (summed) of one hemisphere """
 
+    # Create surface areas
+    surface = get_surface(hemi_surf, subject=subject, hemi=hemi, trans=trans, compact=compact)
+    labels_hemi = get_surface_labels(surface, texture=hemi_tex, hemi=hemi, subject=subject,
+                                     fname_atlas=fname_atlas, fname_color=fname_color,
+                                     tex_cache_dir=tex_cache_dir)
 
-            # MNE accepts hemispheric labels as a single object that keeps the sum of all single labels
-            labels_sum = []
-            for l in labels_hemi:
-                if type(labels_sum) == list:
-                    labels_sum = l
-                else:
-                    labels_sum += l
+    # Delete WM (values of texture 0 and 42)
+    bad_areas = [0, 42]
+    if bad_areas is not None:
+        # bad =
+        labels_hemi = list(np.delete(labels_hemi, bad_areas, axis=0))
 
-            surfaces.append(surface)
-            surf_labels.append(labels_sum)
 
-    print('\nSet sources on MarsAtlas cortical areas')
-    surf_src = SourceSpaces(surfaces)
+    # MNE accepts hemispheric labels as a single object that keeps the sum of all single labels
+    labels_sum = sum_labels(labels_hemi)
 
-    print('[done]')
-    return surf_src, surf_labels
+    return surface, labels_sum
 
 
 def get_brain_vol_sources(subject, fname_vol=None, json_fname='default', name_lobe_vol='Subcortical',
@@ -220,8 +313,8 @@ def get_brain_vol_sources(subject, fname_vol=None, json_fname='default', name_lo
         The filename of mri labelized
     name_lobe_vol : None | list of str | str
         Interest lobe names
-    trans : str | None
-        The filename that contains transformation matrix for surface
+    trans : str | array | None
+        The transformation matrix for surface or the filename that contains it
     fname_atlas : str | None
         The filename of the area atlas
     Returns
@@ -233,24 +326,14 @@ def get_brain_vol_sources(subject, fname_vol=None, json_fname='default', name_lo
     -------
     """
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_coords.json')
-
     print('build volume areas')
 
     assert fname_vol is not None, "error , missing volume file"
 
-    vol_src = get_volume(subject, pos=5.0, json_fname=json_fname)
+    vol_src = get_volume(subject, pos=float(space), json_fname=json_fname)
     vol_labels = get_volume_labels(vol_src)
 
-    labels_sum = []
-    for l in vol_labels:
-        if type(labels_sum) == list:
-            labels_sum = l
-        else:
-            labels_sum += l
-    vol_labels = [labels_sum.lh, labels_sum.rh]
+    vol_labels = sum_hemi_labels(vol_labels)
 
     print('[done]')
 
@@ -2,16 +2,13 @@
 #          Ruggero Basanisi <ruggero.basanisi@gmail.com>
 
 import numpy as np
-import mne
-from mne import Label
-from mne.io.constants import FIFF
 
-from nibabel import gifti
+from bv2mne.utils import  compute_trans, apply_trans_inplace, read_texture_info#
+from bv2mne.cache import read_texture
+from bv2mne.instrument import track_stage
 
-from bv2mne.utils import  compute_trans, read_texture_info#
 
-
-def get_surface(fname, subject, hemi, trans=None):
+def get_surface(fname, subject, hemi, trans=None, compact=False):
     """ Get surface whith a file
 
     Parameters
@@ -24,35 +21,56 @@ def get_surface(fname, subject, hemi, trans=None):
         Hemisphere of interest
     trans : str | array | None
         The matrix transformation or the filename to get this
+    compact : bool
+        If True, positions are kept in float32, transformed and converted to
+        meters in place (without full-size temporaries) and 'inuse' is a
+        boolean array. Peak memory stays close to one copy of the mesh.
 
     Returns
     -------
     surface : instance of mne.SourceSpace ?
         Surface source space
     """
+    import mne
+    from mne.io.constants import FIFF
 
-    try:
-        coords, triangles = mne.read_surface(fname)
-    except Exception:
+    with track_stage('surface_read', subject=subject, inputs=[fname]):
         try:
-            giftiImage = gifti.read(fname)
-
-            coords = giftiImage.darrays[0].data
-            triangles = giftiImage.darrays[1].data
+            coords, triangles = mne.read_surface(fname)
         except Exception:
-            raise Exception('surface file must be in FreeSurfer or BrainVisa format')
+            try:
+                from nibabel import gifti
+                giftiImage = gifti.read(fname)
 
-    # Apply trans to coords
-    coords = compute_trans(coords, trans) ######################
-    # coords = tranform(coords, trans)
+                coords = giftiImage.darrays[0].data
+                triangles = giftiImage.darrays[1].data
+            except Exception:
+                raise Exception('surface file must be in FreeSurfer or BrainVisa format')
 
-    # Locations in meters
-    coords = coords * 1e-3
+    if compact:
+        # Read arrays are reused when they are already float32 and writable
+        coords = np.asarray(coords, dtype=np.float32)
+        if not coords.flags.writeable or not coords.flags.c_contiguous:
+            coords = np.array(coords, dtype=np.float32, order='C')
 
-    inuse = np.ones(len(coords), dtype=int)
-    remains = len(coords)
+        # Trans and locations in meters in one pass
+        coords = apply_trans_inplace(coords, trans, scale=1e-3)
+
+        inuse = np.ones(len(coords), dtype=bool)
+        vertno = np.arange(len(coords))
+
+    else:
+        # Apply trans to coords
+        coords = compute_trans(coords, trans) ######################
+        # coords = tranform(coords, trans)
+
+        # Locations in meters
+        coords = coords * 1e-3
+
+        inuse = np.ones(len(coords), dtype=int)
+        vertno = np.where(inuse == 1)[0]
 
-    vertno = np.where(inuse == 1)[0]
+    remains = len(coords)
 
     if hemi == 'lh':
         Id = 101
@@ -74,7 +92,7 @@ def get_surface(fname, subject, hemi, trans=None):
 
 
 def get_surface_labels(surface, texture, subject='S4', hemi='lh',
-                      fname_atlas=None, fname_color=None):
+                      fname_atlas=None, fname_color=None, tex_cache_dir=None):
     """get areas on the surface
 
     Parameters
@@ -90,27 +108,30 @@ def get_surface_labels(surface, texture, subject='S4', hemi='lh',
         Filename for area atlas
     fname_color : str | None
         Filename for area color
+    tex_cache_dir : str | None
+        Folder where the parsed texture is stored as a memory-mapped .npy file
 
     Returns
     -------
     labels : instance of mne.Labels
         MarsAtlas labels for surface sources
     """
+    from mne import Label
 
     labels = []
 
     rr = surface['rr']
     # normals = surface['nn']
 
-    # Get texture with gifti format (BainVisa)= labels of MarsAtlas
+    # Get texture with gifti format (BainVisa)= labels of MarsAtlas,
+    # template textures shared by subjects are parsed once per process
     if isinstance(texture, str):
-        giftiImage = gifti.giftiio.read(texture)
-        base_values = giftiImage.darrays[0].data
+        base_values = read_texture(texture, cache_dir=tex_cache_dir)
 
     else:
         base_values = texture
 
-    values = base_values
+    values = np.asarray(base_values)
 
     # Get parcels and count the number of nodes in each parcel (count)
     parcels, counts = np.unique(values, return_counts=True)
@@ -118,12 +139,14 @@ def get_surface_labels(surface, texture, subject='S4', hemi='lh',
     # Get parcels information
     info = read_texture_info(fname_atlas, hemi)
 
-    # Get triangles for whole surface
-    triangles = surface['tris']
-    total_nodes = 0
-    for pos, val in enumerate(parcels):
+    # Keep only those nodes of each parcel that are associated with a
+    # face (triangle) lying entirely in that parcel
+    with track_stage('labeling', subject=subject, inputs=[texture, fname_atlas]):
+        parcel_vertices = get_parcel_vertices(values, surface['tris'], parcels)
+
+    for val, vertex_ind in zip(parcels, parcel_vertices):
 
-        name_process = info.get(parcels[pos], False)
+        name_process = info.get(val, False)
         if not name_process:
             name = 'no_name'
             # lobe = 'no_name'
@@ -131,52 +154,62 @@ def get_surface_labels(surface, texture, subject='S4', hemi='lh',
             name = name_process[0]
             # lobe = name_process[1]
 
-        # Find index for nodes of the parcel
-        ind = np.where(values == val)
+        # Positions and textures (values)
+        rr_parcel = rr[vertex_ind]
+        values_parcel = values[vertex_ind]
 
-        # Keep only those nodes and pos of parcel that are associated with a
-        # face (triangle) in its parcel
-        # get triangles where points of the parcel are
-        ix = np.in1d(triangles.ravel(), ind).reshape(triangles.shape)
+        label = Label(vertices=vertex_ind, pos=rr_parcel, values=values_parcel, hemi=hemi,
+                      comment=name, name=name, filename=None, subject=subject, verbose=None)
 
-        # Counting the number of True per lines --> True : 1 , False : 0
-        # to know how many points of the parcel are in each face
-        counts = ix.sum(1)
+        labels.append(label)
 
-        # Indices of each triangles that contains 3 points of the parcel
-        ind_all = np.where(counts == 3)
-        tris_cour = triangles[ind_all]
+    return labels
 
-        # Select nodes that are connected through triangles
-        nodes = np.unique(tris_cour)
-        iy = np.in1d(ind, nodes)
-        ind_n = np.where(iy)
-        ind_n = ind_n[0]
-        ind = ind[0]
 
-        # Positions and normals
-        rr_parcel = rr[ind[ind_n]]
-        # normals_parcel = normals[ind[ind_n]]
+def get_parcel_vertices(values, triangles, parcels=None):
+    """Find the vertices of each parcel connected through its own triangles
 
-        # Textures (values)
-        values_parcel = values[ind[ind_n]]
-        # values_parcel = ind                 ############check#############
+    All the parcels are resolved in a single pass over the triangle to
+    texture lookup, instead of testing the whole mesh once per parcel.
 
-        # Locations in meters
-        # rr_parcel = rr_parcel * 1e-3
+    Parameters
+    ----------
+    values : array, shape (n_vertices,)
+        Texture value (parcel) of each vertex
+    triangles : array, shape (n_triangles, 3)
+        Vertex indices of each face of the mesh
+    parcels : array | None
+        Sorted parcel values to return, if None all the values found in
+        the texture are used
 
-        # Number of nodes
-        nodes, tmp = rr_parcel.shape
-        # vertex_ind = np.arange(total_nodes, total_nodes + nodes, 1)
-        vertex_ind = ind[ind_n]
-        total_nodes = total_nodes + nodes  # (was =+???)
+    Returns
+    -------
+    parcel_vertices : list of array
+        For each parcel, the sorted indices of the vertices that belong to
+        at least one triangle whose three vertices are in the parcel
+    """
 
-        label = Label(vertices=vertex_ind, pos=rr_parcel, values=values_parcel, hemi=hemi,
-                      comment=name, name=name, filename=None, subject=subject, verbose=None)
+    values = np.asarray(values)
+    if parcels is None:
+        parcels = np.unique(values)
 
-        labels.append(label)
+    # Triangles with their three vertices in the same parcel
+    tri_values = values[triangles]
+    inside = (tri_values[:, 0] == tri_values[:, 1]) & (tri_values[:, 1] == tri_values[:, 2])
 
-    return labels
+    # Vertices connected through at least one of those triangles
+    connected = np.zeros(len(values), dtype=bool)
+    connected[triangles[inside].ravel()] = True
+    vertices = np.flatnonzero(connected)
+
+    # Group vertices by parcel in one (stable) sort, vertices stay sorted
+    # within each parcel
+    vertices = vertices[np.argsort(values[vertices], kind='stable')]
+    sorted_values = values[vertices]
+    starts = np.searchsorted(sorted_values, parcels, side='left')
+    stops = np.searchsorted(sorted_values, parcels, side='right')
+
+    return [vertices[start:stop] for start, stop in zip(starts, stops)]
 
 
 # def reject_bad_areas(surface, labels, bad):
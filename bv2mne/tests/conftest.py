@@ -0,0 +1,14 @@
+import json
+
+import pytest
+
+from bv2mne.directories import get_layout
+
+
+@pytest.fixture
+def layout(tmpdir):
+    """ Layout of a project 'meg_te' whose databases are in tmpdir """
+    json_fname = str(tmpdir.join('db_info.json'))
+    with open(json_fname, 'w') as f:
+        json.dump({'db_name': str(tmpdir), 'p_name': 'meg_te'}, f)
+    return get_layout(json_fname)
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from bv2mne.atomic import atomic_write, atomic_copy, is_complete, marker_fname
+
+
+def _write(fname, text):
+    with open(fname, 'w') as f:
+        f.write(text)
+
+
+def test_atomic_write(tmpdir):
+    fname = str(tmpdir.join('subject_01-bem-sol.fif'))
+
+    with atomic_write(fname) as fname_tmp:
+        # Temporary file next to the final one, with the same ending
+        assert os.path.dirname(fname_tmp) == str(tmpdir)
+        assert fname_tmp.endswith('-bem-sol.fif')
+        _write(fname_tmp, 'solution')
+        assert not os.path.exists(fname)
+
+    assert open(fname).read() == 'solution'
+    assert is_complete(fname)
+    assert sorted(os.listdir(str(tmpdir))) == sorted([os.path.basename(fname),
+                                                      os.path.basename(marker_fname(fname))])
+
+
+def test_atomic_write_interrupted(tmpdir):
+    fname = str(tmpdir.join('subject_01-bem-sol.fif'))
+    with atomic_write(fname) as fname_tmp:
+        _write(fname_tmp, 'solution')
+
+    # A failed writing leaves the previous file complete, without temporary file
+    with pytest.raises(RuntimeError):
+        with atomic_write(fname) as fname_tmp:
+            _write(fname_tmp, 'trunc')
+            raise RuntimeError('killed')
+    assert open(fname).read() == 'solution'
+    assert is_complete(fname)
+    assert sorted(os.listdir(str(tmpdir))) == sorted([os.path.basename(fname),
+                                                      os.path.basename(marker_fname(fname))])
+
+
+def test_is_complete(tmpdir):
+    fname = str(tmpdir.join('subject_01-surf-fwd.fif'))
+
+    # Missing file, and file without marker (written directly)
+    assert not is_complete(fname)
+    _write(fname, 'forward')
+    assert not is_complete(fname)
+
+    fname_copy = str(tmpdir.join('subject_02-surf-fwd.fif'))
+    atomic_copy(fname, fname_copy)
+    assert is_complete(fname_copy)
+
+    # File changed after its marker was written
+    _write(fname_copy, 'truncated')
+    assert not is_complete(fname_copy)
+
+
+def test_atomic_write_concurrent(tmpdir):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Writers of the same file (threads of a process, or processes) never share a temporary file
+    fname = str(tmpdir.join('atlas.json'))
+
+    def write(i):
+        with atomic_write(fname, marker=False) as fname_tmp:
+            _write(fname_tmp, 'writer {0}'.format(i) * 1000)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write, range(32)))
+
+    assert os.listdir(str(tmpdir)) == ['atlas.json']
+    text = open(fname).read()
+    assert text in ['writer {0}'.format(i) * 1000 for i in range(32)]
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from bv2mne.cache import hash_file, hash_object
+
+
+def test_hash_object():
+    a = np.arange(12.)
+    assert hash_object([a, 'x', 1]) == hash_object([a.copy(), 'x', 1])
+    assert hash_object([a, 'x', 1]) != hash_object([a.reshape(3, 4), 'x', 1])
+    assert hash_object([a, 'x', 1]) != hash_object([a.astype(np.float32), 'x', 1])
+    assert hash_object({'b': 1, 'a': None}) == hash_object({'a': None, 'b': 1})
+
+
+def test_hash_file(tmpdir):
+    fname = str(tmpdir.join('file.txt'))
+    with open(fname, 'w') as f:
+        f.write('bv2mne')
+    digest = hash_file(fname)
+    assert hash_file(fname) == digest
+    with open(fname, 'a') as f:
+        f.write('!')
+    assert hash_file(fname) != digest
+
+
+def test_read_texture(tmpdir):
+    nib = pytest.importorskip('nibabel')
+    from bv2mne.cache import read_texture, clear_texture_cache
+
+    fname = str(tmpdir.join('parcels.gii'))
+    values = np.arange(20, dtype=np.int32) % 4
+    img = nib.gifti.GiftiImage(darrays=[nib.gifti.GiftiDataArray(values)])
+    nib.save(img, fname)
+
+    cache_dir = str(tmpdir.join('cache'))
+    tex = read_texture(fname, cache_dir=cache_dir)
+    np.testing.assert_array_equal(tex, values)
+    # Same object from the process cache
+    assert read_texture(fname, cache_dir=cache_dir) is tex
+
+    # Memory-mapped sidecar once the process cache is cleared
+    clear_texture_cache()
+    tex = read_texture(fname, cache_dir=cache_dir)
+    assert isinstance(tex, np.memmap)
+    np.testing.assert_array_equal(tex, values)
@@ -0,0 +1,55 @@
+import os
+import os.path as op
+
+from bv2mne.directories import ingest_file
+
+
+def test_ingest_file(tmpdir):
+    src = str(tmpdir.join('T1.mgz'))
+    with open(src, 'w') as f:
+        f.write('volume')
+
+    for mode in ['copy', 'hardlink', 'symlink', 'reflink']:
+        dst = str(tmpdir.join('T1-{0}.mgz'.format(mode)))
+        assert ingest_file(src, dst, mode=mode)
+        with open(dst) as f:
+            assert f.read() == 'volume'
+        # Present and unchanged: skipped
+        assert not ingest_file(src, dst, mode=mode)
+
+    assert op.islink(str(tmpdir.join('T1-symlink.mgz')))
+
+    # Modified original: ingested again
+    with open(src, 'w') as f:
+        f.write('new volume')
+    os.utime(src, (0, 0))
+    assert ingest_file(src, str(tmpdir.join('T1-copy.mgz')), mode='copy')
+
+
+def test_project_layout(tmpdir, layout):
+    import pickle
+    import pytest
+    from bv2mne.directories import get_layout, read_directories
+
+    json_fname = layout.json_fname
+    assert get_layout(json_fname) is layout
+    assert get_layout(layout) is layout
+    with pytest.raises(AttributeError):
+        layout.project = 'other'
+
+    assert layout.bem_sol('subject_01') == op.join(str(tmpdir), 'db_mne', 'meg_te', 'subject_01', 'bem',
+                                                   'subject_01-bem-sol.fif')
+    assert layout.fwd('subject_01', '2', 'surf') == op.join(str(tmpdir), 'db_mne', 'meg_te', 'subject_01', 'fwd',
+                                                           '2', 'subject_01-surf-fwd.fif')
+    assert read_directories(json_fname)[4] == layout.src_dir
+    assert pickle.loads(pickle.dumps(layout)) is layout
+
+
+def test_create_sbj_db_mne_n_jobs(tmpdir):
+    import pytest
+    from bv2mne.directories import create_sbj_db_mne
+
+    with pytest.raises(ValueError, match='n_jobs'):
+        create_sbj_db_mne('subject_01', json_fname=str(tmpdir.join('db_info.json')), n_jobs=0)
+    # Nothing created
+    assert tmpdir.listdir() == []
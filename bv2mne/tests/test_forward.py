@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+from bv2mne import forward
+from bv2mne.forward import (chunked_forward_solution, _set_orientation, _source_blocks, _block_size,
+                            read_forward_model, forward_accuracy)
+
+
+def _meg_info(n_channels=30, radius=0.12):
+    k = np.arange(n_channels) + 0.5
+    z = 1. - k / n_channels * 0.9
+    theta = np.pi * (1. + np.sqrt(5.)) * k
+    pos = np.c_[np.sqrt(1. - z ** 2) * np.cos(theta), np.sqrt(1. - z ** 2) * np.sin(theta), z]
+    info = mne.create_info(['MEG{0:03d}'.format(i) for i in range(n_channels)], 1000., 'mag')
+    for ch, p in zip(info['chs'], pos):
+        ex = np.cross([0., 0., 1.], p)
+        ex = ex / np.linalg.norm(ex) if np.linalg.norm(ex) > 1e-6 else np.array([1., 0., 0.])
+        ch['loc'][:12] = np.r_[p * radius, ex, np.cross(p, ex), p]
+        ch['coord_frame'] = mne.io.constants.FIFF.FIFFV_COORD_DEVICE
+    with info._unlock() if hasattr(info, '_unlock') else np.errstate():
+        info['dev_head_t'] = mne.transforms.Transform('meg', 'head', np.eye(4))
+    return info
+
+
+def test_source_blocks():
+    src = [{'nuse': 5}, {'nuse': 0}, {'nuse': 2}]
+    assert list(_source_blocks(src, 2)) == [(0, 0, 2), (0, 2, 4), (0, 4, 5), (2, 0, 2)]
+
+
+def test_block_size():
+    info = _meg_info(n_channels=100)
+    sphere = mne.make_sphere_model(r0=(0., 0., 0.), head_radius=0.09)
+    assert _block_size(info, sphere, 1.) == 2 ** 20 // (3 * 8 * 4 * 100)
+
+    # The preparation of the BEM is paid by every block
+    bem = {'is_sphere': False, 'surfs': [{'np': 2562}]}
+    assert _block_size(info, bem, 100.) < _block_size(info, sphere, 100.)
+    assert _block_size(info, bem, 1.) == 1
+
+
+@pytest.mark.parametrize('force_fixed', [False, True])
+def test_chunked_forward_solution(tmpdir, force_fixed):
+    info = _meg_info()
+    sphere = mne.make_sphere_model(r0=(0., 0., 0.), head_radius=0.09)
+    src = mne.setup_volume_source_space(pos=20., sphere=(0., 0., 0., 0.07))
+    trans = mne.transforms.Transform('head', 'mri', np.eye(4))
+
+    fwd = _set_orientation(mne.make_forward_solution(info, trans, src, sphere), force_fixed)
+    # Tiny budget, a few sources per block
+    chunked = chunked_forward_solution(info, trans, src, sphere, mem_budget=0.01, force_fixed=force_fixed,
+                                       tmp_dir=str(tmpdir))
+
+    assert chunked['nsource'] == fwd['nsource']
+    np.testing.assert_array_equal(chunked['src'][0]['vertno'], fwd['src'][0]['vertno'])
+    np.testing.assert_allclose(chunked['source_rr'], fwd['source_rr'])
+    np.testing.assert_allclose(chunked['source_nn'], fwd['source_nn'])
+    np.testing.assert_allclose(chunked['sol']['data'], fwd['sol']['data'], rtol=1e-10, atol=1e-20)
+
+    fname = str(tmpdir.join('chunked-fwd.fif'))
+    mne.write_forward_solution(fname, chunked, overwrite=True)
+    np.testing.assert_allclose(mne.read_forward_solution(fname)['sol']['data'], fwd['sol']['data'], rtol=1e-6)
+
+
+def test_compressed_forward_accuracy(tmpdir):
+    info = _meg_info()
+    sphere = mne.make_sphere_model(r0=(0., 0., 0.), head_radius=0.09)
+    src = mne.setup_volume_source_space(pos=20., sphere=(0., 0., 0., 0.07))
+    trans = mne.transforms.Transform('head', 'mri', np.eye(4))
+    fwd = _set_orientation(mne.make_forward_solution(info, trans, src, sphere), False)
+
+    fname = str(tmpdir.join('model-fwd.fif'))
+    fname_gz = str(tmpdir.join('model-fwd.fif.gz'))
+    mne.write_forward_solution(fname, fwd, overwrite=True)
+    mne.write_forward_solution(fname_gz, fwd, overwrite=True)
+
+    # Lossless compression of the float32 gains
+    np.testing.assert_array_equal(read_forward_model(fname_gz)['sol']['data'],
+                                  read_forward_model(fname)['sol']['data'])
+
+    acc = forward_accuracy(fwd, fname_gz)
+    assert acc['max_rel_error'] < 1e-6
+    assert acc['min_corr'] > 1 - 1e-9
+    assert acc['ratio'] < forward_accuracy(fwd, fname)['ratio']
+
+
+def test_get_forward_engine(layout, monkeypatch):
+    json_fname = layout.json_fname
+
+    stamps = {'S1': [1], 'S2': [1]}
+
+    class Engine(object):
+        def __init__(self, subject, json_fname='default'):
+            self.subject = subject
+            self.stamps = self.current_stamps()
+
+        def current_stamps(self):
+            return list(stamps[self.subject])
+
+    monkeypatch.setattr(forward, 'ForwardEngine', Engine)
+    monkeypatch.setattr(forward, '_engines', forward.OrderedDict())
+
+    engine = forward.get_forward_engine('S1', json_fname=json_fname)
+    assert forward.get_forward_engine('S1', json_fname=json_fname) is engine
+
+    # Files changed: loaded again
+    stamps['S1'] = [2]
+    new_engine = forward.get_forward_engine('S1', json_fname=json_fname)
+    assert new_engine is not engine
+    assert forward.get_forward_engine('S1', json_fname=json_fname) is new_engine
+
+    # Only the engine of the current subject is kept
+    forward.get_forward_engine('S2', json_fname=json_fname)
+    assert [key[1] for key in forward._engines] == ['S2']
+
+
+def test_prune_forward_cache(tmpdir, layout):
+    import os
+    from bv2mne.atomic import write_marker
+    from bv2mne.directories import ingest_file
+
+    cache_dir = layout.fwd_cache_dir('S1')
+    os.makedirs(cache_dir)
+
+    # Entry still used by a session, entry of a session computed again
+    fname_fwd = str(tmpdir.join('S1-surf-fwd.fif'))
+    with open(fname_fwd, 'w') as f:
+        f.write('forward')
+    used = os.path.join(cache_dir, 'used-fwd.fif')
+    ingest_file(fname_fwd, used, mode='hardlink')
+    unused = os.path.join(cache_dir, 'unused-fwd.fif')
+    with open(unused, 'w') as f:
+        f.write('old forward')
+    for fname in [used, unused]:
+        write_marker(fname)
+
+    assert forward.prune_forward_cache('S1', json_fname=layout) == [unused]
+    assert sorted(os.listdir(cache_dir)) == ['used-fwd.fif', 'used-fwd.fif.ok']
+    assert forward.prune_forward_cache('S1', json_fname=layout, unused_only=False) == [used]
+    assert os.listdir(cache_dir) == []
+    assert open(fname_fwd).read() == 'forward'
+
+
+def test_forward_engine_sources(layout):
+    import os
+    from bv2mne.atomic import write_marker
+
+    # Engine with its files listed, without loading them
+    engine = forward.ForwardEngine.__new__(forward.ForwardEngine)
+    engine.subject, engine.layout = 'S1', layout
+
+    def list_sources():
+        engine.fname_src = engine._src_files()
+        engine.fname_src_ignored = sorted(set(engine._src_files(complete=False)) - set(engine.fname_src))
+        engine.src = list(engine.fname_src)
+
+    list_sources()
+    with pytest.raises(ValueError, match='No source space'):
+        engine.sources()
+
+    # Source spaces written before completion markers existed are not silently dropped
+    src_dir = layout.src_dir.format('S1')
+    os.makedirs(src_dir)
+    fname_src = os.path.join(src_dir, 'S1_surf-src.fif')
+    with open(fname_src, 'w') as f:
+        f.write('sources')
+    list_sources()
+    assert engine.fname_src_ignored == [fname_src]
+    with pytest.raises(ValueError, match='run create_source_models again'):
+        engine.sources()
+    with pytest.raises(ValueError, match='run create_source_models again'):
+        engine.forward_models('1', None)
+
+    write_marker(fname_src)
+    list_sources()
+    assert engine.sources() == [fname_src]
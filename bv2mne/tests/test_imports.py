@@ -0,0 +1,30 @@
+import json
+import os.path as op
+import subprocess
+import sys
+
+import pytest
+
+root = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+
+
+def _loaded(module):
+    """ Top-level packages loaded by importing a module in a fresh interpreter """
+    code = ('import sys, json; import {0}; '
+            'print(json.dumps(sorted(set(m.split(".")[0] for m in sys.modules))))'.format(module))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root, universal_newlines=True)
+    return set(json.loads(out.strip().splitlines()[-1]))
+
+
+@pytest.mark.parametrize('module', ['bv2mne.main', 'bv2mne.pipeline'])
+def test_entry_points_are_light(module):
+    assert not _loaded(module) & {'numpy', 'scipy', 'mne', 'nibabel', 'visbrain'}
+
+
+@pytest.mark.parametrize('module', ['bv2mne.bem', 'bv2mne.sensors', 'bv2mne.surface', 'bv2mne.volume',
+                                    'bv2mne.labels', 'bv2mne.source', 'bv2mne.forward', 'bv2mne.planning',
+                                    'bv2mne.vis'])
+def test_stages_load_mne_when_run(module):
+    # Stage modules need numpy, mne, nibabel and visbrain are imported by the functions using them
+    pytest.importorskip('numpy')
+    assert not _loaded(module) & {'scipy', 'mne', 'nibabel', 'visbrain'}
@@ -0,0 +1,123 @@
+import os
+import json
+
+import pytest
+
+from bv2mne.instrument import register_hook, unregister_hook, track_stage, JsonLinesHook
+from bv2mne.pipeline import run_graph
+
+
+def _stage(name):
+    with track_stage(name, subject='S1'):
+        pass
+
+
+def test_track_stage_event(tmpdir):
+    fname_in = str(tmpdir.join('in.txt'))
+    with open(fname_in, 'w') as f:
+        f.write('input')
+
+    events = []
+    hook = register_hook(events.append)
+    try:
+        with track_stage('labeling', subject='S1', inputs=[fname_in]) as event:
+            event['outputs'].append(str(tmpdir.join('missing.txt')))
+    finally:
+        unregister_hook(hook)
+
+    assert len(events) == 1
+    event = events[0]
+    assert event['stage'] == 'labeling' and event['subject'] == 'S1'
+    assert event['status'] == 'ok'
+    assert event['wall'] >= 0 and event['cpu'] >= 0
+    if event['max_rss_mb'] is not None:
+        assert 0 <= event['max_rss_delta_mb'] <= event['max_rss_mb']
+    assert event['input_bytes'] == 5
+    assert event['output_bytes'] is None
+
+    # No callback, no event
+    with track_stage('labeling'):
+        pass
+    assert len(events) == 1
+
+
+def test_json_lines_hook_error(tmpdir):
+    fname = str(tmpdir.join('events.jsonl'))
+    hook = register_hook(JsonLinesHook(fname))
+    try:
+        with pytest.raises(ValueError):
+            with track_stage('bem_model', subject='S1'):
+                raise ValueError
+        with track_stage('bem_solution', subject='S1'):
+            pass
+    finally:
+        unregister_hook(hook)
+
+    with open(fname) as f:
+        events = [json.loads(line) for line in f]
+    assert [e['status'] for e in events] == ['error', 'ok']
+    assert [e['stage'] for e in events] == ['bem_model', 'bem_solution']
+
+
+def test_worker_events():
+    # Events of the worker processes reach callbacks that cannot be pickled
+    events = []
+    hook = register_hook(lambda event: events.append(event))
+    try:
+        graph = {'a': (_stage, ('a',), []), 'b': (_stage, ('b',), ['a']), 'c': (_stage, ('c',), ['a'])}
+        run_graph(graph, n_jobs=2)
+    finally:
+        unregister_hook(hook)
+
+    assert sorted(e['stage'] for e in events) == ['a', 'b', 'c']
+    assert all(e['status'] == 'ok' and e['pid'] != os.getpid() for e in events)
+    assert all(e['cpu_clock'] == 'process' for e in events)
+
+
+def test_track_stage_thread_cpu():
+    import threading
+    import time
+
+    def busy(stop):
+        while not stop.is_set():
+            pass
+
+    events = []
+    hook = register_hook(events.append)
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,))
+    thread.start()
+    try:
+        # The CPU time of the other thread is not charged to the stage
+        with track_stage('labeling', subject='S1'):
+            time.sleep(0.3)
+    finally:
+        stop.set()
+        thread.join()
+        unregister_hook(hook)
+
+    assert events[0]['cpu_clock'] == 'thread'
+    assert events[0]['wall'] >= 0.3
+    assert events[0]['cpu'] < 0.1
+
+
+def test_hook_errors():
+    def failing(event):
+        raise KeyError('hook')
+
+    events = []
+    hooks = [register_hook(failing), register_hook(events.append)]
+    try:
+        # Neither replace the error of the stage nor fail a stage, the other callbacks are called
+        with pytest.warns(RuntimeWarning, match='callback'):
+            with pytest.raises(ValueError):
+                with track_stage('bem_model', subject='S1'):
+                    raise ValueError
+        with pytest.warns(RuntimeWarning, match='callback'):
+            with track_stage('bem_solution', subject='S1'):
+                pass
+    finally:
+        for hook in hooks:
+            unregister_hook(hook)
+
+    assert [e['status'] for e in events] == ['error', 'ok']
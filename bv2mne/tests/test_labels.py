@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+from bv2mne.labels import sum_labels, sum_hemi_labels, _blend_colors
+
+
+def _labels(hemis, n_parcels=6, n_vertices=50, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = []
+    for hemi in hemis:
+        parcels = rng.randint(n_parcels, size=n_vertices)
+        for p in range(n_parcels):
+            vertices = np.flatnonzero(parcels == p)
+            labels.append(mne.Label(vertices, pos=rng.randn(len(vertices), 3), values=np.full(len(vertices), p),
+                                    hemi=hemi, comment='c%d' % p, name='parcel_%d' % p if p else '',
+                                    subject='S1'))
+    return labels
+
+
+def _assert_same(a, b):
+    assert a.name == b.name and a.comment == b.comment and a.hemi == b.hemi and a.subject == b.subject
+    assert a.color == b.color
+    np.testing.assert_array_equal(a.vertices, b.vertices)
+    np.testing.assert_array_equal(a.pos, b.pos)
+    np.testing.assert_array_equal(a.values, b.values)
+
+
+def test_sum_labels():
+    labels = _labels(['lh'])
+    expected = labels[0]
+    for l in labels[1:]:
+        expected += l
+    _assert_same(sum_labels(labels), expected)
+    assert sum_labels(labels[:1]) is labels[0]
+    assert sum_labels([]) == []
+
+
+def test_sum_hemi_labels():
+    labels = _labels(['lh', 'rh'])
+    expected = labels[0]
+    for l in labels[1:]:
+        expected += l
+    lh, rh = sum_hemi_labels(labels)
+    _assert_same(lh, expected.lh)
+    _assert_same(rh, expected.rh)
+
+
+def test_blend_colors():
+    # Same colors as the addition of MNE labels
+    colors = [(1., 0., 0., 1.), (0.1, 0.8, 0.3, 0.5), (0.2, 0.2, 0.9, 1.), (0.9, 0.1, 0.6, 0.2)]
+    for c1 in colors:
+        for c2 in colors:
+            l1 = mne.Label([0], hemi='lh', color=c1)
+            l2 = mne.Label([1], hemi='lh', color=c2)
+            np.testing.assert_allclose(_blend_colors(c1, c2), (l1 + l2).color, atol=1e-12)
+    assert _blend_colors(None, colors[0]) == colors[0]
+    assert _blend_colors(None, None) is None
@@ -0,0 +1,60 @@
+import os
+
+from bv2mne.manifest import is_up_to_date, write_manifest
+
+
+def _write(fname, text):
+    with open(fname, 'w') as f:
+        f.write(text)
+
+
+def test_manifest_up_to_date(tmpdir):
+    fname_in = str(tmpdir.join('in.txt'))
+    fname_out = str(tmpdir.join('out.txt'))
+    fname_manifest = str(tmpdir.join('stage.manifest.json'))
+    _write(fname_in, 'input')
+    _write(fname_out, 'output')
+
+    assert not is_up_to_date(fname_manifest, [fname_in], [fname_out])
+    write_manifest(fname_manifest, 'stage', [fname_in], [fname_out], params={'pos': 5.})
+    assert is_up_to_date(fname_manifest, [fname_in], [fname_out], params={'pos': 5.})
+
+    # Parameters changed
+    assert not is_up_to_date(fname_manifest, [fname_in], [fname_out], params={'pos': 3.})
+
+    # Input changed
+    _write(fname_in, 'new input')
+    assert not is_up_to_date(fname_manifest, [fname_in], [fname_out], params={'pos': 5.})
+
+
+def test_manifest_missing_output(tmpdir):
+    fname_in = str(tmpdir.join('in.txt'))
+    fname_out = str(tmpdir.join('out.txt'))
+    fname_manifest = str(tmpdir.join('stage.manifest.json'))
+    _write(fname_in, 'input')
+    _write(fname_out, 'output')
+
+    write_manifest(fname_manifest, 'stage', [fname_in], [fname_out], method='hash')
+    assert is_up_to_date(fname_manifest, [fname_in], [fname_out], method='hash')
+    os.remove(fname_out)
+    assert not is_up_to_date(fname_manifest, [fname_in], [fname_out], method='hash')
+
+
+def test_manifest_output_markers(tmpdir):
+    from bv2mne.atomic import atomic_write
+
+    fname_in = str(tmpdir.join('in.txt'))
+    fname_out = str(tmpdir.join('out.txt'))
+    fname_manifest = str(tmpdir.join('stage.manifest.json'))
+    _write(fname_in, 'input')
+
+    # Output written directly, e.g. before markers existed
+    _write(fname_out, 'output')
+    write_manifest(fname_manifest, 'stage', [fname_in], [fname_out])
+    assert is_up_to_date(fname_manifest, [fname_in], [fname_out])
+    assert not is_up_to_date(fname_manifest, [fname_in], [fname_out], markers=True)
+
+    with atomic_write(fname_out) as fname_tmp:
+        _write(fname_tmp, 'output')
+    write_manifest(fname_manifest, 'stage', [fname_in], [fname_out])
+    assert is_up_to_date(fname_manifest, [fname_in], [fname_out], markers=True)
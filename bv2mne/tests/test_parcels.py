@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from bv2mne.parcels import write_parcel_index, read_parcel_index
+
+
+def test_parcel_index(tmpdir):
+    src = [{'type': 'surf', 'id': 101, 'vertno': np.arange(6), 'nuse': 6},
+           {'type': 'surf', 'id': 102, 'vertno': np.arange(4), 'nuse': 4}]
+    labels = [SimpleNamespace(hemi='lh', vertices=np.array([0, 1, 3, 4]), values=np.array([5., 5., 7., 7.])),
+              SimpleNamespace(hemi='rh', vertices=np.array([1, 2, 3]), values=np.array([5., 5., 9.]))]
+    names = {'lh': {5: 'VCcm', 7: 'Mdl'}, 'rh': {5: 'VCcm', 9: 'Sv'}}
+
+    fname = str(tmpdir.join('S1_surf-parc.npy'))
+    written = write_parcel_index(fname, src, labels, names)
+    index = read_parcel_index(fname)
+
+    assert isinstance(index.ids, np.memmap)
+    np.testing.assert_array_equal(index.ids, written.ids)
+    np.testing.assert_array_equal(index.ids, [5, 5, -1, 7, 7, -1, -1, 5, 5, 9])
+    np.testing.assert_array_equal(index.space(1), [-1, 5, 5, 9])
+
+    np.testing.assert_array_equal(index.sources(5), [0, 1, 7, 8])
+    np.testing.assert_array_equal(index.sources('VCcm', 'rh'), [7, 8])
+    assert not index.mask('unknown', 'lh').any()
+    assert index.counts() == {5: 4, 7: 2, 9: 1}
+    assert index.counts('lh') == {5: 2, 7: 2}
+    assert index.name(9, 'rh') == 'Sv'
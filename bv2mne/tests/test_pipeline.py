@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from bv2mne.pipeline import build_pipeline_graph, run_graph, _topological_order, _check_n_jobs
+
+
+def test_pipeline_graph_dependencies():
+    graph = build_pipeline_graph(['s1', 's2'], ['1', '2'], 'stim')
+    assert len(graph) == 2 * 3 + 2 * 2
+    assert graph[('fwd', 's1', '2')][2] == [('src', 's1')]
+    assert graph[('src', 's2')][2] == [('bem', 's2')]
+
+    order = _topological_order(graph)
+    for node, (func, args, deps) in graph.items():
+        for d in deps:
+            assert order.index(d) < order.index(node)
+
+
+def test_pipeline_graph_stages_selection():
+    graph = build_pipeline_graph(['s1'], ['1'], 'stim', run_stages=['fwd'])
+    assert list(graph) == [('fwd', 's1', '1')]
+    assert graph[('fwd', 's1', '1')][2] == []
+
+
+def test_run_graph_serial():
+    calls = []
+    graph = {'b': (calls.append, ('b',), ['a']),
+             'a': (calls.append, ('a',), []),
+             'c': (calls.append, ('c',), ['a', 'b'])}
+    run_graph(graph, n_jobs=1)
+    assert calls == ['a', 'b', 'c']
+
+
+def test_pipeline_graph_grouped_forwards():
+    graph = build_pipeline_graph(['s1'], ['1', '2', '3'], 'stim', group_fwd=True)
+    assert sorted(node for node in graph if node[0] == 'fwd') == [('fwd', 's1')]
+    assert graph[('fwd', 's1')][1][1] == ['1', '2', '3']
+
+
+def test_check_n_jobs():
+    assert _check_n_jobs(2) == 2
+    assert _check_n_jobs(-1) == (os.cpu_count() or 1)
+    assert _check_n_jobs(-10 ** 6) == 1
+    with pytest.raises(ValueError):
+        _check_n_jobs(0)
+    with pytest.raises(ValueError):
+        run_graph({}, n_jobs=0)
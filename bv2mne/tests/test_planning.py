@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mne')
+
+from bv2mne.planning import same_head_position
+
+
+def _rotation(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    trans = np.eye(4)
+    trans[:2, :2] = [[c, -s], [s, c]]
+    return trans
+
+
+def test_same_head_position():
+    trans = _rotation(0.1)
+    trans[:3, 3] = [0.01, 0.02, 0.04]
+
+    moved = trans.copy()
+    moved[0, 3] += 5e-4
+    assert same_head_position(trans, moved, tol_trans=1e-3)
+    moved[0, 3] += 1e-3
+    assert not same_head_position(trans, moved, tol_trans=1e-3)
+
+    rotated = np.dot(trans, _rotation(5e-4))
+    assert same_head_position(trans, rotated, tol_rot=1e-3)
+    assert not same_head_position(trans, np.dot(trans, _rotation(2e-3)), tol_rot=1e-3)
+
+    assert same_head_position(None, None)
+    assert not same_head_position(trans, None)
+
+
+def _info(name, dx=0.):
+    dev_head_t = np.eye(4)
+    dev_head_t[0, 3] = dx
+    chs = [{'ch_name': 'MEG001', 'kind': 1, 'coil_type': 3012, 'coord_frame': 1, 'loc': np.arange(12.)}]
+    return {'name': name, 'chs': chs, 'dev_head_t': {'trans': dev_head_t}}
+
+
+def test_plan_forwards(monkeypatch):
+    from bv2mne import planning
+
+    infos = {'1': _info('1'), '2': _info('2', 5e-4), '3': _info('3', 5e-3)}
+    monkeypatch.setattr(planning, 'get_layout', lambda json_fname: json_fname)
+    monkeypatch.setattr(planning, 'get_sensor_info', lambda subject, ses, ev, json_fname: infos[ses])
+
+    groups = planning.plan_forwards('S1', ['1', '2', '3'], ['stim'])
+    assert [g['members'] for g in groups] == [[('1', 'stim'), ('2', 'stim')], [('3', 'stim')]]
+    assert [g['info']['name'] for g in groups] == ['1', '3']
+
+    groups = planning.plan_forwards('S1', ['1', '2', '3'], ['stim'], tol_trans=1e-2)
+    assert len(groups) == 1
+
+    # Events of a session stay in its group (one forward model file per session), even at another head position
+    events = {('1', 'stim'): _info('1'), ('1', 'resp'): _info('1r', 5e-3), ('2', 'stim'): _info('2', 5e-3),
+              ('2', 'resp'): _info('2r')}
+    monkeypatch.setattr(planning, 'get_sensor_info', lambda subject, ses, ev, json_fname: events[(ses, ev)])
+    groups = planning.plan_forwards('S1', ['1', '2'], ['stim', 'resp'])
+    assert [g['members'] for g in groups] == [[('1', 'stim'), ('1', 'resp')], [('2', 'stim'), ('2', 'resp')]]
+    assert [g['info']['name'] for g in groups] == ['1', '2']
+
+
+def test_run_forward_plan(tmpdir, layout, monkeypatch):
+    from bv2mne import planning
+    from bv2mne.atomic import is_complete
+    from bv2mne.forward import forward_manifest
+    from bv2mne.manifest import read_manifest
+
+    class Engine(object):
+        src = [[{'type': 'surf'}], [{'type': 'vol'}]]
+        trans = None
+        fname_bem_sol = str(tmpdir.join('S1-bem-sol.fif'))
+        computed = []
+
+        def sources(self):
+            return self.src
+
+        def forward_models(self, session, info, force=False, compress=False, **kwargs):
+            self.computed.append(session)
+            for name in ['surf', 'vol']:
+                fname = layout.fwd('S1', session, name)
+                if not os.path.exists(os.path.dirname(fname)):
+                    os.makedirs(os.path.dirname(fname))
+                with open(fname, 'w') as f:
+                    f.write('{0} {1}'.format(name, session))
+
+    engine = Engine()
+    with open(engine.fname_bem_sol, 'w') as f:
+        f.write('bem')
+    monkeypatch.setattr(planning, 'get_forward_engine', lambda subject, json_fname: engine)
+    monkeypatch.setattr(planning, 'forward_digest', lambda info, *args, **kwargs: 'digest-' + info['name'])
+
+    groups = [{'members': [('1', 'stim'), ('1', 'resp'), ('2', 'stim'), ('3', 'stim')], 'info': _info('1')},
+              {'members': [('4', 'stim')], 'info': _info('4')}]
+    report = planning.run_forward_plan('S1', groups, json_fname=layout, mode='copy')
+
+    # 2 groups x 2 source spaces for the representatives, sessions 2 and 3 x 2 shared
+    assert report == {'n_members': 5, 'n_groups': 2, 'n_forwards': 4, 'n_shared': 4}
+    assert engine.computed == ['1', '4']
+
+    for ses in ['2', '3']:
+        fname = layout.fwd('S1', ses, 'surf')
+        with open(fname) as f:
+            assert f.read() == 'surf 1'
+        assert is_complete(fname)
+        # Not up to date for a forward_model run of the session alone
+        manifest = read_manifest(forward_manifest(fname, 'S1', 'surf'))
+        assert manifest['params'] == {'digest': 'digest-1', 'shared_from': '1'}
+
+    # A session cannot get its forward model from two representatives
+    groups = [{'members': [('1', 'stim'), ('2', 'stim')], 'info': _info('1')},
+              {'members': [('2', 'resp')], 'info': _info('2r')}]
+    with pytest.raises(ValueError, match='several groups'):
+        planning.run_forward_plan('S1', groups, json_fname=layout, mode='copy')
@@ -0,0 +1,41 @@
+import numpy as np
+
+from bv2mne.surface import get_parcel_vertices
+
+
+def _parcel_vertices_loop(values, triangles):
+    """Reference implementation, one pass over the mesh per parcel"""
+    parcel_vertices = []
+    for val in np.unique(values):
+        ind = np.where(values == val)
+        ix = np.in1d(triangles.ravel(), ind).reshape(triangles.shape)
+        tris_cour = triangles[np.where(ix.sum(1) == 3)]
+        nodes = np.unique(tris_cour)
+        ind_n = np.where(np.in1d(ind, nodes))[0]
+        parcel_vertices.append(ind[0][ind_n])
+    return parcel_vertices
+
+
+def test_parcel_vertices_same_as_loop():
+    rng = np.random.RandomState(42)
+    n_vertices = 500
+    triangles = rng.randint(0, n_vertices, size=(3000, 3))
+    # Spatially coherent parcels so that many triangles are fully inside one
+    values = (np.arange(n_vertices) // 25).astype(np.float32)
+    values[rng.randint(0, n_vertices, 50)] = 0.
+
+    expected = _parcel_vertices_loop(values, triangles)
+    found = get_parcel_vertices(values, triangles)
+
+    assert len(found) == len(expected)
+    for f, e in zip(found, expected):
+        np.testing.assert_array_equal(f, e)
+
+
+def test_parcel_vertices_empty_parcel():
+    values = np.array([1, 1, 1, 2, 3, 3])
+    triangles = np.array([[0, 1, 2], [2, 3, 4], [3, 4, 5]])
+    found = get_parcel_vertices(values, triangles)
+    np.testing.assert_array_equal(found[0], [0, 1, 2])
+    assert len(found[1]) == 0
+    assert len(found[2]) == 0
@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+
+from bv2mne import utils
+from bv2mne.utils import create_trans, compute_trans, apply_trans_inplace, load_trans, read_texture_info
+
+
+def _write_trm(fname, rotation, translation):
+    with open(fname, 'w') as f:
+        f.write(' '.join(str(v) for v in translation) + '\n')
+        for row in rotation:
+            f.write(' '.join(str(v) for v in row) + '\n')
+
+
+def test_create_trans_chain(tmpdir):
+    rot = np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 1.]])
+    fname_a = str(tmpdir.join('S1-a.trm'))
+    fname_b = str(tmpdir.join('S1-b.trm'))
+    _write_trm(fname_a, rot, [1., 2., 3.])
+    _write_trm(fname_b, np.eye(3), [-4., 0.5, 2.])
+    fname_ref = str(tmpdir.join('referential.txt'))
+    with open(fname_ref, 'w') as f:
+        f.write('{0}\ninv {1}\n'.format(fname_a.replace('S1', '{0}'), fname_b.replace('S1', '{0}')))
+
+    mat_a = np.eye(4)
+    mat_a[:3, :3], mat_a[:3, 3] = rot, [1., 2., 3.]
+    mat_b = np.eye(4)
+    mat_b[:3, 3] = [-4., 0.5, 2.]
+    expected = np.dot(mat_a, np.linalg.inv(mat_b))
+
+    fname_out = str(tmpdir.join('S1-trans.trm'))
+    trans = create_trans('S1', str(tmpdir), fname_ref, fname_out)
+    np.testing.assert_allclose(trans, expected)
+
+    # Text file, binary sidecar and in-memory copy agree
+    np.testing.assert_array_equal(np.loadtxt(fname_out), trans)
+    np.testing.assert_array_equal(np.load(fname_out + '.npy'), trans)
+    np.testing.assert_array_equal(load_trans(fname_out), trans)
+
+    pos = np.random.RandomState(0).randn(10, 3)
+    np.testing.assert_allclose(compute_trans(pos, fname_out), np.dot(pos, rot.T) + expected[:3, 3])
+
+
+def test_compose_trans_cache(tmpdir, monkeypatch):
+    fname_a = str(tmpdir.join('S1-a.trm'))
+    _write_trm(fname_a, np.eye(3), [1., 2., 3.])
+    fname_ref = str(tmpdir.join('referential.txt'))
+    with open(fname_ref, 'w') as f:
+        f.write('{0}\n'.format(fname_a.replace('S1', '{0}')))
+
+    calls = []
+    read_referential = utils.read_referential
+    monkeypatch.setattr(utils, 'read_referential', lambda *args: calls.append(args) or read_referential(*args))
+
+    trans = utils.compose_trans('S1', str(tmpdir), fname_ref)
+    assert utils.compose_trans('S1', str(tmpdir), fname_ref) is trans
+    assert len(calls) == 1
+
+    # Changed .trm file, the referential is not parsed again
+    _write_trm(fname_a, np.eye(3), [1., 2., 30.])
+    np.testing.assert_allclose(utils.compose_trans('S1', str(tmpdir), fname_ref)[:3, 3], [1., 2., 30.])
+    assert len(calls) == 1
+
+
+def test_apply_trans_inplace():
+    rng = np.random.RandomState(1)
+    trans = np.eye(4)
+    trans[:3, :3] = np.linalg.qr(rng.randn(3, 3))[0]
+    trans[:3, 3] = rng.randn(3) * 10.
+    pos = rng.randn(1000, 3).astype(np.float32) * 50.
+
+    expected = compute_trans(pos.astype(np.float64), trans) * 1e-3
+    res = apply_trans_inplace(pos, trans, scale=1e-3, chunk_size=128)
+    assert res is pos and res.dtype == np.float32
+    np.testing.assert_allclose(res, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_read_texture_info_sidecar(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('atlas.txt'))
+    with open(fname, 'w') as f:
+        f.write('Label Hemisphere Name Lobe\n')
+
+    calls = []
+
+    def parse(filename, hemi):
+        calls.append(hemi)
+        return {1: ['VCcm', 'Occipital']} if hemi == 'lh' else {101: ['VCcm', 'Occipital']}
+
+    monkeypatch.setattr(utils, '_parse_texture_info', parse)
+    utils._cached_texture_info.cache_clear()
+
+    assert read_texture_info(fname, 'lh') == {1: ['VCcm', 'Occipital']}
+    assert calls == ['lh', 'rh']
+
+    # Process cache, then json sidecar
+    assert read_texture_info(fname, 'rh') == {101: ['VCcm', 'Occipital']}
+    utils._cached_texture_info.cache_clear()
+    assert read_texture_info(fname, 'lh') == {1: ['VCcm', 'Occipital']}
+    assert calls == ['lh', 'rh']
+
+    # Malformed or foreign sidecars are parsed again
+    for sidecar in [{'sha1': 'x', 'lh': {}, 'rh': {}}, [1, 2], {'size': 0}]:
+        with open(fname + '.json', 'w') as f:
+            json.dump(sidecar, f)
+        utils._cached_texture_info.cache_clear()
+        assert read_texture_info(fname, 'lh') == {1: ['VCcm', 'Occipital']}
+    assert calls == ['lh', 'rh'] * 4
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+from bv2mne import vis
+
+
+def _src():
+    return [{'type': 'surf', 'id': 101, 'np': 5, 'nuse': 3, 'vertno': np.array([0, 2, 4])},
+            {'type': 'surf', 'id': 102, 'np': 4, 'nuse': 4, 'vertno': np.arange(4)},
+            {'type': 'vol', 'id': 1, 'seg_name': 'Left-Thalamus-lh', 'np': 100, 'nuse': 3,
+             'vertno': np.array([10, 11, 12])},
+            {'type': 'vol', 'id': 2, 'seg_name': 'Right-Thalamus-rh', 'np': 100, 'nuse': 2,
+             'vertno': np.array([20, 21])}]
+
+
+def _write_labels(layout, subject, surf_lh_values):
+    labels = {('surf', 'lh'): mne.Label([0, 4], values=surf_lh_values, hemi='lh'),
+              ('surf', 'rh'): mne.Label([1, 3], values=[101, 141], hemi='rh'),
+              ('vol', 'lh'): mne.Label([10, 12], values=[200, 206], hemi='lh'),
+              ('vol', 'rh'): mne.Label([21], values=[207], hemi='rh')}
+    for (kind, hemi), label in labels.items():
+        mne.write_label(layout.label(subject, kind, hemi), label)
+
+
+def test_set_marsatlas(tmpdir, layout):
+    tmpdir.mkdir('db_mne').mkdir('meg_te').mkdir('S1').mkdir('src')
+    _write_labels(layout, 'S1', [1, 5])
+
+    cortical, subcortical = vis._marsatlas_palettes()
+    rgb = vis.set_marsatlas('S1', _src(), json_fname=layout)
+
+    # Every vertex of the surfaces, used sources of the volumes
+    assert rgb.shape == (5 + 4 + 3 + 2, 3)
+    assert not rgb.flags.writeable
+    expected = np.ones((14, 3))
+    expected[[0, 4]] = cortical[[0, 4]]
+    expected[[5 + 1, 5 + 3]] = cortical[[0, 40]]
+    expected[[9, 11]] = subcortical[[0, 6]]
+    expected[13] = subcortical[0]
+    np.testing.assert_array_equal(rgb, expected)
+
+    assert vis.set_marsatlas('S1', _src(), json_fname=layout) is rgb
+    np.testing.assert_array_equal(vis.set_marsatlas('S1', _src(), hemi='rh', json_fname=layout),
+                                  expected[[5, 6, 7, 8, 12, 13]])
+
+    # New labels: colors computed again, the old ones are dropped
+    n_cached = len(vis._marsatlas_cache)
+    _write_labels(layout, 'S1', [2, 5])
+    new_rgb = vis.set_marsatlas('S1', _src(), json_fname=layout)
+    np.testing.assert_array_equal(new_rgb[0], cortical[1])
+    assert len(vis._marsatlas_cache) == n_cached
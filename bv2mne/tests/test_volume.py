@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip('mne')
+
+from bv2mne.volume import _set_marsatlas_names, aseg_labels, marsatlas_labels
+
+
+def test_set_marsatlas_names():
+    # Names follow the aseg name of each source space, not its position
+    spaces = [{'seg_name': name} for name in reversed(aseg_labels)]
+    _set_marsatlas_names(spaces)
+    assert [s['seg_name'] for s in spaces] == list(reversed(marsatlas_labels))
+
+    # A structure dropped by MNE is reported
+    spaces = [{'seg_name': name} for name in aseg_labels[1:]]
+    with pytest.raises(ValueError, match='one volume source space per structure'):
+        _set_marsatlas_names(spaces)
+    assert spaces[0]['seg_name'] == aseg_labels[1]
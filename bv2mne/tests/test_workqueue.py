@@ -0,0 +1,121 @@
+import os
+import time
+
+from bv2mne.workqueue import TaskLock, task_name
+
+
+def test_task_name():
+    assert task_name(('fwd', 'subject_01', 2)) == 'fwd-subject_01-2'
+
+
+def test_task_lock(tmpdir):
+    fname = str(tmpdir.join('src-s1.lock'))
+    lock = TaskLock(fname, stale_timeout=60., heartbeat=0.05)
+    other = TaskLock(fname, stale_timeout=60.)
+
+    assert lock.acquire()
+    assert lock.owned() and not other.owned()
+    assert not other.acquire()
+
+    # Heartbeat keeps the lock fresh
+    os.utime(fname, (time.time() - 30., time.time() - 30.))
+    time.sleep(0.2)
+    assert time.time() - os.stat(fname).st_mtime < 1.
+
+    lock.release()
+    assert not os.path.exists(fname)
+    assert other.acquire()
+    other.release()
+
+
+def test_task_lock_stale_recovery(tmpdir):
+    fname = str(tmpdir.join('bem-s1.lock'))
+    dead = TaskLock(fname, stale_timeout=10.)
+    assert dead._create()
+    os.utime(fname, (time.time() - 100., time.time() - 100.))
+
+    lock = TaskLock(fname, stale_timeout=10.)
+    assert lock.is_stale()
+    assert lock.acquire()
+    assert lock.owned() and not dead.owned()
+    lock.release()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_task_lock_not_refreshed_once_taken_over(tmpdir):
+    fname = str(tmpdir.join('fwd-s1.lock'))
+    lock = TaskLock(fname, stale_timeout=60., heartbeat=0.05)
+    assert lock.acquire()
+
+    # Lock recovered by another worker, then left to age
+    other = TaskLock(fname, stale_timeout=60.)
+    os.remove(fname)
+    assert other._create()
+    os.utime(fname, (time.time() - 30., time.time() - 30.))
+    time.sleep(0.2)
+    assert time.time() - os.stat(fname).st_mtime > 20.
+
+    lock.release()
+    assert other.owned()
+
+
+def _worker_graph(layout, monkeypatch, fail=()):
+    from bv2mne import workqueue
+
+    calls = []
+
+    def stage(name):
+        def func(*args):
+            calls.append(name)
+            if name in fail:
+                raise RuntimeError(name)
+        return func
+
+    # Same arguments as the stages of build_pipeline_graph
+    graph = {('bem', 's1'): (stage('bem'), ('s1', layout, False), []),
+             ('src', 's1'): (stage('src'), ('s1', layout, False), [('bem', 's1')]),
+             ('fwd', 's1', '1'): (stage('fwd-1'), ('s1', '1', 'stim', layout, False), [('src', 's1')]),
+             ('fwd', 's1', '2'): (stage('fwd-2'), ('s1', '2', 'stim', layout, False), [('src', 's1')])}
+    monkeypatch.setattr(workqueue, 'build_pipeline_graph', lambda *args, **kwargs: graph)
+    return calls
+
+
+def test_run_worker(layout, monkeypatch):
+    from bv2mne.workqueue import run_worker
+
+    calls = _worker_graph(layout, monkeypatch)
+    status = run_worker(['s1'], ['1', '2'], 'stim', json_fname=layout, poll=0.01)
+    assert calls == ['bem', 'src', 'fwd-1', 'fwd-2']
+    assert set(status.values()) == {'done'}
+
+    # Done tasks are not run again
+    run_worker(['s1'], ['1', '2'], 'stim', json_fname=layout, poll=0.01)
+    assert len(calls) == 4
+
+    # Forced stage
+    run_worker(['s1'], ['1', '2'], 'stim', json_fname=layout, force_stages=['fwd'], poll=0.01)
+    assert calls[4:] == ['fwd-1', 'fwd-2']
+
+    # Changed input of the BEM
+    fname_surf = os.path.join(layout.fs_subjects_dir(), 's1', 'bem', 'inner_skull.surf')
+    os.makedirs(os.path.dirname(fname_surf))
+    with open(fname_surf, 'w') as f:
+        f.write('surface')
+    run_worker(['s1'], ['1', '2'], 'stim', json_fname=layout, poll=0.01)
+    assert calls[6:] == ['bem']
+
+
+def test_run_worker_failure(layout, monkeypatch):
+    from bv2mne.workqueue import run_worker
+
+    calls = _worker_graph(layout, monkeypatch, fail=('src',))
+    status = run_worker(['s1'], ['1', '2'], 'stim', json_fname=layout, poll=0.01)
+
+    # Tasks depending on a failed one are not run, the worker does not wait for them
+    assert calls == ['bem', 'src']
+    assert status[('src', 's1')] == 'failed'
+    assert status[('fwd', 's1', '1')] == status[('fwd', 's1', '2')] == 'pending'
+
+    # Failed tasks are run again on request
+    run_worker(['s1'], ['1', '2'], 'stim', json_fname=layout, poll=0.01, retry_failed=True)
+    assert calls == ['bem', 'src', 'src']
@@ -1,26 +1,30 @@
 # Authors: David Meunier <david.meunier@univ-amu.fr>
 #          Ruggero Basanisi <ruggero.basanisi@gmail.com>
 
-import mne
+import json
+from functools import lru_cache
+
 import numpy as np
 from numpy.linalg import inv
 
-from nibabel.affines import apply_affine
-
-from mne.transforms import write_trans, read_trans
+# mne and nibabel are imported by the functions using them, the module is
+# imported by light entry points (command line, pipeline workers)
 # from vispy.visuals.transforms import MatrixTransform
 
 from bv2mne.directories import *
+from bv2mne.cache import hash_file, file_stamp
+from bv2mne.atomic import atomic_write
 
 
-def create_trans(subject, database, fname, fname_out):
-    """
-       Get transformations of the surface from a file that containes filename
-       matrix transformations
+def read_referential(subject, database, fname):
     """
-    trans_list = []
+       Get the transformation files listed in a referential file, each line
+       is a filename (formatted with the subject name) optionally preceded
+       by 'inv' if the transformation has to be inverted
 
-    print(fname)
+       Returns the list of (filename, inv_bool)
+    """
+    referential = []
 
     with open(fname, 'r') as textfile:
         trans_name = textfile.read().strip().split("\n")
@@ -47,62 +51,167 @@ def create_trans(subject, database, fname, fname_out):
                 assert os.path.exists(format_name), "Breaking, even when add \
                     subject_dir, file {} do not exists".format(name)
 
-            with open(format_name, 'r') as matfile:
-                lines = matfile.read().strip().split("\n")
-                lines_list = [l.split() for l in lines]
-                translation = lines_list.pop(0)
+            referential.append((format_name, inv_bool))
 
-                # transpose the rotations
-                transpose = list(zip(*lines_list))
+    return referential
 
-                # append translations
-                transpose.append(translation)
 
-                # create the matrix
-                mat_str = np.array(list(zip(*transpose)))
-                mat = mat_str.astype(np.float)
-                mat = np.vstack([mat, [0, 0, 0, 1]])
+# Composed BV->FS transformations of this process, keyed by referential and
+# by matrix file, with the stamps of the files they were read from
+_trans_cache = {}
 
-                if inv_bool:
-                    mat = inv(mat)
 
-                # add line por computing translation
-                trans_list.append(mat)
+def read_trm(fname):
+    """
+       Read a BrainVISA .trm file as a 4x4 affine matrix: the first line is
+       the translation, the three next ones are the rows of the rotation
+    """
+    lines = np.loadtxt(fname, dtype=np.float64, ndmin=2)
+    mat = np.eye(4)
+    mat[:3, :3] = lines[1:4]
+    mat[:3, 3] = lines[0]
+    return mat
 
-        trans = None
-        for trans_cour in trans_list:
-            if trans is None:
-                trans = trans_cour
-            else:
-                trans = np.dot(trans, trans_cour)
 
-    if fname_out.endswith('fif'):
-        write_trans(fname_out, trans)
+def compose_trans(subject, database, fname):
+    """
+       Compose the chain of transformations listed in a referential file.
+       The matrix is computed once per process as long as the referential
+       and the .trm files it lists did not change.
 
+       Returns the 4x4 matrix (read-only, shared)
+    """
+    # The referential is parsed again only when it changes
+    ref_key = ('referential', subject, database, op.abspath(fname))
+    ref_stamp = file_stamp(fname)
+    cached = _trans_cache.get(ref_key)
+    if cached is not None and cached[0] == ref_stamp:
+        referential = cached[1]
     else:
-        with open(fname_out, 'w') as matfile:
-            # un autre nom semblerait judiceiux pour eviter la confuson
-            # avec le matfile de la partie precedente de la fonction
-            for i in range(len(trans)):
-                for j in range(len(trans[i])):
-                    matfile.write(str(trans[i][j])+' ')
-                matfile.write('\n')
+        referential = read_referential(subject, database, fname)
+        _trans_cache[ref_key] = (ref_stamp, referential)
+
+    key = ('chain', subject, op.abspath(fname))
+    stamps = [ref_stamp] + [(f, inv_bool, file_stamp(f)) for f, inv_bool in referential]
 
+    cached = _trans_cache.get(key)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+
+    trans = np.eye(4)
+    for format_name, inv_bool in referential:
+        mat = read_trm(format_name)
+        if inv_bool:
+            mat = inv(mat)
+        trans = np.dot(trans, mat)
+
+    trans.flags.writeable = False
+    _trans_cache[key] = (stamps, trans)
     return trans
 
 
+def create_trans(subject, database, fname, fname_out):
+    """
+       Get transformations of the surface from a file that containes filename
+       matrix transformations
+
+       The composed matrix is written to fname_out (.fif or text) and, for a
+       text file, to a binary sidecar ('<fname_out>.npy') read back by
+       load_trans. Nothing is written if fname_out already holds the matrix.
+    """
+    print(fname)
+
+    trans = compose_trans(subject, database, fname)
+
+    if fname_out.endswith('fif'):
+        from mne.transforms import write_trans
+        with atomic_write(fname_out) as fname_tmp:
+            write_trans(fname_tmp, trans)
+        return trans
+
+    try:
+        same = np.array_equal(load_trans(fname_out), trans)
+    except (OSError, ValueError):
+        same = False
+
+    if not same:
+        with atomic_write(fname_out) as fname_tmp:
+            np.savetxt(fname_tmp, trans, fmt='%.17g')
+        _write_trans_sidecar(fname_out, trans)
+        _trans_cache[('file', op.abspath(fname_out))] = (file_stamp(fname_out), trans)
+
+    return trans
+
+
+def _write_trans_sidecar(fname, trans):
+    """ Binary copy of a text transformation, written atomically """
+    fname_npy = fname + '.npy'
+    try:
+        with atomic_write(fname_npy, marker=False) as fname_tmp:
+            np.save(fname_tmp, np.asarray(trans, dtype=np.float64))
+    except OSError:
+        print('Transformation sidecar could not be written, {0}'.format(fname_npy))
+
+
+def load_trans(trans):
+    """
+       Get a 4x4 transformation matrix from an array, a .fif file or a text
+       file. Text files are parsed once per process, or read from their
+       binary sidecar when it is not older than the file.
+
+       Returns the matrix (read-only for files, shared)
+    """
+    if not isinstance(trans, str):
+        return np.asarray(trans)
+
+    if trans.endswith('fif'):
+        from mne.transforms import read_trans
+        return read_trans(trans)['trans']
+
+    key = ('file', op.abspath(trans))
+    stamp = file_stamp(trans)
+    cached = _trans_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    fname_npy = trans + '.npy'
+    if op.isfile(fname_npy) and os.stat(fname_npy).st_mtime_ns >= stamp[1]:
+        mat = np.load(fname_npy)
+    else:
+        mat = np.loadtxt(trans, dtype=np.float64, ndmin=2)
+        _write_trans_sidecar(trans, mat)
+
+    mat.flags.writeable = False
+    _trans_cache[key] = (stamp, mat)
+    return mat
+
+
 def compute_trans(pos, trans):
-    pos = pos.copy()
-    if isinstance(trans, str):
-        if trans.endswith('fif'):
-            trans = read_trans(trans)['trans']
-        else:
-            with open(trans, 'r') as matfile:
-                lines = matfile.read().strip().split("\n")
-                trans = [l.split() for l in lines]
-                trans = np.array(trans).astype(np.float)
+    """
+       Apply a transformation (array or filename) to positions, returns a
+       new array
+    """
+    from nibabel.affines import apply_affine
+    return apply_affine(load_trans(trans), pos)
+
+
+def apply_trans_inplace(pos, trans=None, scale=1., chunk_size=2 ** 16):
+    """
+       Apply a transformation followed by a scaling to positions, in place
+       and by chunks, so that only a chunk-sized temporary is allocated.
+       The scaling is folded into the matrix.
+
+       pos must be a writable float array, it is returned
+    """
+    mat = np.eye(4) if trans is None else np.array(load_trans(trans), dtype=np.float64)
+    mat[:3] *= scale
+    rot, translation = mat[:3, :3].T.astype(pos.dtype), mat[:3, 3].astype(pos.dtype)
+
+    for start in range(0, len(pos), chunk_size):
+        chunk = pos[start:start + chunk_size]
+        chunk[...] = np.dot(chunk, rot)
+        chunk += translation
 
-    pos = apply_affine(trans, pos)
     return pos
 
 
@@ -124,6 +233,73 @@ def compute_trans(pos, trans):
 
 
 def read_texture_info(filename, hemi):
+    """
+        Read file with informations for each parcels
+
+        The parsed atlas is kept in memory and in a json sidecar next to the
+        file ('<filename>.json'), valid as long as the size and modification
+        time of the file, or else its content hash, did not change. The
+        spreadsheet is then parsed only once.
+    """
+    if filename is None:
+        return {}
+    if hemi not in ['lh', 'rh']:
+        raise ValueError('hemi must be lh or rh')
+
+    info_dict = _cached_texture_info(op.abspath(filename), file_stamp(filename))[hemi]
+
+    # Copy, the cached table is shared
+    return {key: list(val) for key, val in info_dict.items()}
+
+
+@lru_cache(maxsize=16)
+def _cached_texture_info(filename, stamp):
+    """
+        Parsed atlas of both hemispheres, from the json sidecar if it is
+        still valid or from the file itself
+    """
+    fname_json = filename + '.json'
+    size, mtime_ns = stamp
+
+    sidecar = None
+    if op.isfile(fname_json):
+        try:
+            with open(fname_json, 'r') as f:
+                sidecar = json.load(f)
+        except ValueError:
+            sidecar = None
+
+    # Malformed or foreign sidecars are stale, the atlas is parsed again
+    if not (isinstance(sidecar, dict) and all(isinstance(sidecar.get(hemi), dict) for hemi in ['lh', 'rh'])):
+        sidecar = None
+
+    digest = None
+    if sidecar is not None and [sidecar.get('size'), sidecar.get('mtime_ns')] != [size, mtime_ns]:
+        # File touched or copied, its content may still be the same
+        digest = hash_file(filename)
+        if digest != sidecar.get('sha1'):
+            sidecar = None
+
+    if sidecar is None:
+        sidecar = {'sha1': digest if digest is not None else hash_file(filename)}
+        for hemi in ['lh', 'rh']:
+            sidecar[hemi] = {str(key): val for key, val in _parse_texture_info(filename, hemi).items()}
+    elif digest is None:
+        # Sidecar up to date, nothing to write
+        return {hemi: {int(key): val for key, val in sidecar[hemi].items()} for hemi in ['lh', 'rh']}
+
+    sidecar['size'], sidecar['mtime_ns'] = size, mtime_ns
+    try:
+        with atomic_write(fname_json, marker=False) as fname_tmp:
+            with open(fname_tmp, 'w') as f:
+                json.dump(sidecar, f)
+    except OSError:
+        print('Atlas sidecar could not be written, {0}'.format(fname_json))
+
+    return {hemi: {int(key): val for key, val in sidecar[hemi].items()} for hemi in ['lh', 'rh']}
+
+
+def _parse_texture_info(filename, hemi):
     """
         Read file with informations for each parcels
         (DM): fonction un peu bizarre,
@@ -1,13 +1,21 @@
-from bv2mne.directories import read_directories
+from bv2mne.directories import get_layout
+from bv2mne.parcels import read_parcel_index, build_parcel_index, _space_hemi, no_parcel
+from bv2mne.cache import file_stamp
+from bv2mne.atomic import is_complete
 import os.path as op
 import numpy as np
-import mne
-from visbrain.objects import *
+
+# MarsAtlas palettes and colors of the sources, last ones per project, subject and hemisphere
+_palettes = []
+_marsatlas_cache = {}
 
 
 # def visualize_objects(subject, brain=True, bem=False, surf_src=False)
 
 def visualize_bem(bem_dir, subject, vis_as='src', color='green', preview=True):
+    # visbrain (and its OpenGL backend) is only loaded when something is displayed
+    import mne
+    from visbrain.objects import SourceObj, BrainObj
     bem = mne.read_bem_surfaces(op.join(bem_dir.format(subject), '{0}-bem-model.fif'.format(subject)))
     if vis_as == 'src':
         im_bem = SourceObj('bem', bem[0]['rr'], color=color, alpha=1., symbol='diamond', radius_min=3.)
@@ -21,6 +29,8 @@ def visualize_bem(bem_dir, subject, vis_as='src', color='green', preview=True):
 
 
 def visualize_cortical_src(src_dir, subject, hemi='both', color='marsatlas', preview=True):
+    import mne
+    from visbrain.objects import SourceObj
     src = mne.read_source_spaces(op.join(src_dir.format(subject), '{0}_surf-src.fif'.format(subject)))
     if hemi == 'both':
         rr = np.vstack((src[0]['rr'], src[1]['rr']))
@@ -41,6 +51,8 @@ def visualize_cortical_src(src_dir, subject, hemi='both', color='marsatlas', pre
 
 
 def visualize_brain(src_dir, subject, hemi='both', translucent=False, preview=True):
+    import mne
+    from visbrain.objects import BrainObj
     src = mne.read_source_spaces(op.join(src_dir.format(subject), '{0}_surf-src.fif'.format(subject)))
     if hemi == 'both':
         rr = np.vstack((src[0]['rr'], src[1]['rr']))
@@ -63,68 +75,112 @@ def visualize_brain(src_dir, subject, hemi='both', translucent=False, preview=Tr
     return im_brain
 
 
-def set_marsatlas(subject, src, hemi='both', json_fname='default'):
+def _marsatlas_palettes():
+    """ Cortical and subcortical MarsAtlas colors, loaded once """
+    if not _palettes:
+        read_dir = op.join(op.dirname(op.abspath(__file__)), 'textures')
+        _palettes.extend([np.load(op.join(read_dir, 'cortical.npy')),
+                          np.load(op.join(read_dir, 'subcortical.npy'))])
+    return _palettes
+
+
+def _parcel_ids(layout, subject, kind, spaces):
+    """ Parcel id of the used sources of the source spaces of one kind, from the
+    parcel index when it exists, else from the labels """
+    import mne
+    fname_parc = layout.parcels(subject, kind)
+    if is_complete(fname_parc):
+        index = read_parcel_index(fname_parc)
+        if [sp['nuse'] for sp in index.spaces] == [s['nuse'] for s in spaces]:
+            return [np.asarray(index.space(i)) for i in range(len(spaces))]
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_coords.json')
+    labels = [mne.read_label(layout.label(subject, kind, h)) for h in ['lh', 'rh']
+              if op.isfile(layout.label(subject, kind, h))]
+    ids, index_spaces = build_parcel_index(spaces, labels)
+    return [ids[sp['offset']:sp['offset'] + sp['nuse']] for sp in index_spaces]
 
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
 
-    read_dir = op.abspath(__file__).replace('vis.py', 'textures')
-    cortical_text = np.load(op.join(read_dir, 'cortical.npy'))
-    subcort_text = np.load(op.join(read_dir, 'subcortical.npy'))
+def set_marsatlas(subject, src, hemi='both', json_fname='default'):
+    """ MarsAtlas color of the sources
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    src : instance of SourceSpaces
+        Source spaces of the subject
+    hemi : 'both' | 'lh' | 'rh'
+        Hemisphere(s) of interest
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+
+    Returns
+    -------
+    rgb_marsatlas : array, shape (n_sources, 3)
+        Color of each vertex of the cortical source spaces and of each source of
+        the subcortical ones (white outside the parcels), read-only and shared by
+        the calls with the same subject and files. Only the colors of the latest
+        files are kept for each subject and hemisphere
+    """
+
+    layout = get_layout(json_fname)
+    hemis = ['lh', 'rh'] if hemi == 'both' else [hemi]
+
+    # Colors are computed again only when the labels or the parcel index change
+    files = [layout.label(subject, kind, h) for kind in ['surf', 'vol'] for h in ['lh', 'rh']] + \
+            [layout.parcels(subject, kind) for kind in ['surf', 'vol']]
+    slot = (layout.json_fname, subject, hemi)
+    key = (tuple((s['type'], int(s['id']), s.get('seg_name'), s['np'], s['nuse']) for s in src),
+           tuple((f, file_stamp(f)) for f in files if op.isfile(f)))
+    cached = _marsatlas_cache.get(slot)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    cortical_text, subcort_text = _marsatlas_palettes()
+
+    # Parcel ids are 1-41 (lh) and 101-141 (rh) for cortical parcels, 200-206 (lh)
+    # and 207-213 (rh) for subcortical structures
+    offsets = {('surf', 'lh'): 1, ('surf', 'rh'): 101, ('vol', 'lh'): 200, ('vol', 'rh'): 207}
+
+    ids = {}
+    for kind in ['surf', 'vol']:
+        spaces = [s for s in src if s['type'] == kind]
+        if spaces:
+            ids[kind] = dict(zip([id(s) for s in spaces], _parcel_ids(layout, subject, kind, spaces)))
 
     rgb_marsatlas = []
     for s in src:
+        h = _space_hemi(s)
+        if s['type'] not in ids or h not in hemis:
+            continue
+
         if s['type'] == 'surf':
+            # Every vertex of the surface is displayed
             textures = cortical_text
-            if (hemi == 'both' or hemi == 'lh') and s['id'] == 101:
-                labels_lh = mne.read_label(op.join(src_dir.format(subject),
-                                                   '{0}_{1}-lab-lh.label'.format(subject, s['type'])))
-                all_src = np.full((s['np'], 3), 1.)
-                for v, p in zip(labels_lh.vertices, labels_lh.values - 1):
-                    all_src[int(v), :] = textures[int(p), :]
-                rgb_marsatlas.append(all_src)
-
-            if (hemi == 'both' or hemi == 'rh') and s['id'] == 102:
-                labels_rh = mne.read_label(op.join(src_dir.format(subject),
-                                                   '{0}_{1}-lab-rh.label'.format(subject, s['type'])))
-                all_src = np.full((s['np'], 3), 1.)
-                for v, p in zip(labels_rh.vertices, labels_rh.values - 101):
-                    all_src[int(v), :] = textures[int(p), :]
-                rgb_marsatlas.append(all_src)
-
-        if s['type'] == 'vol':
+            all_src = np.full((s['np'], 3), 1.)
+            rows = np.asarray(s['vertno'])
+        else:
             textures = subcort_text
-            if (hemi == 'both' or hemi == 'lh') and s['seg_name'].endswith('lh'):
-                labels_lh = mne.read_label(op.join(src_dir.format(subject),
-                                                   '{0}_{1}-lab-lh.label'.format(subject, s['type'])))
-                all_src = np.full((labels_lh.pos.shape[0], 3), 1.)
-                for v, p in zip(labels_lh.vertices, labels_lh.values - 200):
-                    all_src[int(v), :] = textures[int(p), :]
-                rgb_marsatlas.append(all_src)
-
-            if (hemi == 'both' or hemi == 'rh') and s['seg_name'].endswith('rh'):
-                labels_rh = mne.read_label(op.join(src_dir.format(subject),
-                                                   '{0}_{1}-lab-rh.label'.format(subject, s['type'])))
-                all_src = np.full((labels_rh.pos.shape[0], 3), 1.)
-                for v, p in zip(labels_rh.vertices, labels_rh.values - 208):
-                    all_src[int(v), :] = textures[int(p), :]
-                rgb_marsatlas.append(all_src)
+            all_src = np.full((s['nuse'], 3), 1.)
+            rows = np.arange(s['nuse'])
+
+        space_ids = ids[s['type']][id(s)]
+        valid = space_ids != no_parcel
+        all_src[rows[valid]] = textures[space_ids[valid].astype(int) - offsets[(s['type'], h)]]
+        rgb_marsatlas.append(all_src)
 
     rgb_marsatlas = np.vstack(tuple(rgb_marsatlas))
-    rgb_marsatlas = list(rgb_marsatlas)
+    rgb_marsatlas.flags.writeable = False
+    # Replaces the colors computed from older files
+    _marsatlas_cache[slot] = (key, rgb_marsatlas)
 
     return rgb_marsatlas
 
 def visualize_objects(subject, bem, sources, brain, color='marsatlas', json_fname='default'):
+    from visbrain.objects import SceneObj
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_coords.json')
-
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
+    layout = get_layout(json_fname)
+    src_dir, bem_dir = layout.src_dir, layout.bem_dir
 
     so = SceneObj()
     im_objects = []
@@ -5,7 +5,7 @@ from bv2mne.directories import *
 
 import numpy as np
 
-import mne
+from bv2mne.instrument import track_stage
 
 aseg_labels = ['Left-Accumbens-area',
                'Left-Amygdala',
@@ -218,6 +218,7 @@ marsatlas_labels = ['NAc_lh',
 #
 #
 def get_volume_labels(volume):
+    import mne
     labels = []
     for val, vol in enumerate(volume):
         vertices = np.sort(vol['vertno'])
@@ -238,32 +239,83 @@ def get_volume_labels(volume):
     return labels
 
 
-def get_volume(subject, pos=5.0, json_fname='default'):
+def _set_marsatlas_names(vol_src_space):
+    """ Replace the aseg names ('seg_name') of the volume source spaces by their MarsAtlas names
 
-    if json_fname == 'default':
-        read_dir = op.join(op.abspath(__package__), 'config')
-        json_fname = op.join(read_dir, 'db_coords.json')
+    Each source space is renamed from its own aseg name, whatever the order in which MNE
+    returned them. Every structure of aseg_labels must have exactly one source space.
+    """
+    aseg2marsatlas = dict(zip(aseg_labels, marsatlas_labels))
 
-    database, project, db_mne, db_bv, db_fs = read_databases(json_fname)
-    raw_dir, prep_dir, trans_dir, mri_dir, src_dir, bem_dir, fwd_dir, hga_dir = read_directories(json_fname)
+    seg_names = [vol_label['seg_name'] for vol_label in vol_src_space]
+    if sorted(seg_names) != sorted(aseg_labels):
+        raise ValueError('Expected one volume source space per structure of {0}, got {1}'.format(
+            aseg_labels, seg_names))
 
-    fname_bem_model = op.join(bem_dir.format(subject), '{0}-bem-model.fif'.format(subject))
+    for vol_label in vol_src_space:
+        vol_label['seg_name'] = aseg2marsatlas[vol_label['seg_name']]
 
-    fname_aseg = op.join(mri_dir.format(subject), 'aseg.mgz')
 
-    vol_src_space = []
-    for al, ml in zip(aseg_labels, marsatlas_labels):
-        vol_label = mne.setup_volume_source_space(subject,
-                                                  mri=fname_aseg,
-                                                  pos=pos,
-                                                  bem=fname_bem_model,
-                                                  volume_label=al,
-                                                  subjects_dir=op.join(db_mne, project))
+def get_volume(subject, pos=5.0, json_fname='default', single_pass=True):
+    """ Create the volume source spaces of the subcortical structures
 
-        vol_label[0]['seg_name'] = ml
+    Parameters
+    ----------
+    subject : str
+        The name of the subject
+    pos : float
+        Distance between sources, in mm
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    single_pass : bool
+        If True, the segmentation and the BEM are read once and a single grid is
+        shared by all the structures (needs MNE >= 0.21), otherwise one source
+        space is set up for each structure independently
 
-        if type(vol_src_space) == list:
-            vol_src_space = vol_label
-        else: vol_src_space += vol_label
+    Returns
+    -------
+    vol_src_space : instance of mne.SourceSpaces
+        One volume source space per structure, with MarsAtlas names as 'seg_name'
+    """
+    import mne
+
+    layout = get_layout(json_fname)
+
+    fname_bem_model = layout.bem_model(subject)
+
+    fname_aseg = layout.aseg(subject)
+
+    # Several volume labels in one call are supported from MNE 0.21
+    if single_pass and tuple(int(v) for v in mne.__version__.split('.')[:2]) < (0, 21):
+        single_pass = False
+
+    with track_stage('volume_setup', subject=subject, inputs=[fname_aseg, fname_bem_model]):
+        if single_pass:
+            # Same grid and inside-skull test for every structure, each grid point
+            # goes to the source space of its segmentation label
+            vol_src_space = mne.setup_volume_source_space(subject,
+                                                          mri=fname_aseg,
+                                                          pos=pos,
+                                                          bem=fname_bem_model,
+                                                          volume_label=aseg_labels,
+                                                          subjects_dir=layout.mne_subjects_dir())
+            _set_marsatlas_names(vol_src_space)
+
+            return vol_src_space
+
+        vol_src_space = []
+        for al, ml in zip(aseg_labels, marsatlas_labels):
+            vol_label = mne.setup_volume_source_space(subject,
+                                                      mri=fname_aseg,
+                                                      pos=pos,
+                                                      bem=fname_bem_model,
+                                                      volume_label=al,
+                                                      subjects_dir=layout.mne_subjects_dir())
+
+            vol_label[0]['seg_name'] = ml
+
+            if type(vol_src_space) == list:
+                vol_src_space = vol_label
+            else: vol_src_space += vol_label
 
     return vol_src_space
@@ -0,0 +1,341 @@
+# Authors: David Meunier <david.meunier@univ-amu.fr>
+#          Ruggero Basanisi <ruggero.basanisi@gmail.com>
+
+import os
+import os.path as op
+import json
+import glob
+import hashlib
+import time
+import socket
+import threading
+import traceback
+import uuid
+
+from bv2mne.directories import get_layout, ProjectLayout
+from bv2mne.atomic import atomic_write
+from bv2mne.pipeline import build_pipeline_graph, _topological_order
+
+# Status of the tasks in the queue
+status_names = ['pending', 'running', 'stale', 'done', 'failed']
+
+
+def task_name(node):
+    """ Name of the files of a task, e.g. 'fwd-subject_01-1' for ('fwd', 'subject_01', '1') """
+    return '-'.join(str(n) for n in node)
+
+
+def _write_json(fname, content):
+    """ Write a marker atomically """
+    with atomic_write(fname, marker=False) as fname_tmp:
+        with open(fname_tmp, 'w') as f:
+            json.dump(content, f)
+
+
+def _read_json(fname):
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TaskLock(object):
+    """ Lock file of a task, created atomically (O_CREAT | O_EXCL) in the queue directory
+
+    The owner refreshes the modification time of the lock (heartbeat). A lock not
+    refreshed for stale_timeout seconds is considered left by a dead worker and can
+    be taken over.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the lock
+    stale_timeout : float
+        Age (s) of the last heartbeat after which the lock is stale
+    heartbeat : float
+        Period (s) of the heartbeat of the owner
+    """
+
+    def __init__(self, fname, stale_timeout=600., heartbeat=60.):
+        self.fname = fname
+        self.stale_timeout = stale_timeout
+        self.heartbeat = heartbeat
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _create(self):
+        try:
+            fd = os.open(self.fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': self.token, 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'time': time.time()}, f)
+        return True
+
+    def is_stale(self):
+        """ Whether the lock exists and was not refreshed for stale_timeout seconds """
+        try:
+            return time.time() - os.stat(self.fname).st_mtime > self.stale_timeout
+        except FileNotFoundError:
+            return False
+
+    def _recover(self):
+        """ Move a stale lock aside, only one worker can rename it """
+        fname_stale = '{0}.stale.{1}'.format(self.fname, uuid.uuid4().hex)
+        try:
+            os.rename(self.fname, fname_stale)
+        except FileNotFoundError:
+            return
+        # Another worker took the stale lock over in the meantime: give it back
+        if time.time() - os.stat(fname_stale).st_mtime <= self.stale_timeout:
+            try:
+                os.link(fname_stale, self.fname)
+            except OSError:
+                pass
+        else:
+            owner = _read_json(fname_stale) or {}
+            print('Stale lock of {0} (host {1}, pid {2}) recovered'.format(
+                op.basename(self.fname), owner.get('host'), owner.get('pid')))
+        os.remove(fname_stale)
+
+    def acquire(self):
+        """ Try to take the lock, recovering it if stale
+
+        Returns
+        -------
+        True/False : bool
+            True if the lock is taken by this worker
+        """
+        if not self._create():
+            if not self.is_stale():
+                return False
+            self._recover()
+            if not self._create():
+                return False
+
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return True
+
+    def owned(self):
+        """ Whether the lock file is still the one of this worker """
+        content = _read_json(self.fname)
+        return content is not None and content.get('token') == self.token
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            # Never refresh a lock taken over by another worker
+            if not self.owned():
+                break
+            try:
+                os.utime(self.fname)
+            except OSError:
+                pass
+
+    def release(self):
+        """ Stop the heartbeat and remove the lock if it is still owned """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.owned():
+            os.remove(self.fname)
+
+
+def _task_inputs(layout, node, args):
+    """ Files a task depends on, their stamps are part of the key of the task """
+    stage, subject = node[0], node[1]
+    if stage == 'bem':
+        return [op.join(layout.fs_subjects_dir(), subject, 'bem', 'inner_skull.surf')]
+    if stage == 'src':
+        # Meshes, parcellations and atlas read by create_source_models, segmentation and BEM
+        analysis = op.join(layout.bv_mesh_dir(subject), 'surface_analysis')
+        textures = op.join(layout.db_bv, 'hiphop138-multiscale', 'Decimated', '4K')
+        return [op.join(analysis, '{0}_{1}white_remeshed_hiphop.gii'.format(subject, h)) for h in 'LR'] + \
+            [op.join(textures, 'hiphop138_{0}white_dec_4K_parcels_marsAtlas.gii'.format(h)) for h in 'LR'] + \
+            [op.join(analysis, '{0}_parcellation.nii.gz'.format(subject)), layout.atlas(), layout.referential(),
+             layout.aseg(subject), layout.bem_model(subject)]
+    if stage == 'fwd':
+        sessions = [node[2]] if len(node) > 2 else args[1]
+        event = args[2]
+        src_files = sorted(glob.glob(op.join(layout.src_dir.format(subject), '*-src.fif')))
+        return [layout.bem_sol(subject), layout.trans(subject)] + src_files + \
+            [layout.epochs(subject, ses, event) for ses in sessions]
+    return []
+
+
+def task_key(layout, node, args):
+    """ Key of a run of a task: its arguments and the stamps of its input files
+
+    A '.done' marker is valid only for the same key, a task is run again when its
+    arguments (event, sessions, grouping, tolerances) or its inputs change.
+    """
+    args = [a.json_fname if isinstance(a, ProjectLayout) else a for a in args]
+    stamps = []
+    for f in _task_inputs(layout, node, args):
+        try:
+            st = os.stat(f)
+            stamps.append([f, st.st_size, st.st_mtime_ns])
+        except OSError:
+            stamps.append([f, None, None])
+    content = json.dumps([task_name(node), args, stamps], default=str, sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _task_status(queue_dir, node, stale_timeout, key=None):
+    name = task_name(node)
+    done = _read_json(op.join(queue_dir, name + '.done'))
+    if done is not None and (key is None or done.get('key') == key):
+        return 'done'
+    if op.isfile(op.join(queue_dir, name + '.failed')):
+        return 'failed'
+    lock = TaskLock(op.join(queue_dir, name + '.lock'), stale_timeout=stale_timeout)
+    if op.isfile(lock.fname):
+        return 'stale' if lock.is_stale() else 'running'
+    return 'pending'
+
+
+def queue_status(graph, json_fname='default', stale_timeout=600.):
+    """ Status of the tasks of a pipeline graph in the work queue of the project
+
+    Parameters
+    ----------
+    graph : dict
+        The pipeline graph, see build_pipeline_graph
+    json_fname : str | ProjectLayout
+        The path of the json file with the database coordinates
+    stale_timeout : float
+        Age (s) of the last heartbeat after which a running task is stale
+
+    Returns
+    -------
+    status : dict
+        For each node, 'pending', 'running', 'stale', 'done' or 'failed'. A task
+        is done only if its '.done' marker has the current key (see task_key)
+    """
+    layout = get_layout(json_fname)
+    queue_dir = layout.queue_dir()
+    return {node: _task_status(queue_dir, node, stale_timeout, key=task_key(layout, node, graph[node][1]))
+            for node in _topological_order(graph)}
+
+
+def print_status(status):
+    """ Print the status of each task and the number of tasks per status """
+    for node, st in status.items():
+        print('{0:<40} {1}'.format(task_name(node), st))
+    counts = [(st, sum(1 for s in status.values() if s == st)) for st in status_names]
+    print(', '.join('{0} {1}'.format(n, st) for st, n in counts if n))
+
+
+def run_worker(subjects, sessions, event, json_fname='default', run_stages=None, force_stages=None,
+               group_fwd=False, tol_trans=1e-3, tol_rot=1e-3, stale_timeout=600., heartbeat=60., poll=10.,
+               retry_failed=False, max_tasks=None):
+    """ Run tasks of the pipeline claimed through lock files on the shared project directory
+
+    Any number of workers, on any number of nodes sharing the database, can run with the same
+    arguments: each task (stage, subject[, session]) is run by the first worker that creates its
+    lock file, once its dependencies are done. Completed tasks leave a '.done' marker with the
+    key of the run (see task_key) and failed ones a '.failed' marker with the error, in the
+    queue directory of the project. A task is run again when its key changes.
+
+    Parameters
+    ----------
+    subjects, sessions, event, json_fname, run_stages, group_fwd, tol_trans, tol_rot
+        See run_pipeline
+    force_stages : list of str | None
+        Stages rebuilt even if up to date: their '.done' markers are removed when the worker
+        starts, the other workers of the run should be started without force_stages
+    stale_timeout : float
+        Age (s) of the last heartbeat after which the lock of a task is taken over
+    heartbeat : float
+        Period (s) at which a worker refreshes the lock of its task
+    poll : float
+        Period (s) at which a worker waiting for the dependencies of the remaining tasks checks again
+    retry_failed : bool
+        If True, failed tasks are run again (their marker is removed)
+    max_tasks : int | None
+        Maximum number of tasks run by this worker
+
+    Returns
+    -------
+    status : dict
+        Status of each task when the worker stops
+    """
+    layout = get_layout(json_fname)
+    graph = build_pipeline_graph(subjects, sessions, event, json_fname=layout, run_stages=run_stages,
+                                 force_stages=force_stages, group_fwd=group_fwd, tol_trans=tol_trans,
+                                 tol_rot=tol_rot)
+    order = _topological_order(graph)
+    queue_dir = layout.queue_dir()
+    if not op.exists(queue_dir):
+        os.makedirs(queue_dir, exist_ok=True)
+
+    if retry_failed:
+        for node in order:
+            fname_failed = op.join(queue_dir, task_name(node) + '.failed')
+            if op.isfile(fname_failed):
+                os.remove(fname_failed)
+
+    for node in order:
+        fname_done = op.join(queue_dir, task_name(node) + '.done')
+        if node[0] in (force_stages or []) and op.isfile(fname_done):
+            os.remove(fname_done)
+
+    n_tasks = 0
+    while max_tasks is None or n_tasks < max_tasks:
+        # Keys computed again, the inputs of a task change when its dependencies run
+        keys = {node: task_key(layout, node, graph[node][1]) for node in order}
+        status = {node: _task_status(queue_dir, node, stale_timeout, key=keys[node]) for node in order}
+
+        claimed = False
+        waiting = False
+        for node in order:
+            if status[node] in ['done', 'failed']:
+                continue
+            deps = [status[d] for d in graph[node][2]]
+            if 'failed' in deps:
+                continue
+            waiting = True
+            if status[node] == 'running' or any(d != 'done' for d in deps):
+                continue
+
+            name = task_name(node)
+            lock = TaskLock(op.join(queue_dir, name + '.lock'), stale_timeout=stale_timeout, heartbeat=heartbeat)
+            if not lock.acquire():
+                continue
+            try:
+                # Done by another worker between the status and the lock
+                if _task_status(queue_dir, node, stale_timeout, key=keys[node]) == 'done':
+                    continue
+                claimed = True
+                print('\n---------- Worker {0}:{1} running {2} ----------\n'.format(
+                    socket.gethostname(), os.getpid(), name))
+                func, args, deps = graph[node]
+                start = time.time()
+                try:
+                    func(*args)
+                except Exception as e:
+                    _write_json(op.join(queue_dir, name + '.failed'),
+                                {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(),
+                                 'error': repr(e), 'traceback': traceback.format_exc()})
+                    print('Task {0} failed: {1!r}'.format(name, e))
+                else:
+                    _write_json(op.join(queue_dir, name + '.done'),
+                                {'key': keys[node], 'host': socket.gethostname(), 'pid': os.getpid(),
+                                 'time': time.time(), 'wall': time.time() - start})
+            finally:
+                lock.release()
+            n_tasks += 1
+            # Status again, the dependencies of other tasks may be done
+            break
+
+        if not claimed:
+            if not waiting:
+                break
+            time.sleep(poll)
+
+    status = queue_status(graph, json_fname=layout, stale_timeout=stale_timeout)
+    print_status(status)
+    return status
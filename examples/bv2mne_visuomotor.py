@@ -9,14 +9,16 @@
 # ----------------------------------------------------------------------------------------------------------------------
 
 # Imports
-from bv2mne.source import create_source_models
-from bv2mne.forward import create_forward_models
+from bv2mne.pipeline import run_pipeline
 
 # Jobs
 
 create_source_model = False
 create_fwd_model = True
 
+# Number of processes running independent subjects/sessions
+n_jobs = 4
+
 # Directories and params of the project
 db = '/hpc/bagamore/brainets/data/'
 project = 'meg_te'
@@ -27,14 +29,11 @@ subjects = ['subject_01', 'subject_04', 'subject_05', 'subject_06', 'subject_07'
 sessions = ['1', '2', '3', '4', '5', '6']
 event = 'stim'
 
-# Create surfaces/volumes sources and label
+# Create surfaces/volumes sources and label (BEM included) and/or forward models
+run_stages = []
 if create_source_model:
-    for sbj in subjects:
-        create_source_models(sbj, save=True, json_fname=json_fname)
-
-# Create forwad models
+    run_stages += ['bem', 'src']
 if create_fwd_model:
-    for sbj in subjects:
-        for ses in sessions:
-            # Pipeline to estimate surfaces/volumes forward models
-            create_forward_models(sbj, ses, event, json_fname=json_fname)
+    run_stages += ['fwd']
+
+run_pipeline(subjects, sessions, event, json_fname=json_fname, n_jobs=n_jobs, run_stages=run_stages)
@@ -15,6 +15,9 @@ from bv2mne.directories import create_sbj_db_mne
 create_json_file = True
 create_db_mne = True
 
+# Anatomical files are linked instead of copied when possible
+ingest_mode = 'hardlink'
+
 # Directories and params of the project
 db = '/hpc/bagamore/brainets/data/'
 project = 'meg_te'
@@ -31,6 +34,6 @@ else:
 # Create MNE database with all directories and adds necessary files from BrainVISA and Freesurfer
 if create_db_mne:
     for sbj in subjects:
-        create_sbj_db_mne(sbj, json_fname=json_fname)
+        create_sbj_db_mne(sbj, json_fname=json_fname, mode=ingest_mode, n_jobs=4)
 
 # Manual intervention: copy and paste adapted referential.txt and MarsAtlas files into /referential and /marsatlas
\ No newline at end of file